@@ -1,5 +1,6 @@
 // components/api/analyze.ts
 import { API_BASE } from "../../utils/constants";
+import { getIdToken } from "../../services/auth";
 
 export type AnalyzeResult = {
   image_size?: { width: number; height: number };
@@ -10,6 +11,8 @@ export type AnalyzeResult = {
   roi_skeleton_png_b64?: string;
   roi_binary_rle?: any;
   finger_length_ratio_to_hand?: any;
+  scan_key?: string;
+  duplicate_of?: { scan_key: string; scan_id: string | null; hamming: number };
   error?: string;
 };
 
@@ -36,12 +39,18 @@ export async function analyzeImage(
   const payload = { ...defaults, ...extra };
   Object.entries(payload).forEach(([k, v]) => form.append(k, String(v)));
 
+  // ส่ง token ถ้า login อยู่: server จะจำ scan ล่าสุดของ user และคืนผลเดิมเมื่อถ่ายรูปซ้ำ
+  // (ไม่ login ก็วิเคราะห์ได้ แค่ไม่มี dedup)
+  const token = await getIdToken().catch(() => null);
+  const headers: Record<string, string> = token ? { Authorization: `Bearer ${token}` } : {};
+
   const ctrl = new AbortController();
   const timer = setTimeout(() => ctrl.abort(), timeoutMs);
 
   try {
     const resp = await fetch(`${API_BASE}/analyze`, {
       method: "POST",
+      headers,
       body: form,
       signal: ctrl.signal,
     });
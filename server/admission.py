@@ -0,0 +1,132 @@
+# server/admission.py
+"""
+Per-endpoint admission control.
+
+Each ``Admission`` gate allows ``max_concurrent`` requests to run, queues up to
+``max_queue`` more (FIFO, each waiting at most ``max_wait`` seconds) and sheds
+everything else with ``Overloaded``. A single user may hold at most
+``per_user`` running+queued slots, so one client's retries cannot fill the queue.
+"""
+import math
+import threading
+import time
+from collections import deque
+
+
+class Overloaded(Exception):
+    def __init__(self, gate: str, reason: str, retry_after: int):
+        super().__init__(f"{gate}: {reason}")
+        self.gate = gate
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    def __init__(self, gate: "Admission", user_id: str):
+        self._gate = gate
+        self._user_id = user_id
+        self._started = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._gate._release(self._user_id, time.monotonic() - self._started)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+class Admission:
+    def __init__(self, name: str, max_concurrent: int, max_queue: int = 0,
+                 max_wait: float = 5.0, per_user: int = 0):
+        self.name = name
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.max_queue = max(0, int(max_queue))
+        self.max_wait = float(max_wait)
+        self.per_user = int(per_user)   # 0 = ไม่จำกัดต่อ user
+        self._lock = threading.Lock()
+        self._waiters: deque = deque()  # threading.Event ของ request ที่รอ (FIFO)
+        self._per_user: dict[str, int] = {}
+        self.active = 0
+        self.admitted = 0
+        self.shed = {"queue_full": 0, "wait_timeout": 0, "per_user": 0}
+        self._waits = deque(maxlen=1024)   # queue wait (วินาที) ล่าสุด
+        self._service_ewma = 1.0
+
+    def _retry_after(self) -> int:
+        # ประมาณเวลาที่คิวจะว่าง: (คนรอ + 1) งาน / จำนวนช่อง × เวลาเฉลี่ยต่องาน
+        est = (len(self._waiters) + 1) / self.max_concurrent * self._service_ewma
+        return max(1, int(math.ceil(est)))
+
+    def acquire(self, user_id: str) -> Ticket:
+        t0 = time.monotonic()
+        with self._lock:
+            if self.per_user and self._per_user.get(user_id, 0) >= self.per_user:
+                self.shed["per_user"] += 1
+                raise Overloaded(self.name, "per_user_limit", self._retry_after())
+            if self.active < self.max_concurrent and not self._waiters:
+                return self._admit(user_id, t0)
+            if len(self._waiters) >= self.max_queue:
+                self.shed["queue_full"] += 1
+                raise Overloaded(self.name, "queue_full", self._retry_after())
+            ev = threading.Event()
+            self._waiters.append(ev)
+            self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+
+        granted = ev.wait(self.max_wait)
+        with self._lock:
+            self._per_user[user_id] -= 1
+            if not granted and not ev.is_set():
+                self._waiters.remove(ev)
+                if not self._per_user[user_id]:
+                    del self._per_user[user_id]
+                self.shed["wait_timeout"] += 1
+                raise Overloaded(self.name, "wait_timeout", self._retry_after())
+            # slot ถูกส่งต่อมาจาก _release แล้ว (active นับไว้ให้แล้ว)
+            self.active -= 1
+            return self._admit(user_id, t0)
+
+    def _admit(self, user_id: str, t0: float) -> Ticket:
+        self.active += 1
+        self.admitted += 1
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        self._waits.append(time.monotonic() - t0)
+        return Ticket(self, user_id)
+
+    def _release(self, user_id: str, service_time: float):
+        with self._lock:
+            self._service_ewma = 0.8 * self._service_ewma + 0.2 * service_time
+            n = self._per_user.get(user_id, 0) - 1
+            if n > 0:
+                self._per_user[user_id] = n
+            else:
+                self._per_user.pop(user_id, None)
+            self.active -= 1
+            if self._waiters:
+                # ส่ง slot ให้คนที่รอนานที่สุดโดยตรง
+                self.active += 1
+                self._waiters.popleft().set()
+
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def stats(self) -> dict:
+        with self._lock:
+            waits = sorted(self._waits)
+        def pct(p):
+            return round(waits[min(len(waits) - 1, int(p * len(waits)))] * 1000, 1) if waits else 0.0
+        return {
+            "active": self.active,
+            "queued": len(self._waiters),
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "shed": dict(self.shed),
+            "queue_wait_ms": {"p50": pct(0.50), "p95": pct(0.95), "max": pct(1.0)},
+            "service_ewma_s": round(self._service_ewma, 3),
+        }
@@ -0,0 +1,490 @@
+# server/analyze_jobs.py
+"""
+Asynchronous /analyze jobs on a pool of worker processes.
+
+Submit an encoded image + PipeConfig and get a job id back; a worker process
+(with a warm mediapipe detector) runs ``python.analyze`` and the result is
+kept in a job store until it expires. Clients poll or long-poll for it.
+
+Stores:
+- ``MemoryJobStore``: in-process dict (default)
+- ``SqliteJobStore``: local sqlite file, so finished jobs survive a restart
+
+With a ``transport`` (``shm_transport.SegmentPool``) the image is decoded on
+the Flask side into shared memory and workers read it in place; jobs submitted
+with ``raw_masks=True`` also get their ROI masks back through a preallocated
+segment (``AnalyzeJobs.masks``) instead of the result pickle.
+"""
+import json
+import logging
+import multiprocessing as mp
+import os
+import random
+import signal
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict
+
+import cv2
+import numpy as np
+
+from shm_transport import ShmPoolFull, ShmRef
+
+QUEUED, RUNNING, DONE, ERROR, TIMEOUT, CANCELLED = (
+    "queued", "running", "done", "error", "timeout", "cancelled",
+)
+FINAL_STATES = (DONE, ERROR, TIMEOUT, CANCELLED)
+
+log = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+# ---------- worker process side ----------
+def _init_worker(pids=None):
+    if pids is not None:
+        pids.put(os.getpid())   # ให้ฝั่ง Flask kill worker ที่ค้างได้ (WorkerPool.kill)
+    # งานขนานกันที่ระดับ process แล้ว ไม่ต้องให้ OpenCV แตก thread ซ้อนอีก
+    cv2.setNumThreads(1)
+    from python import warm_detectors
+    warm_detectors()
+
+
+def _run_analyze(raw, cfg: dict, outdir: str) -> dict:
+    from python import analyze, PipeConfig
+    img = raw if isinstance(raw, np.ndarray) else cv2.imdecode(np.frombuffer(raw, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return {"error": "missing/invalid image"}
+    return analyze(img, outdir=outdir, Cfg=PipeConfig(**cfg))
+
+
+def _run_analyze_shm(ref: ShmRef, cfg: dict, outdir: str, out_ref: ShmRef | None = None) -> dict:
+    from shm_transport import detach_all
+    try:
+        return _analyze_shm(ref, cfg, outdir, out_ref)
+    finally:
+        # view ทั้งหมดหมดอายุพร้อม frame ของ _analyze_shm แล้ว: unmap ให้ segment ที่ pool unlink คืนหน่วยความจำจริง
+        detach_all()
+
+
+def _analyze_shm(ref: ShmRef, cfg: dict, outdir: str, out_ref: ShmRef | None) -> dict:
+    from python import analyze, PipeConfig
+    from shm_transport import view
+    arrays = {} if out_ref is not None else None
+    out = analyze(view(ref), outdir=outdir, Cfg=PipeConfig(**cfg), arrays=arrays)
+    if arrays:
+        out["masks_shm"] = _write_masks(arrays, out_ref)
+    return out
+
+
+def _write_masks(arrays: dict, out_ref: ShmRef) -> dict:
+    """Copy masks into the job's output segment; returns ``{name: {offset, shape}}``."""
+    from shm_transport import view
+    dst, pos, meta = view(out_ref), 0, {}
+    for name, arr in arrays.items():
+        n = arr.size
+        if pos + n > dst.size:
+            break
+        dst[pos:pos + n] = arr.reshape(-1)
+        meta[name] = {"offset": out_ref.offset + pos, "shape": list(arr.shape)}
+        pos += (n + 63) & ~63
+    return meta
+
+
+class WorkerPool:
+    """
+    ``ProcessPoolExecutor`` that knows its worker PIDs (each worker reports its
+    own from the initializer), so a pool stuck on an overrunning job can be
+    killed; ``concurrent.futures`` has no public way to stop a running task.
+    """
+
+    def __init__(self, workers: int, ctx):
+        self._pid_queue = ctx.SimpleQueue()
+        self._pids = set()
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=ctx,
+            initializer=_init_worker, initargs=(self._pid_queue,),
+        )
+
+    def submit(self, fn, *args):
+        return self.executor.submit(fn, *args)
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False):
+        self.executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+    def kill(self):
+        """SIGKILL every worker; their running futures then fail with ``BrokenProcessPool``."""
+        while not self._pid_queue.empty():
+            self._pids.add(self._pid_queue.get())
+        for pid in self._pids:
+            try:
+                os.kill(pid, getattr(signal, "SIGKILL", signal.SIGTERM))
+            except OSError:
+                pass
+
+
+def start_pool(workers: int | None = None, start_method: str | None = None) -> WorkerPool:
+    """
+    Create the worker pool and start its processes now instead of on the first
+    submit. With fork this must run before the parent starts any thread (log
+    writer, write queue, gRPC): a child forked while another thread holds a
+    lock inherits that lock held forever.
+    """
+    if not start_method:
+        # fork: worker ไม่ต้อง import serve_flask ซ้ำ (spawn/forkserver จะรันโค้ด top-level ของ __main__ ใหม่)
+        start_method = "fork" if "fork" in mp.get_all_start_methods() else "spawn"
+    pool = WorkerPool(workers or os.cpu_count() or 1, mp.get_context(start_method))
+    pool.submit(int)   # submit แรกสร้าง worker ทั้งหมด (fork) และให้ initializer เริ่มโหลด detector
+    return pool
+
+
+# ---------- stores ----------
+def _json_default(o):
+    return o.item() if hasattr(o, "item") else str(o)
+
+
+class MemoryJobStore:
+    def __init__(self):
+        self._jobs: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def put(self, job: dict):
+        with self._lock:
+            self._jobs[job["id"]] = dict(job)
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def purge(self, older_than: float):
+        with self._lock:
+            for job_id in [k for k, j in self._jobs.items()
+                           if j["status"] in FINAL_STATES and (j.get("finished_at") or 0) < older_than]:
+                del self._jobs[job_id]
+
+
+class SqliteJobStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, status TEXT, finished_at REAL, body TEXT)"
+        )
+        # งานที่ค้างตอน process ตายไปแล้ว จะไม่มีวันเสร็จ
+        self._conn.execute(
+            "UPDATE jobs SET status = ?, finished_at = ? WHERE status IN (?, ?)",
+            (ERROR, time.time(), QUEUED, RUNNING),
+        )
+        self._conn.commit()
+
+    def put(self, job: dict):
+        body = json.dumps(job, ensure_ascii=False, default=_json_default)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, status, finished_at, body) VALUES (?, ?, ?, ?)",
+                (job["id"], job["status"], job.get("finished_at"), body),
+            )
+            self._conn.commit()
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute("SELECT status, body FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if not row:
+            return None
+        job = json.loads(row[1])
+        job["status"] = row[0]
+        return job
+
+    def purge(self, older_than: float):
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (older_than,)
+            )
+            self._conn.commit()
+
+
+# ---------- manager (Flask process side) ----------
+class AnalyzeJobs:
+    def __init__(self, workers: int | None = None, max_pending: int = 32,
+                 timeout: float = 60.0, result_ttl: float = 600.0,
+                 store=None, outdir: str | None = None, debug_sample: float = 1.0,
+                 start_method: str | None = None, transport=None, pool=None,
+                 kill_after: float | None = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max(1, int(max_pending))
+        self.timeout = float(timeout)
+        # งานที่เกิน deadline ไปอีก kill_after วินาทีแล้วยังไม่จบ: kill ทั้ง pool (0 = ไม่ kill รอจน worker เสร็จเอง)
+        self.kill_after = self.timeout if kill_after is None else float(kill_after)
+        self.result_ttl = float(result_ttl)
+        self.store = store or MemoryJobStore()
+        self.outdir = outdir              # ภาพ debug ของ worker (None = ไม่เขียน)
+        self.debug_sample = float(debug_sample)
+        self.transport = transport        # SegmentPool หรือ None (ส่ง bytes ผ่าน pickle แบบเดิม)
+        self.start_method = start_method
+        self._pool = pool            # None = สร้างตอน submit แรก (ใช้ start_pool ก่อนมี thread เมื่อใช้ fork)
+        self._lock = threading.Lock()
+        self._futures = {}           # job_id -> Future (งานที่ยังไม่จบ)
+        self._job_pools = {}         # job_id -> WorkerPool ที่รันงานนั้น
+        self._events = {}            # job_id -> threading.Event (long-poll)
+        self._mask_leases = {}       # job_id -> Lease ของ raw masks ที่ยังไม่ถูกอ่าน
+        self.submitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.pool_restarts = 0
+        self.pool_kills = 0
+        self._monitor = threading.Thread(target=self._watch, name="analyze-jobs", daemon=True)
+        self._monitor.start()
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = start_pool(self.workers, self.start_method)
+            return self._pool
+
+    def _discard_pool(self, pool, kill: bool = False):
+        """
+        Worker ตาย (OOM/segfault) ทำให้ทั้ง pool ใช้ต่อไม่ได้: ทิ้งไปแล้วให้ submit ถัดไปสร้างใหม่
+        (pool ใหม่ fork ตอนมี thread แล้ว แต่เกิดเฉพาะหลัง worker ตาย แทนที่จะตอบ 500 ตลอดไป)
+        """
+        with self._lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+            self.pool_restarts += 1
+        pool.shutdown(wait=False, cancel_futures=True)
+        if kill:
+            self.pool_kills += 1
+            pool.kill()
+
+    def depth(self) -> int:
+        return len(self._futures)
+
+    def submit(self, image, cfg, raw_masks: bool = False) -> str:
+        """
+        Queue one analysis of encoded bytes or a decoded BGR array. Raises
+        ``JobQueueFull`` when ``max_pending`` jobs are unfinished (or shared
+        memory is exhausted) and ``ValueError`` for an undecodable image.
+        """
+        cfg_dict = asdict(cfg) if not isinstance(cfg, dict) else dict(cfg)
+        if raw_masks and self.transport is None:
+            raise ValueError("raw_masks needs a shared-memory transport")
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            if len(self._futures) >= self.max_pending:
+                self.rejected += 1
+                raise JobQueueFull()
+            self._events[job_id] = threading.Event()
+            self._futures[job_id] = None  # จองที่ก่อน submit
+
+        leases = []
+        try:
+            outdir = self.outdir if self.outdir and random.random() < self.debug_sample else None
+            if self.transport is None:
+                task = (_run_analyze, image, cfg_dict, outdir)
+            else:
+                leases, task = self._shm_task(job_id, image, cfg_dict, outdir, raw_masks)
+            self.store.put({"id": job_id, "status": QUEUED, "created_at": now, "deadline": now + self.timeout})
+            pool = self._executor()
+            try:
+                fut = pool.submit(*task)
+            except BrokenProcessPool:
+                self._discard_pool(pool)
+                pool = self._executor()
+                fut = pool.submit(*task)
+        except BaseException as e:
+            for lease in leases:
+                self.transport.release(lease)
+            with self._lock:
+                self._futures.pop(job_id, None)
+                self._events.pop(job_id, None)
+                if isinstance(e, ShmPoolFull):
+                    self.rejected += 1
+            if isinstance(e, ShmPoolFull):
+                raise JobQueueFull() from e
+            raise
+        with self._lock:
+            self._futures[job_id] = fut
+            self._job_pools[job_id] = pool
+            if raw_masks:
+                self._mask_leases[job_id] = leases[1]
+        self.submitted += 1
+        if leases:
+            # คืน segment ขาเข้าเมื่อ worker เลิกใช้จริง (ไม่ใช่ตอน cancel/timeout ที่ worker อาจยังอ่านอยู่)
+            fut.add_done_callback(lambda f, lease=leases[0]: self.transport.release(lease))
+        fut.add_done_callback(lambda f, jid=job_id, p=pool: self._finish(jid, f, p))
+        return job_id
+
+    def _shm_task(self, job_id: str, image, cfg_dict: dict, outdir, raw_masks: bool):
+        if isinstance(image, np.ndarray):
+            in_lease, ref = self.transport.put_array(np.ascontiguousarray(image), owner=job_id)
+        else:
+            got = self.transport.decode(image, owner=job_id)
+            if got is None:
+                raise ValueError("missing/invalid image")
+            in_lease, ref = got
+        if not raw_masks:
+            return [in_lease], (_run_analyze_shm, ref, cfg_dict, outdir)
+        # binary + skeleton ของ ROI ไม่เกินภาพที่ย่อแล้วอย่างละหนึ่งภาพ
+        side = min(int(cfg_dict.get("max_side") or ref.shape[0]), max(ref.shape[:2]))
+        try:
+            out_lease, out_ref = self.transport.alloc((2 * side * side + 128,), "uint8", owner=job_id)
+        except BaseException:
+            self.transport.release(in_lease)
+            raise
+        return [in_lease, out_lease], (_run_analyze_shm, ref, cfg_dict, outdir, out_ref)
+
+    def masks(self, job_id: str) -> dict | None:
+        """
+        Raw ``roi_binary`` / ``roi_skeleton`` arrays of a finished job submitted
+        with ``raw_masks=True``. The segment is released, so this works once.
+        """
+        job = self.store.get(job_id)
+        if job is None or job["status"] not in FINAL_STATES:
+            return None
+        with self._lock:
+            lease = self._mask_leases.pop(job_id, None)
+        if lease is None:
+            return None
+        try:
+            meta = (job.get("result") or {}).get("masks_shm") or {}
+            return {name: self.transport.read(ShmRef(lease.name, tuple(m["shape"]), "|u1", m["offset"]))
+                    for name, m in meta.items()}
+        finally:
+            self.transport.release(lease)
+
+    def _finish(self, job_id: str, fut, pool=None):
+        exc = None if fut.cancelled() else fut.exception()
+        if isinstance(exc, BrokenProcessPool):
+            self._discard_pool(pool)
+        job = self.store.get(job_id)
+        if job is None or job["status"] in FINAL_STATES:
+            self._drop_masks(job_id)
+            self._release(job_id)
+            return
+        if fut.cancelled():
+            # cancel()/timeout ตั้งสถานะก่อน cancel future เสมอ: ที่เหลือคืองานในคิวของ pool ที่ถูกทิ้ง
+            job["status"], job["error"] = ERROR, "the worker pool was restarted before this job ran, submit again"
+        elif isinstance(exc, BrokenProcessPool):
+            job["status"], job["error"] = ERROR, "worker process died; the pool was restarted, submit again"
+        elif exc is not None:
+            job["status"], job["error"] = ERROR, f"{exc.__class__.__name__}: {exc}"
+        else:
+            job["status"], job["result"] = DONE, fut.result()
+        job["finished_at"] = time.time()
+        self.store.put(job)
+        if job["status"] != DONE or not (job.get("result") or {}).get("masks_shm"):
+            self._drop_masks(job_id)
+        self._release(job_id)
+
+    def _drop_masks(self, job_id: str):
+        with self._lock:
+            lease = self._mask_leases.pop(job_id, None)
+        if lease is not None:
+            self.transport.release(lease)
+
+    def _release(self, job_id: str):
+        # คืนช่องของ max_pending เฉพาะตอน future จบจริง (worker ว่างแล้ว)
+        with self._lock:
+            self._futures.pop(job_id, None)
+            self._job_pools.pop(job_id, None)
+            ev = self._events.pop(job_id, None)
+        if ev:
+            ev.set()
+
+    def _notify(self, job_id: str):
+        # ปลุก long-poll ของงานที่ถูก cancel/timeout แต่ยังนับเป็นงานค้างจนกว่า worker จะทำเสร็จ
+        ev = self._events.get(job_id)
+        if ev:
+            ev.set()
+
+    def get(self, job_id: str, wait: float = 0.0) -> dict | None:
+        """Job record; with ``wait`` > 0 block up to that many seconds for it to finish."""
+        if wait > 0:
+            ev = self._events.get(job_id)
+            if ev is not None:
+                ev.wait(wait)
+        job = self.store.get(job_id)
+        if job and job["status"] == QUEUED:
+            fut = self._futures.get(job_id)
+            if fut is not None and fut.running():
+                job["status"] = RUNNING
+        return job
+
+    def cancel(self, job_id: str) -> dict | None:
+        """
+        Cancel a job; a job already running in a worker finishes but its result
+        is discarded, and it keeps its ``max_pending`` slot until then.
+        """
+        job = self.store.get(job_id)
+        if job is None or job["status"] in FINAL_STATES:
+            return job
+        job["status"], job["finished_at"] = CANCELLED, time.time()
+        self.store.put(job)
+        fut = self._futures.get(job_id)
+        if fut is not None:
+            fut.cancel()
+        self._notify(job_id)
+        return job
+
+    def _watch(self):
+        last_purge = 0.0
+        while True:
+            time.sleep(0.5)
+            now = time.time()
+            for job_id in list(self._futures):
+                job = self.store.get(job_id)
+                if job and job["status"] not in FINAL_STATES and now > job.get("deadline", now):
+                    job["status"], job["finished_at"] = TIMEOUT, now
+                    job["error"] = f"analysis exceeded {self.timeout:.0f}s"
+                    self.store.put(job)
+                    fut = self._futures.get(job_id)
+                    if fut is not None:
+                        fut.cancel()
+                    self.timed_out += 1
+                    self._notify(job_id)
+                elif (job and job["status"] == TIMEOUT and self.kill_after > 0
+                      and now > job.get("deadline", now) + self.kill_after):
+                    # worker ยังติดงานนี้อยู่ (ภาพที่ทำให้ pipeline วนนาน): kill pool ทั้งชุดเพื่อคืน worker
+                    # งานอื่นที่รันใน pool เดียวกันจะจบเป็น error และ submit ถัดไปได้ pool ใหม่
+                    pool = self._job_pools.get(job_id)
+                    if pool is not None:
+                        log.warning("analyze job %s overran its deadline by %.0fs; killing the worker pool",
+                                    job_id, now - job["deadline"])
+                        self._discard_pool(pool, kill=True)
+            if now - last_purge > 30:
+                self.store.purge(now - self.result_ttl)
+                for job_id in list(self._mask_leases):
+                    if self.store.get(job_id) is None:
+                        self._drop_masks(job_id)
+                if self.transport is not None:
+                    self.transport.reap(active=lambda owner: owner in self._futures)
+                last_purge = now
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "pending": self.depth(),
+            "max_pending": self.max_pending,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "pool_restarts": self.pool_restarts,
+            "pool_kills": self.pool_kills,
+            "shm": self.transport.stats() if self.transport is not None else None,
+        }
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        if self.transport is not None:
+            self.transport.close()
@@ -0,0 +1,249 @@
+# server/applog.py
+"""
+Structured logging that stays off the request thread.
+
+``setup_logging()`` routes the root logger through a bounded queue: the
+request thread only renders the message and enqueues the record, and a writer
+thread formats records (one JSON object per line, or key=value text) and
+writes them in batches every ``linger`` seconds, so it wakes up a few times a
+second instead of contending for the GIL on every line. When the queue is
+full, records below ERROR are dropped and counted; errors are written
+synchronously instead of being lost.
+
+``init_request_logging(app)`` gives every request an id (``X-Request-Id`` in
+and out) and adds ``request_id``/``endpoint`` to every record logged while it
+runs. It also writes one access record per request with status and latency.
+Sampling:
+
+* DEBUG records are kept for a ``debug_sample`` fraction of requests (decided
+  once per request, so a sampled request keeps all of its debug lines).
+* Access records are kept for ``access_sample`` of requests, but always for
+  5xx responses and requests slower than ``slow_ms``.
+* WARNING and above are never sampled.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+
+from flask import g, request
+
+_REQUEST_ID = contextvars.ContextVar("request_id", default=None)
+_ENDPOINT = contextvars.ContextVar("endpoint", default=None)
+_SAMPLED = contextvars.ContextVar("debug_sampled", default=True)
+
+# attribute มาตรฐานของ LogRecord — ที่เหลือ (จาก extra=...) คือ field ของ record
+_STD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+def _fields(record) -> dict:
+    return {k: v for k, v in vars(record).items() if k not in _STD_ATTRS and not k.startswith("_")}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        out = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **_fields(record),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            out["exc"] = record.exc_text
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        ts = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.created))
+        extra = " ".join(f"{k}={v}" for k, v in _fields(record).items())
+        line = f"{ts} {record.levelname:<7} [{record.name}] {record.getMessage()}" + (f" {extra}" if extra else "")
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        return f"{line}\n{record.exc_text}" if record.exc_text else line
+
+
+class _ContextFilter(logging.Filter):
+    """เติม request_id/endpoint ตอนอยู่ใน thread ของ request และตัด DEBUG ของ request ที่ไม่ถูก sample"""
+
+    def filter(self, record) -> bool:
+        if record.levelno < logging.INFO and not _SAMPLED.get():
+            return False
+        rid = _REQUEST_ID.get()
+        if rid is not None and not hasattr(record, "request_id"):
+            record.request_id = rid
+            record.endpoint = _ENDPOINT.get()
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, q, fallback):
+        super().__init__(q)
+        self.fallback = fallback
+        self.dropped = 0
+
+    def prepare(self, record):
+        # ทำแค่ที่ต้องทำใน thread ต้นทาง (args/exc_info อาจอ้าง object ที่เปลี่ยนภายหลัง) ไม่ format ทั้งบรรทัด
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno >= logging.ERROR:
+                self.fallback.handle(record)
+            else:
+                self.dropped += 1
+
+
+class _Writer(threading.Thread):
+    def __init__(self, q, out: logging.StreamHandler, linger: float = 0.05, batch: int = 1000):
+        super().__init__(name="log-writer", daemon=True)
+        self.q = q
+        self.out = out
+        self.linger = linger
+        self.batch = batch
+
+    def run(self):
+        running = True
+        while running:
+            records = [self.q.get()]
+            time.sleep(self.linger)   # ให้ record ที่ตามมาสะสมเป็นชุดเดียว
+            try:
+                while len(records) < self.batch:
+                    records.append(self.q.get_nowait())
+            except queue.Empty:
+                pass
+            if None in records:
+                running = False
+            lines = []
+            for record in records:
+                if record is None:
+                    continue
+                try:
+                    lines.append(self.out.format(record))
+                except Exception:
+                    self.out.handleError(record)
+            if lines:
+                with self.out.lock:
+                    self.out.stream.write("\n".join(lines) + "\n")
+                    self.out.flush()
+
+    def stop(self, timeout: float = 2.0):
+        try:
+            self.q.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.join(timeout)
+
+
+_STATE = {"handler": None, "writer": None}
+_SETUP_LOCK = threading.Lock()
+
+
+def setup_logging(level: str = "INFO", fmt: str = "json", queue_size: int = 10000,
+                  stream=None, linger: float = 0.05):
+    """Install the queue handler on the root logger (idempotent)."""
+    with _SETUP_LOCK:
+        if _STATE["handler"] is not None:
+            return _STATE["handler"]
+        out = logging.StreamHandler(stream or sys.stdout)
+        out.setFormatter(TextFormatter() if fmt == "text" else JsonFormatter())
+        handler = _QueueHandler(queue.Queue(maxsize=max(1, int(queue_size))), out)
+        handler.addFilter(_ContextFilter())
+        writer = _Writer(handler.queue, out, linger=linger)
+        writer.start()
+        atexit.register(writer.stop)
+
+        root = logging.getLogger()
+        root.handlers = [handler]
+        root.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+        _STATE.update(handler=handler, writer=writer)
+        return handler
+
+
+class RequestLog:
+    def __init__(self, access_sample: float = 1.0, debug_sample: float = 0.05, slow_ms: float = 2000.0):
+        self.access_sample = float(access_sample)
+        self.debug_sample = float(debug_sample)
+        self.slow_ms = float(slow_ms)
+        self.log = logging.getLogger("access")
+        self.requests = 0
+        self.logged = 0
+
+    def before_request(self):
+        # id ไม่ต้องสุ่มแบบ crypto (uuid4 อ่าน os.urandom ทุก request)
+        rid = (request.headers.get("X-Request-Id") or "").strip()[:64] or f"{random.getrandbits(64):016x}"
+        g._log_t0 = time.perf_counter()
+        g._log_tokens = (
+            _REQUEST_ID.set(rid),
+            _ENDPOINT.set(request.endpoint),
+            _SAMPLED.set(self.debug_sample >= 1.0 or random.random() < self.debug_sample),
+        )
+
+    def after_request(self, resp):
+        rid = _REQUEST_ID.get()
+        if rid is None:
+            return resp
+        resp.headers.setdefault("X-Request-Id", rid)
+        ms = (time.perf_counter() - g.get("_log_t0", time.perf_counter())) * 1000
+        self.requests += 1
+        slow = ms >= self.slow_ms
+        if resp.status_code >= 500 or slow or random.random() < self.access_sample:
+            self.logged += 1
+            level = logging.ERROR if resp.status_code >= 500 else logging.WARNING if slow else logging.INFO
+            if self.log.isEnabledFor(level):
+                # สร้าง record เอง: ข้าม findCaller (แพงสุดของ logger.log และไม่ได้ใช้)
+                # stream/SSE: latency คือเวลาถึง header แรก
+                self.log.handle(self.log.makeRecord(
+                    self.log.name, level, "(access)", 0, "%s %s %d",
+                    (request.method, request.path, resp.status_code), None, extra={
+                        "method": request.method,
+                        "path": request.path,
+                        "status": resp.status_code,
+                        "latency_ms": round(ms, 1),
+                        "bytes": resp.calculate_content_length() if not resp.is_streamed else None,
+                    }))
+        return resp
+
+    def teardown_request(self, exc=None):
+        tokens = g.pop("_log_tokens", None)
+        if tokens:
+            for var, token in zip((_REQUEST_ID, _ENDPOINT, _SAMPLED), tokens):
+                var.reset(token)
+
+    def stats(self) -> dict:
+        handler = _STATE["handler"]
+        return {
+            "requests": self.requests,
+            "access_logged": self.logged,
+            "queue_depth": handler.queue.qsize() if handler else 0,
+            "dropped": handler.dropped if handler else 0,
+        }
+
+
+def init_request_logging(app, **kwargs) -> RequestLog:
+    """
+    Register request id / access logging hooks on ``app``. Call before other
+    ``after_request`` hooks (e.g. compression) so the access record sees the
+    final response.
+    """
+    rl = RequestLog(**kwargs)
+    app.before_request(rl.before_request)
+    app.after_request(rl.after_request)
+    app.teardown_request(rl.teardown_request)
+    return rl
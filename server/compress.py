@@ -0,0 +1,107 @@
+# server/compress.py
+"""
+Negotiated response compression for large JSON bodies.
+
+``init_compression(app)`` registers an ``after_request`` hook that picks
+brotli (if ``pip install brotli`` is present and the client accepts ``br``)
+or gzip from ``Accept-Encoding`` and compresses buffered responses larger than
+``min_size`` bytes. Streamed responses (SSE) and already-encoded bodies are
+left alone so token streaming is not delayed.
+"""
+import gzip
+import threading
+
+from flask import request
+
+try:
+    import brotli
+except Exception:
+    brotli = None
+
+_COMPRESSIBLE = ("application/json", "text/", "application/javascript", "image/svg+xml")
+
+
+def _accepted(header: str) -> dict[str, float]:
+    out = {}
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for p in params.split(";"):
+            k, _, v = p.strip().partition("=")
+            if k == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        out[name] = q
+    return out
+
+
+def choose_encoding(header: str) -> str | None:
+    accepted = _accepted(header)
+    star = accepted.get("*", 0.0)
+    for enc in (("br",) if brotli is not None else ()) + ("gzip",):
+        if accepted.get(enc, star) > 0:
+            return enc
+    return None
+
+
+class Compressor:
+    def __init__(self, min_size: int = 1024, level: int = 6, brotli_quality: int = 5):
+        self.min_size = int(min_size)
+        self.level = int(level)
+        self.brotli_quality = int(brotli_quality)
+        self._lock = threading.Lock()
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def compress(self, data: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            return brotli.compress(data, quality=self.brotli_quality, mode=brotli.MODE_TEXT)
+        return gzip.compress(data, compresslevel=self.level, mtime=0)
+
+    def after_request(self, resp):
+        if (resp.direct_passthrough or resp.is_streamed
+                or resp.status_code < 200 or resp.status_code in (204, 304)
+                or "Content-Encoding" in resp.headers
+                or not (resp.mimetype or "").startswith(_COMPRESSIBLE)
+                or resp.mimetype == "text/event-stream"):
+            return resp
+        resp.vary.add("Accept-Encoding")
+        encoding = choose_encoding(request.headers.get("Accept-Encoding", ""))
+        if encoding is None:
+            return resp
+        data = resp.get_data()
+        if len(data) < self.min_size:
+            return resp
+        body = self.compress(data, encoding)
+        if len(body) >= len(data):
+            return resp
+        resp.set_data(body)
+        resp.headers["Content-Encoding"] = encoding
+        with self._lock:
+            self.compressed += 1
+            self.bytes_in += len(data)
+            self.bytes_out += len(body)
+        return resp
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "brotli": brotli is not None,
+                "min_size": self.min_size,
+                "compressed": self.compressed,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "ratio": round(self.bytes_out / self.bytes_in, 3) if self.bytes_in else None,
+            }
+
+
+def init_compression(app, min_size: int = 1024, level: int = 6, brotli_quality: int = 5) -> Compressor:
+    comp = Compressor(min_size, level, brotli_quality)
+    app.after_request(comp.after_request)
+    return comp
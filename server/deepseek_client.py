@@ -0,0 +1,300 @@
+# server/deepseek_client.py
+"""
+DeepSeek HTTP client with an end-to-end deadline per call.
+
+* Every call gets a deadline (``deadline`` seconds from the start). Connect and
+  read timeouts are clipped to the time left, and retries (connection errors,
+  429/502/503/504) only happen while there is time for them. Read timeouts are
+  not retried: the upstream is still generating and a retry would start over.
+* Streams are held to the same deadline: ``open_stream`` returns a response
+  whose ``iter_lines`` raises the deadline error once it has passed (checked
+  per line, so a stalled body is still bounded by the read timeout first).
+* With ``hedge=True`` a non-stream call that has not finished after the
+  observed p95 latency (``hedge_after`` until enough samples exist) sends a
+  second identical request; the first success wins and the loser is closed.
+* The connection pool is sized explicitly (``pool_size``) so it matches the
+  number of concurrent LLM requests the server admits (plus hedges).
+"""
+import json
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RETRY_STATUS = frozenset([429, 502, 503, 504])
+
+
+class DeepSeekError(Exception):
+    """DeepSeek call failed; ``body``/``status`` are what the endpoint should return."""
+
+    def __init__(self, body: dict, status: int):
+        super().__init__(body)
+        self.body = body
+        self.status = status
+
+
+class _Cancelled(Exception):
+    pass
+
+
+def _deadline_error(detail="DeepSeek deadline exceeded"):
+    return DeepSeekError({"error": "deepseek_timeout", "detail": detail}, 504)
+
+
+def _is_timeout(e: Exception) -> bool:
+    return isinstance(e, DeepSeekError) and isinstance(e.body, dict) and e.body.get("error") == "deepseek_timeout"
+
+
+class _DeadlineStream:
+    """Ok streaming response; ``iter_lines`` stops with a deadline error once ``deadline`` passes."""
+
+    def __init__(self, r: requests.Response, deadline: float, on_timeout):
+        self._r = r
+        self.deadline = deadline
+        self._on_timeout = on_timeout
+
+    def iter_lines(self, **kwargs):
+        for line in self._r.iter_lines(**kwargs):
+            if time.monotonic() > self.deadline:
+                self._on_timeout()
+                raise _deadline_error("DeepSeek stream exceeded its deadline")
+            yield line
+
+    def close(self):
+        self._r.close()
+
+    def __getattr__(self, name):
+        return getattr(self._r, name)
+
+
+class DeepSeekClient:
+    def __init__(self, base: str, api_key: str, *, connect_timeout: float = 10.0,
+                 read_timeout: float = 75.0, deadline: float = 90.0, max_retries: int = 2,
+                 backoff: float = 0.5, pool_size: int = 32, hedge: bool = False,
+                 hedge_after: float = 8.0, hedge_min_samples: int = 20):
+        self.base = base.rstrip("/")
+        self.api_key = api_key
+        self.connect_timeout = float(connect_timeout)
+        self.read_timeout = float(read_timeout)
+        self.deadline = float(deadline)
+        self.max_retries = max(0, int(max_retries))
+        self.backoff = float(backoff)
+        self.pool_size = max(1, int(pool_size))
+        self.hedge = bool(hedge)
+        self.hedge_after = float(hedge_after)
+        self.hedge_min_samples = int(hedge_min_samples)
+
+        self.session = requests.Session()
+        # retry ระดับ urllib3 เหลือแค่ตอนต่อไม่ติด (request ยังไม่ถูกส่ง) ที่เหลือจัดการเองตาม deadline
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=self.pool_size,
+            max_retries=Retry(total=0, connect=0, read=0, status=0, redirect=0, raise_on_status=False),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._pool = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="deepseek")
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=256)   # วินาทีของ call non-stream ที่สำเร็จ
+        self.calls = 0
+        self.retries = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def _headers(self):
+        return {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"}
+
+    def _count(self, field: str, n: int = 1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + n)
+
+    # ---------- one HTTP attempt ----------
+    def _post_once(self, payload: dict, stream: bool, deadline: float, cancel: threading.Event):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise _deadline_error()
+        try:
+            r = self.session.post(
+                f"{self.base}/chat/completions",
+                headers=self._headers(),
+                json=payload,
+                timeout=(min(self.connect_timeout, remaining), min(self.read_timeout, remaining)),
+                stream=True,
+            )
+        except requests.exceptions.ReadTimeout:
+            raise _deadline_error("DeepSeek read timed out")
+
+        if cancel.is_set():
+            r.close()
+            raise _Cancelled()
+        if not r.ok:
+            try:
+                body = r.json()
+            except Exception:
+                body = {"error": r.text}
+            r.close()
+            raise DeepSeekError(body, r.status_code)
+        if stream:
+            return r
+
+        buf = bytearray()
+        try:
+            for chunk in r.iter_content(chunk_size=64 * 1024):
+                if cancel.is_set():
+                    raise _Cancelled()
+                if time.monotonic() > deadline:
+                    raise _deadline_error()
+                buf += chunk
+        except requests.exceptions.ConnectionError as e:
+            # read timeout ระหว่างอ่าน body มาเป็น ConnectionError ของ requests
+            if "timed out" in str(e).lower():
+                raise _deadline_error("DeepSeek read timed out")
+            raise
+        finally:
+            r.close()
+        try:
+            return json.loads(buf)
+        except ValueError:
+            raise DeepSeekError({"error": "invalid_response",
+                                 "detail": bytes(buf[:200]).decode("utf-8", errors="replace")}, 502)
+
+    # ---------- attempts with deadline-aware retries ----------
+    def _call(self, payload: dict, stream: bool, deadline: float, cancel: threading.Event):
+        attempt = 0
+        while True:
+            try:
+                return self._post_once(payload, stream, deadline, cancel)
+            except requests.exceptions.ConnectionError as e:
+                last = DeepSeekError({"error": "request_failed", "detail": str(e)}, 502)
+            except DeepSeekError as e:
+                if e.status not in RETRY_STATUS or _is_timeout(e):
+                    raise
+                last = e
+            except requests.RequestException as e:
+                raise DeepSeekError({"error": "request_failed", "detail": str(e)}, 502)
+
+            attempt += 1
+            delay = self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+            if attempt > self.max_retries or time.monotonic() + delay >= deadline:
+                raise last
+            self._count("retries")
+            if cancel.wait(delay):
+                raise _Cancelled()
+
+    def hedge_delay(self) -> float | None:
+        """Seconds before a hedge request is sent (None = hedging off)."""
+        if not self.hedge:
+            return None
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < self.hedge_min_samples:
+            return self.hedge_after
+        return samples[int(0.95 * (len(samples) - 1))]
+
+    def _finish(self, t0: float, exc: Exception | None):
+        with self._lock:
+            self.calls += 1
+            if exc is None:
+                self._latencies.append(time.monotonic() - t0)
+            elif _is_timeout(exc):
+                self.timeouts += 1
+            else:
+                self.errors += 1
+
+    # ---------- public API ----------
+    def complete(self, payload: dict, deadline: float | None = None) -> dict:
+        """Non-stream ``chat/completions``; returns the parsed JSON or raises ``DeepSeekError``."""
+        t0 = time.monotonic()
+        end = t0 + (deadline or self.deadline)
+        hedge_after = self.hedge_delay()
+        try:
+            if hedge_after is None or t0 + hedge_after >= end:
+                out = self._call(payload, False, end, threading.Event())
+            else:
+                out = self._hedged(payload, end, hedge_after)
+        except Exception as e:
+            self._finish(t0, e)
+            raise
+        self._finish(t0, None)
+        return out
+
+    def _hedged(self, payload: dict, end: float, hedge_after: float) -> dict:
+        def submit():
+            cancel = threading.Event()
+            attempts[self._pool.submit(self._call, payload, False, end, cancel)] = cancel
+
+        attempts = {}
+        submit()
+        primary = next(iter(attempts))
+        done, _ = wait([primary], timeout=hedge_after)
+        if not done:
+            self._count("hedged")
+            submit()
+
+        pending, last = set(attempts), None
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=max(0.0, end - time.monotonic()),
+                                     return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                for f in done:
+                    exc = f.exception()
+                    if exc is None:
+                        if f is not primary:
+                            self._count("hedge_wins")
+                        return f.result()
+                    last = exc
+            raise last if last is not None else _deadline_error()
+        finally:
+            # ยกเลิกตัวที่แพ้/ค้าง: ปิด connection ทันทีที่มันเช็ค cancel
+            for ev in attempts.values():
+                ev.set()
+
+    def open_stream(self, payload: dict, deadline: float | None = None) -> _DeadlineStream:
+        """
+        Streaming ``chat/completions``; returns the ok response once headers arrive.
+        The deadline covers the whole call: its ``iter_lines`` raises
+        ``DeepSeekError`` (504) when the body is still running past it.
+        """
+        t0 = time.monotonic()
+        end = t0 + (deadline or self.deadline)
+        try:
+            r = self._call(payload, True, end, threading.Event())
+        except Exception as e:
+            self._finish(t0, e)
+            raise
+        with self._lock:
+            self.calls += 1
+        return _DeadlineStream(r, end, lambda: self._count("timeouts"))
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", (self.connect_timeout, self.read_timeout))
+        return self.session.get(f"{self.base}{path}", **kwargs)
+
+    def stats(self) -> dict:
+        with self._lock:
+            samples = sorted(self._latencies)
+            out = {
+                "calls": self.calls,
+                "retries": self.retries,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "timeouts": self.timeouts,
+                "errors": self.errors,
+                "pool_size": self.pool_size,
+                "deadline_s": self.deadline,
+            }
+        def pct(p):
+            return round(samples[int(p * (len(samples) - 1))], 3) if samples else None
+        out["latency_s"] = {"p50": pct(0.50), "p95": pct(0.95)}
+        out["hedge_after_s"] = self.hedge_delay()
+        return out
@@ -0,0 +1,158 @@
+# server/fake_deepseek.py
+"""
+Local stand-in for the DeepSeek chat API, for offline load tests.
+
+    python fake_deepseek.py --port 8100 --latency 3 --jitter 1 --error-rate 0.02
+
+then start the server with ``DEEPSEEK_BASE=http://127.0.0.1:8100``.
+Supports ``POST /chat/completions`` (``stream`` true/false, including
+``stream_options.include_usage``; ``response_format`` ``json_object`` answers
+with one text per fortune period) and ``GET /v1/models``.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LOREM = (
+    "1) ความรัก: มีคนเข้ามาให้กำลังใจ 2) การงาน: งานใหม่เข้ามา "
+    "3) การเงิน: วางแผนรายจ่าย 4) สุขภาพ: พักผ่อนให้พอ "
+).split(" ")
+
+
+class Settings:
+    latency = 2.0          # วินาทีจนได้คำตอบเต็ม (non-stream) / จนจบ stream
+    jitter = 0.5           # ± uniform
+    first_token = 0.4      # วินาทีจนได้ token แรก (stream)
+    tokens = 120
+    error_rate = 0.0       # สัดส่วนที่ตอบ 503
+    prefix_cache_ratio = 0.5
+    lock = threading.Lock()
+    requests = 0
+
+
+def _usage(prompt_chars: int, completion_tokens: int) -> dict:
+    prompt_tokens = max(1, prompt_chars // 3)
+    hit = int(prompt_tokens * Settings.prefix_cache_ratio)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_cache_hit_tokens": hit,
+        "prompt_cache_miss_tokens": prompt_tokens - hit,
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, status: int, body: dict):
+        raw = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_GET(self):
+        if self.path.rstrip("/") in ("/v1/models", "/models"):
+            return self._json(200, {"object": "list", "data": [{"id": "deepseek-chat", "object": "model"}]})
+        self._json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path.rstrip("/") not in ("/chat/completions", "/v1/chat/completions"):
+            return self._json(404, {"error": "not found"})
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self._json(400, {"error": {"message": "invalid json"}})
+        with Settings.lock:
+            Settings.requests += 1
+
+        if random.random() < Settings.error_rate:
+            time.sleep(random.uniform(0, Settings.first_token))
+            return self._json(503, {"error": {"message": "fake upstream overloaded"}})
+
+        total = max(0.0, Settings.latency + random.uniform(-Settings.jitter, Settings.jitter))
+        words = [random.choice(LOREM) for _ in range(Settings.tokens)]
+        prompt_chars = sum(len(str(m.get("content", ""))) for m in body.get("messages") or [])
+        model = body.get("model") or "deepseek-chat"
+        cid = "fake-" + uuid.uuid4().hex[:12]
+        usage = _usage(prompt_chars, len(words))
+
+        content = " ".join(words)
+        if (body.get("response_format") or {}).get("type") == "json_object":
+            content = json.dumps({p: content for p in ("today", "week", "month")}, ensure_ascii=False)
+
+        if not body.get("stream"):
+            time.sleep(total)
+            return self._json(200, {
+                "id": cid, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": content}}],
+                "usage": usage,
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send(obj):
+            data = ("data: " + (obj if isinstance(obj, str) else json.dumps(obj, ensure_ascii=False)) + "\n\n").encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        try:
+            time.sleep(min(Settings.first_token, total))
+            step = max(0.0, total - Settings.first_token) / max(1, len(words))
+            for i, w in enumerate(words):
+                send({"id": cid, "object": "chat.completion.chunk", "model": model,
+                      "choices": [{"index": 0, "delta": {"content": w + " "}, "finish_reason": None}]})
+                time.sleep(step)
+            send({"id": cid, "object": "chat.completion.chunk", "model": model,
+                  "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            if (body.get("stream_options") or {}).get("include_usage"):
+                send({"id": cid, "object": "chat.completion.chunk", "model": model, "choices": [], "usage": usage})
+            send("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def serve(host: str = "127.0.0.1", port: int = 8100):
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8100)
+    ap.add_argument("--latency", type=float, default=Settings.latency)
+    ap.add_argument("--jitter", type=float, default=Settings.jitter)
+    ap.add_argument("--first-token", type=float, default=Settings.first_token)
+    ap.add_argument("--tokens", type=int, default=Settings.tokens)
+    ap.add_argument("--error-rate", type=float, default=Settings.error_rate)
+    ap.add_argument("--prefix-cache-ratio", type=float, default=Settings.prefix_cache_ratio)
+    args = ap.parse_args()
+
+    Settings.latency, Settings.jitter = args.latency, args.jitter
+    Settings.first_token, Settings.tokens = args.first_token, args.tokens
+    Settings.error_rate, Settings.prefix_cache_ratio = args.error_rate, args.prefix_cache_ratio
+
+    srv = serve(args.host, args.port)
+    print(f"fake DeepSeek on http://{args.host}:{args.port} (latency={args.latency}s, errors={args.error_rate:.0%})")
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
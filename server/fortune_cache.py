@@ -0,0 +1,126 @@
+# server/fortune_cache.py
+"""
+Cache of generated fortunes so that asking again for the same scan, period,
+language and style within the same period does not call DeepSeek again.
+
+Two tiers:
+- local: in-process ``TTLCache`` (always on)
+- shared: Redis, when ``FORTUNE_CACHE_REDIS_URL`` is set and ``redis`` is installed
+"""
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+try:
+    from zoneinfo import ZoneInfo
+except Exception:  # pragma: no cover
+    ZoneInfo = None
+
+try:
+    import redis
+except Exception:
+    redis = None
+
+from ttl_cache import TTLCache
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TZ = os.getenv("FORTUNE_CACHE_DEFAULT_TZ", "Asia/Bangkok")
+
+
+def fortune_key(user_id: str, summary: dict, safe_profile: dict, model: str,
+                language: str, style: str, period: str) -> str:
+    """Canonical hash of everything that shapes the prompt for one fortune."""
+    canonical = json.dumps(
+        {
+            "user_id": user_id,
+            "summary": summary,
+            "profile": safe_profile,
+            "model": model,
+            "language": language,
+            "style": style,
+            "period": period,
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+        default=str,
+    )
+    return "fortune:" + hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _resolve_tz(name):
+    if ZoneInfo is None:
+        return None
+    for candidate in (name, DEFAULT_TZ):
+        if not candidate or not isinstance(candidate, str):
+            continue
+        try:
+            return ZoneInfo(candidate)
+        except Exception:
+            continue
+    return None
+
+
+def seconds_until_period_end(period: str, tz_name=None, now: datetime | None = None) -> float:
+    """
+    Seconds from ``now`` until the end of the current day / month in the
+    user's timezone, so a "today" fortune expires at local midnight. A "week"
+    fortune is written for "the next 7 days" and lives 7 days from ``now``.
+    """
+    tz = _resolve_tz(tz_name)
+    now = now or datetime.now(tz)
+    start_of_day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == "week":
+        end = now + timedelta(days=7)
+    elif period == "month":
+        if now.month == 12:
+            end = start_of_day.replace(year=now.year + 1, month=1, day=1)
+        else:
+            end = start_of_day.replace(month=now.month + 1, day=1)
+    else:
+        end = start_of_day + timedelta(days=1)
+    return max(0.0, (end - now).total_seconds())
+
+
+class FortuneCache:
+    def __init__(self, maxsize: int = 2048, redis_url: str | None = None):
+        self.local = TTLCache(maxsize=maxsize, ttl=24 * 3600)
+        self.shared = None
+        if redis_url and redis is not None:
+            try:
+                self.shared = redis.Redis.from_url(redis_url, socket_timeout=0.5)
+            except Exception as e:
+                log.warning("redis disabled: %s", e)
+
+    def get(self, key: str):
+        value = self.local.get(key)
+        if value is not None or self.shared is None:
+            return value
+        try:
+            raw = self.shared.get(key)
+            if raw is None:
+                return None
+            value = json.loads(raw)
+            ttl = self.shared.ttl(key)
+            if ttl and ttl > 0:
+                self.local.set(key, value, ttl=ttl)
+            return value
+        except Exception as e:
+            log.warning("shared get failed: %s", e)
+            return None
+
+    def set(self, key: str, value: dict, ttl: float):
+        if ttl <= 0:
+            return
+        self.local.set(key, value, ttl=ttl)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, json.dumps(value, ensure_ascii=False), ex=max(1, int(ttl)))
+            except Exception as e:
+                log.warning("shared set failed: %s", e)
+
+    def stats(self) -> dict:
+        return {**self.local.stats(), "shared": self.shared is not None}
@@ -0,0 +1,66 @@
+# server/known_users.py
+"""
+Remembers which ``users/{uid}`` documents are known to exist so that
+``_ensure_user_doc`` writes at most once per user per TTL. Later
+``updatedAt`` touches are collected and written in one periodic flush.
+"""
+import atexit
+import logging
+import threading
+
+from ttl_cache import TTLCache
+
+log = logging.getLogger(__name__)
+
+
+class KnownUsers:
+    def __init__(self, touch, ttl: float = 3600.0, maxsize: int = 10000,
+                 flush_interval: float = 60.0):
+        """``touch(user_id)`` writes ``updatedAt`` for one user (ideally via the write queue)."""
+        self._touch = touch
+        self.known = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.flush_interval = float(flush_interval)
+        self._touched: set[str] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.first_writes = 0
+        self.coalesced = 0
+        if self.flush_interval > 0:
+            threading.Thread(target=self._run, name="user-touch-flush", daemon=True).start()
+        atexit.register(self.flush)
+
+    def ensure(self, user_id: str) -> bool:
+        """Write the user doc if not known yet; otherwise defer the touch. True when a write was issued."""
+        if user_id in self.known:
+            with self._lock:
+                self._touched.add(user_id)
+                self.coalesced += 1
+            return False
+        self._touch(user_id)
+        self.known.set(user_id, True)
+        with self._lock:
+            self._touched.discard(user_id)
+            self.first_writes += 1
+        return True
+
+    def flush(self):
+        with self._lock:
+            touched, self._touched = self._touched, set()
+        for user_id in touched:
+            try:
+                self._touch(user_id)
+            except Exception as e:
+                log.warning("touch failed: %s", e, extra={"user_id": user_id})
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = {
+                "first_writes": self.first_writes,
+                "coalesced": self.coalesced,
+                "pending_touches": len(self._touched),
+            }
+        return {**self.known.stats(), **counts}
@@ -0,0 +1,254 @@
+# server/loadgen.py
+"""
+Load generator for the Flask API. Runs offline against the local stand-ins:
+
+    python fake_deepseek.py --port 8100 --latency 3
+    FIRESTORE_BACKEND=memory DEEPSEEK_BASE=http://127.0.0.1:8100 DEEPSEEK_API_KEY=test \\
+        ADMISSION_PER_USER=0 ANALYZE_WORKERS=2 FLASK_DEBUG=0 python serve_flask.py
+    python loadgen.py --duration 60 --concurrency 32 --image Hand.jpg
+
+Each worker thread picks an endpoint from ``--mix`` (weights), sends a
+realistic request for one of ``--users`` synthetic users and records latency.
+The report lists throughput, error counts and p50/p95/p99 per endpoint.
+``analyze``, ``analyze_predict`` and ``analyze_job`` need ``--image``.
+Without ID tokens every request counts as one caller (the loadgen host's IP)
+for ``ADMISSION_PER_USER``, so turn that limit off on the server under test.
+"""
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+DEFAULT_MIX = ("scan_save=3,scan_list=2,scan_stats=1,fortune=4,fortune_stream=1,fortune_multi=1,fortune_list=1,"
+               "chat=1,analyze=0,analyze_predict=0,analyze_job=0")
+IMAGE_SCENARIOS = ("analyze", "analyze_predict", "analyze_job")
+JOB_FINAL_STATES = ("done", "error", "timeout", "cancelled")
+
+SAMPLE_RESULT = {
+    "image_size": {"width": 1080, "height": 1440},
+    "roi_bbox_small": {"x": 120, "y": 260, "w": 520, "h": 610},
+    "lines": {
+        "life": {"length_px": 812.4, "thickness_px": 5.1, "branch_style": "curved"},
+        "head": {"length_px": 640.2, "thickness_px": 4.2, "branch_style": "straight"},
+        "heart": {"length_px": 701.9, "thickness_px": 4.7, "branch_style": "forked"},
+    },
+    # ขนาดใกล้เคียงผลจริงที่ client ส่งกลับมา
+    "roi_binary_png_b64": base64.b64encode(b"\0" * 60000).decode("ascii"),
+    "roi_skeleton_png_b64": base64.b64encode(b"\0" * 30000).decode("ascii"),
+}
+
+
+class Scenario:
+    def __init__(self, base: str, users: int, image: bytes | None, refresh_ratio: float):
+        self.base = base.rstrip("/")
+        self.users = [f"load-user-{i}" for i in range(users)]
+        self.image = image
+        self.refresh_ratio = refresh_ratio
+        self.scans: dict[str, list[str]] = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def _scan_for(self, user: str) -> str | None:
+        with self.lock:
+            scans = self.scans.get(user)
+            return random.choice(scans) if scans else None
+
+    def scan_save(self, s, user):
+        r = s.post(f"{self.base}/scan/save", json={
+            "user_id": user, "analyze_result": SAMPLE_RESULT, "meta": {"source": "loadgen"},
+        }, timeout=30)
+        if r.ok:
+            with self.lock:
+                self.scans[user].append(r.json()["id"])
+        return r
+
+    def scan_list(self, s, user):
+        return s.get(f"{self.base}/scan/list", params={"user_id": user, "limit": 20}, timeout=30)
+
+    def scan_stats(self, s, user):
+        return s.get(f"{self.base}/scan/stats", params={"user_id": user}, timeout=30)
+
+    def _fortune_body(self, user):
+        body = {
+            "user_id": user,
+            "period": random.choice(["today", "today", "week", "month"]),
+            "language": random.choice(["th", "th", "en"]),
+            "force_refresh": random.random() < self.refresh_ratio,
+        }
+        scan_id = self._scan_for(user)
+        if scan_id:
+            body["scan_id"] = scan_id
+        else:
+            body["summary"] = {k: SAMPLE_RESULT["lines"][k] for k in ("life", "head", "heart")}
+        return body
+
+    def fortune(self, s, user):
+        return s.post(f"{self.base}/fortune/predict", json=self._fortune_body(user), timeout=120)
+
+    def fortune_stream(self, s, user):
+        body = {**self._fortune_body(user), "stream": True}
+        r = s.post(f"{self.base}/fortune/predict", json=body, timeout=120, stream=True)
+        for _ in r.iter_lines(chunk_size=None):
+            pass
+        return r
+
+    def fortune_multi(self, s, user):
+        body = {**self._fortune_body(user), "periods": "all"}
+        return s.post(f"{self.base}/fortune/predict", json=body, timeout=120)
+
+    def fortune_list(self, s, user):
+        return s.get(f"{self.base}/fortune/list", params={"user_id": user, "limit": 20}, timeout=30)
+
+    def chat(self, s, user):
+        return s.post(f"{self.base}/ai/chat", json={
+            "user_id": user,
+            "messages": [{"role": "user", "content": "ดวงความรักสัปดาห์นี้เป็นอย่างไร"}],
+        }, timeout=120)
+
+    def analyze(self, s, user):
+        if not self.image:
+            return None
+        return s.post(f"{self.base}/analyze",
+                      files={"file": ("hand.jpg", self.image, "image/jpeg")},
+                      data={"user_id": user, "max_side": 900}, timeout=120)
+
+    def analyze_predict(self, s, user):
+        if not self.image:
+            return None
+        body = self._fortune_body(user)
+        body.pop("scan_id", None)
+        body.pop("summary", None)
+        r = s.post(f"{self.base}/scan/analyze-predict",
+                   files={"file": ("hand.jpg", self.image, "image/jpeg")},
+                   data={**body, "max_side": 900, "meta": json.dumps({"source": "loadgen"})}, timeout=120)
+        if r.ok:
+            with self.lock:
+                self.scans[user].append(r.json()["scan_id"])
+        return r
+
+    def analyze_job(self, s, user):
+        """Submit to /analyze/jobs and long-poll until the job is final; latency covers both."""
+        if not self.image:
+            return None
+        r = s.post(f"{self.base}/analyze/jobs",
+                   files={"file": ("hand.jpg", self.image, "image/jpeg")},
+                   data={"user_id": user, "max_side": 900}, timeout=30)
+        if r.status_code != 202:
+            return r
+        job_id = r.json()["job_id"]
+        deadline = time.monotonic() + 120
+        while time.monotonic() < deadline:
+            r = s.get(f"{self.base}/analyze/jobs/{job_id}", params={"wait": 20}, timeout=30)
+            if not r.ok or r.json().get("status") in JOB_FINAL_STATES:
+                break
+        return r
+
+
+def _parse_mix(spec: str) -> dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip():
+            mix[name.strip()] = float(weight or 1)
+    return {k: v for k, v in mix.items() if v > 0}
+
+
+def _pct(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def run(scenario: Scenario, mix: dict, duration: float, concurrency: int, warmup_saves: int = 0):
+    lat = defaultdict(list)
+    status = defaultdict(lambda: defaultdict(int))
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+    names, weights = zip(*mix.items())
+
+    with requests.Session() as s:
+        for user in scenario.users[:warmup_saves]:
+            scenario.scan_save(s, user)
+
+    def worker():
+        s = requests.Session()
+        while time.monotonic() < stop_at:
+            name = random.choices(names, weights)[0]
+            user = random.choice(scenario.users)
+            t0 = time.perf_counter()
+            try:
+                r = getattr(scenario, name)(s, user)
+                code = r.status_code if r is not None else "skipped"
+            except requests.RequestException as e:
+                code = e.__class__.__name__
+            ms = (time.perf_counter() - t0) * 1000
+            with lock:
+                if code != "skipped":
+                    lat[name].append(ms)
+                status[name][code] += 1
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    t_start = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - t_start
+
+    report = {}
+    for name in names:
+        v = lat.get(name, [])
+        report[name] = {
+            "requests": len(v),
+            "rps": round(len(v) / elapsed, 2),
+            "p50_ms": round(_pct(v, 0.50), 1),
+            "p95_ms": round(_pct(v, 0.95), 1),
+            "p99_ms": round(_pct(v, 0.99), 1),
+            "status": dict(status.get(name, {})),
+        }
+    total = sum(len(v) for v in lat.values())
+    report["_total"] = {"requests": total, "rps": round(total / elapsed, 2), "seconds": round(elapsed, 1)}
+    return report
+
+
+def _print_report(report: dict):
+    print(f"{'endpoint':<16}{'reqs':>8}{'rps':>9}{'p50':>10}{'p95':>10}{'p99':>10}  status")
+    for name, r in report.items():
+        if name.startswith("_"):
+            continue
+        print(f"{name:<16}{r['requests']:>8}{r['rps']:>9}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}  {r['status']}")
+    t = report["_total"]
+    print(f"{'total':<16}{t['requests']:>8}{t['rps']:>9}   in {t['seconds']}s")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--base", default="http://127.0.0.1:8000")
+    ap.add_argument("--duration", type=float, default=30)
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--users", type=int, default=50)
+    ap.add_argument("--mix", default=DEFAULT_MIX, help="endpoint=weight,... (" + DEFAULT_MIX + ")")
+    ap.add_argument("--image", help="hand photo for " + ", ".join(IMAGE_SCENARIOS))
+    ap.add_argument("--refresh-ratio", type=float, default=0.1, help="share of fortunes sent with force_refresh")
+    ap.add_argument("--warmup-saves", type=int, default=20, help="scans saved before the run so fortunes can use scan_id")
+    ap.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = ap.parse_args()
+
+    image = open(args.image, "rb").read() if args.image else None
+    mix = _parse_mix(args.mix)
+    for name in IMAGE_SCENARIOS:
+        if name in mix and image is None:
+            print(f"[loadgen] {name} in mix but no --image; skipping {name}")
+            mix.pop(name)
+
+    scenario = Scenario(args.base, args.users, image, args.refresh_ratio)
+    report = run(scenario, mix, args.duration, args.concurrency, args.warmup_saves)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        _print_report(report)
@@ -0,0 +1,253 @@
+# server/memory_firestore.py
+"""
+In-memory stand-in for the subset of the Firestore client used by serve_flask
+(collection/document refs, set/get/add, batches, order_by/limit/select/
+start_after queries). Select it with ``FIRESTORE_BACKEND=memory`` to run the
+server fully offline, e.g. for load tests. Not persistent, single process only.
+
+Transactions go through ``MemoryFirestore.run_transaction(fn)`` rather than
+``firestore.transactional``: reads record document versions and the commit
+retries ``fn`` when something it read has been written in the meantime.
+"""
+import copy
+import threading
+import uuid
+from datetime import datetime, timezone
+
+from firebase_admin import firestore
+from google.api_core import exceptions as gexc
+
+_LOCK = threading.RLock()
+
+
+def _resolve(value, old=None):
+    """Replace write sentinels (SERVER_TIMESTAMP, Increment) with concrete values."""
+    if value is firestore.SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+    if isinstance(value, firestore.Increment):
+        base = old if isinstance(old, (int, float)) else 0
+        return base + value.value
+    if isinstance(value, dict):
+        old = old if isinstance(old, dict) else {}
+        return {k: _resolve(v, old.get(k)) for k, v in value.items()}
+    return copy.deepcopy(value)
+
+
+def _merge(old: dict, new: dict) -> dict:
+    out = dict(old)
+    for k, v in new.items():
+        if isinstance(v, dict) and isinstance(out.get(k), dict):
+            out[k] = _merge(out[k], v)
+        else:
+            out[k] = v
+    return out
+
+
+def _get_path(data: dict, field: str):
+    cur = data
+    for part in field.split("."):
+        if not isinstance(cur, dict) or part not in cur:
+            return None
+        cur = cur[part]
+    return cur
+
+
+def _set_path(data: dict, field: str, value) -> None:
+    *parents, last = field.split(".")
+    for part in parents:
+        data = data.setdefault(part, {})
+    data[last] = value
+
+
+def _parent(path: str) -> str:
+    return path.rsplit("/", 1)[0]
+
+
+class DocumentSnapshot:
+    def __init__(self, ref, data):
+        self.reference = ref
+        self.id = ref.id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+
+class DocumentReference:
+    def __init__(self, client, path: str):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name: str):
+        return CollectionReference(self._client, f"{self.path}/{name}")
+
+    def set(self, data: dict, merge: bool = False):
+        with _LOCK:
+            old = self._client._docs.get(self.path)
+            value = _resolve(data, old if merge else None)
+            self._client._docs[self.path] = _merge(old or {}, value) if merge else value
+            self._client._bump(self.path)
+
+    def get(self, transaction=None):
+        with _LOCK:
+            if transaction is not None:
+                transaction._read(self.path)
+            return DocumentSnapshot(self, copy.deepcopy(self._client._docs.get(self.path)))
+
+
+class Query:
+    def __init__(self, col, orders=(), limit=None, fields=None, after=None):
+        self._col = col
+        self._orders = list(orders)
+        self._limit = limit
+        self._fields = fields
+        self._after = after
+
+    def _copy(self, **kw):
+        args = dict(orders=self._orders, limit=self._limit, fields=self._fields, after=self._after)
+        args.update(kw)
+        return Query(self._col, **args)
+
+    def order_by(self, field: str, direction: str = "ASCENDING"):
+        return self._copy(orders=self._orders + [(field, direction)])
+
+    def limit(self, n: int):
+        return self._copy(limit=n)
+
+    def select(self, fields):
+        return self._copy(fields=list(fields))
+
+    def start_after(self, cursor):
+        if isinstance(cursor, DocumentSnapshot):
+            cursor = {**(cursor.to_dict() or {}), "__name__": cursor.id}
+        return self._copy(after=cursor)
+
+    def _key(self, doc_id, data):
+        return tuple(doc_id if f == "__name__" else _get_path(data, f) for f, _ in self._orders)
+
+    def stream(self, transaction=None):
+        prefix = self._col.path + "/"
+        with _LOCK:
+            if transaction is not None:
+                transaction._read(self._col.path)
+            rows = [
+                (path[len(prefix):], copy.deepcopy(data))
+                for path, data in self._col._client._docs.items()
+                if path.startswith(prefix) and "/" not in path[len(prefix):]
+            ]
+        # เหมือน Firestore: เอกสารที่ไม่มี field ที่ order_by จะไม่ถูกคืน
+        rows = [r for r in rows if all(f == "__name__" or _get_path(r[1], f) is not None
+                                       for f, _ in self._orders)]
+        for field, direction in reversed(self._orders):
+            rows.sort(key=lambda r, f=field: r[0] if f == "__name__" else _get_path(r[1], f),
+                      reverse=(direction == "DESCENDING"))
+        if self._after is not None:
+            after = tuple(self._after.get(f) for f, _ in self._orders)
+
+            def is_after(row):
+                key = self._key(*row)
+                for (f, direction), a, b in zip(self._orders, key, after):
+                    if a == b:
+                        continue
+                    return a < b if direction == "DESCENDING" else a > b
+                return False
+            rows = [r for r in rows if is_after(r)]
+        if self._limit is not None:
+            rows = rows[: self._limit]
+        for doc_id, data in rows:
+            if self._fields is not None:
+                # เหมือน Firestore: field แบบ "a.b" คืนเป็น dict ซ้อน {"a": {"b": ...}}
+                picked = {}
+                for f in self._fields:
+                    value = _get_path(data, f)
+                    if value is not None:
+                        _set_path(picked, f, value)
+                data = picked
+            yield DocumentSnapshot(self._col.document(doc_id), data)
+
+
+class CollectionReference(Query):
+    def __init__(self, client, path: str):
+        self._client = client
+        self.path = path
+        super().__init__(self)
+
+    def document(self, doc_id: str | None = None):
+        return DocumentReference(self._client, f"{self.path}/{doc_id or uuid.uuid4().hex[:20]}")
+
+    def add(self, data: dict):
+        ref = self.document()
+        ref.set(data)
+        return datetime.now(timezone.utc), ref
+
+
+class WriteBatch:
+    def __init__(self):
+        self._ops = []
+
+    def set(self, ref, data, merge=False):
+        self._ops.append((ref, data, merge))
+
+    def commit(self):
+        with _LOCK:
+            for ref, data, merge in self._ops:
+                ref.set(data, merge=merge)
+        self._ops = []
+
+
+class Transaction(WriteBatch):
+    """
+    Optimistic transaction for ``MemoryFirestore.run_transaction``: remembers
+    the version of every document (and queried collection) it read and only
+    commits if none of them changed since.
+    """
+
+    def __init__(self, client):
+        super().__init__()
+        self._client = client
+        self._reads: dict[str, int] = {}
+
+    def _read(self, path: str):
+        self._reads.setdefault(path, self._client._versions.get(path, 0))
+
+    def get(self, ref_or_query):
+        if isinstance(ref_or_query, DocumentReference):
+            return iter([ref_or_query.get(transaction=self)])
+        return ref_or_query.stream(transaction=self)
+
+    def commit(self) -> bool:
+        with _LOCK:
+            versions = self._client._versions
+            if any(versions.get(p, 0) != v for p, v in self._reads.items()):
+                self._ops = []
+                return False
+            WriteBatch.commit(self)
+            return True
+
+
+class MemoryFirestore:
+    def __init__(self):
+        self._docs: dict[str, dict] = {}
+        # version ต่อ path ของเอกสารและ collection ที่อยู่ (ใช้ตรวจ conflict ของ transaction)
+        self._versions: dict[str, int] = {}
+
+    def _bump(self, path: str):
+        for p in (path, _parent(path)):
+            self._versions[p] = self._versions.get(p, 0) + 1
+
+    def collection(self, name: str):
+        return CollectionReference(self, name)
+
+    def batch(self):
+        return WriteBatch()
+
+    def run_transaction(self, fn, max_attempts: int = 5):
+        """``fn(transaction)`` then commit; re-run when a read was written concurrently."""
+        for _ in range(max_attempts):
+            transaction = Transaction(self)
+            result = fn(transaction)
+            if transaction.commit():
+                return result
+        raise gexc.Aborted("transaction contention: too many attempts")
@@ -0,0 +1,142 @@
+# server/prompts.py
+"""
+Prompt templates laid out for upstream prefix caching.
+
+DeepSeek caches prompt prefixes: tokens that repeat byte-for-byte from the
+start of an earlier request are billed as ``prompt_cache_hit_tokens`` and skip
+prefill. Each ``PromptTemplate`` therefore keeps all long, constant
+instructions in the system message (identical for every user, period and
+style) and puts the per-request data in a short user message at the end.
+Templates are checked once at import; ``render`` only fills the tail.
+
+``PromptCacheStats`` aggregates the cache hit/miss token counts DeepSeek
+reports in ``usage`` per template.
+"""
+import json
+import string
+import threading
+
+
+class PromptTemplate:
+    def __init__(self, name: str, system: str, tail: str):
+        self.name = name
+        self.system = system
+        self.tail = tail
+        # ตรวจ field ตอนสร้างครั้งเดียว
+        self.fields = frozenset(f for _, f, _, _ in string.Formatter().parse(tail) if f)
+        if "{" in system or "}" in system:
+            raise ValueError(f"{name}: system prefix must be static")
+
+    def render(self, **values) -> list[dict]:
+        missing = self.fields - values.keys()
+        if missing:
+            raise KeyError(f"{self.name}: missing {sorted(missing)}")
+        return [
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": self.tail.format(**values)},
+        ]
+
+
+def stable_json(value) -> str:
+    """Deterministic JSON for prompt data (same data => same bytes)."""
+    return json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(", ", ": "), default=str)
+
+
+# ---------- fortune ----------
+_FORTUNE_SYSTEM_TH = (
+    "คุณคือผู้ช่วยโหราศาสตร์ลายมือ เชี่ยวชาญการอ่านเส้นชีวิต/เส้นสมอง/เส้นหัวใจ "
+    "ตอบอย่างระมัดระวัง ไม่อ้างอิงเรื่องรักษาโรคหรือการเงินแบบชี้นำลงทุน "
+    "ให้คำแนะนำเชิงบวก นำไปใช้ได้จริง และเคารพความเป็นส่วนตัวของผู้ใช้\n\n"
+    "ผู้ใช้จะส่งข้อมูลภาพรวมเส้นลายมือ (life/head/heart: length_px, branch_style) ขนาดภาพ roi "
+    "ข้อมูลโปรไฟล์ (ถ้ามี) กรอบเวลา และโทนที่ต้องการ ให้ทำนายจากข้อมูลนั้น\n"
+    "รูปแบบคำตอบเป็นหัวข้อย่อย 4 หมวด และสั้นกระชับใช้งานได้จริง:\n"
+    "1) ความรัก\n2) การงาน\n3) การเงิน\n4) สุขภาพ\n\n"
+    "เพิ่ม: คำแนะนำปฏิบัติ 3-5 ข้อ และข้อควรระวัง 1-2 ข้อ\n"
+    "โทน: friendly = เป็นกันเอง, formal = เป็นทางการ\n"
+    "ห้ามกล่าวอ้างการรักษาโรคหรือรับประกันผลลัพธ์ ทางการแพทย์/การเงิน และให้กำลังใจอย่างเหมาะสม\n\n"
+    "ถ้าผู้ใช้ขอหลายกรอบเวลา ให้ตอบเป็น JSON object เท่านั้น โดยมี key เป็นชื่อกรอบเวลา "
+    "(today/week/month) และแต่ละค่าเป็นข้อความคำทำนายเต็มตามรูปแบบข้างต้น"
+)
+
+_FORTUNE_SYSTEM_EN = (
+    "You are a palmistry assistant who reads life/head/heart lines carefully, "
+    "avoids medical or investment directives, and gives practical, positive, privacy-respecting guidance.\n\n"
+    "The user sends a palm line summary (life/head/heart: length_px, branch_style), the image size and roi, "
+    "profile context (if any), a time frame and a tone. Read the palm from that data.\n"
+    "Return concise, actionable sections:\n"
+    "1) Love\n2) Career\n3) Finance\n4) Health\n\n"
+    "Also include: 3-5 practical tips and 1-2 caveats.\n"
+    "Tone: friendly = warm and casual, formal = formal.\n"
+    "Avoid medical or investment guarantees. Be supportive and realistic.\n\n"
+    "If several time frames are requested, reply with a JSON object only, keyed by time frame "
+    "(today/week/month), each value being the full reading text in the format above."
+)
+
+_FORTUNE_DATA_TH = (
+    "ข้อมูลลายมือ:\n- {life}\n- {head}\n- {heart}\n"
+    "ขนาดภาพ: {image_w}x{image_h}, roi={roi}\n"
+    "ข้อมูลผู้ใช้ (ถ้ามี): {profile}\n"
+    "โทน: {style}\n"
+)
+
+_FORTUNE_DATA_EN = (
+    "Palm summary:\n- {life}\n- {head}\n- {heart}\n"
+    "image: {image_w}x{image_h}, roi={roi}\n"
+    "user profile (if any): {profile}\n"
+    "Tone: {style}\n"
+)
+
+FORTUNE = {
+    "th": PromptTemplate("fortune", _FORTUNE_SYSTEM_TH, _FORTUNE_DATA_TH + "กรอบเวลา: {period_text}"),
+    "en": PromptTemplate("fortune", _FORTUNE_SYSTEM_EN, _FORTUNE_DATA_EN + "Time frame: {period_text}"),
+}
+
+FORTUNE_MULTI = {
+    "th": PromptTemplate("fortune_multi", _FORTUNE_SYSTEM_TH,
+                         _FORTUNE_DATA_TH + "กรอบเวลา (ตอบเป็น JSON):\n{frames}"),
+    "en": PromptTemplate("fortune_multi", _FORTUNE_SYSTEM_EN,
+                         _FORTUNE_DATA_EN + "Time frames (reply as JSON):\n{frames}"),
+}
+
+
+def fortune_values(summary: dict, safe_profile: dict, style: str) -> dict:
+    def line_desc(name):
+        d = (summary.get(name) or {})
+        return f"{name}: length_px={d.get('length_px')}, branch_style={d.get('branch_style')}"
+
+    return {
+        "life": line_desc("life"),
+        "head": line_desc("head"),
+        "heart": line_desc("heart"),
+        "image_w": summary.get("image_w"),
+        "image_h": summary.get("image_h"),
+        "roi": stable_json(summary.get("roi")),
+        "profile": stable_json(safe_profile or {}),
+        "style": "friendly" if style == "friendly" else "formal",
+    }
+
+
+# ---------- usage metrics ----------
+class PromptCacheStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_name: dict[str, dict] = {}
+
+    def record(self, name: str, usage: dict | None):
+        if not usage:
+            return
+        with self._lock:
+            s = self._by_name.setdefault(name, {"calls": 0, "prompt_tokens": 0,
+                                                "cache_hit_tokens": 0, "cache_miss_tokens": 0})
+            s["calls"] += 1
+            s["prompt_tokens"] += int(usage.get("prompt_tokens") or 0)
+            s["cache_hit_tokens"] += int(usage.get("prompt_cache_hit_tokens") or 0)
+            s["cache_miss_tokens"] += int(usage.get("prompt_cache_miss_tokens") or 0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = {}
+            for name, s in self._by_name.items():
+                seen = s["cache_hit_tokens"] + s["cache_miss_tokens"]
+                out[name] = {**s, "hit_rate": round(s["cache_hit_tokens"] / seen, 3) if seen else None}
+            return out
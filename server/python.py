@@ -1,4 +1,4 @@
-import os, io, json, base64, math, heapq, collections, pathlib
+import os, io, json, base64, math, heapq, collections, pathlib, hashlib, threading
 from dataclasses import dataclass
 from typing import List, Tuple, Dict, Any, Optional
 
@@ -21,6 +21,7 @@ BLACKHAT_K_DEFAULT = 15
 OPEN_ITR_DEFAULT, CLOSE_ITR_DEFAULT = 1, 2
 MIN_COMPONENT_PIXELS_DEFAULT = 1           # เดิม 60 -> ให้เห็นเส้นเล็กๆ ตามที่ใช้งาน
 PRUNE_SPUR_ITER_DEFAULT = 3                # เดิม 8 -> ตามค่าที่คุณรันบ่อย
+OVERLAY_PREVIEW_SIDE = int(os.getenv("OVERLAY_PREVIEW_SIDE", "640"))   # ด้านยาวสุดของภาพ overlay (0 = ขนาดเต็ม)
 
 # ---- OpenCV constants (safe/fallback) ----
 ADAPTIVE_GAUSS = getattr(cv2, "ADAPTIVE_THRESH_GAUSSIAN_C", 1)
@@ -55,6 +56,10 @@ class PipeConfig:
     show_hand: bool = True
     hand_refine: str = "grabcut"           # "none"|"morph"|"skin"|"grabcut"
     hand_alpha: float = 0.5                # เดิม 0.35 -> 0.5
+    # output
+    polyline_tolerance: float = 1.5        # Douglas–Peucker epsilon (px ภาพเต็ม), 0 = ไม่ simplify
+    polyline_delta: bool = False           # polyline เป็น [x0,y0,dx1,dy1,...] แทน [x0,y0,x1,y1,...]
+    include_masks: bool = True             # False = ไม่ส่ง roi_*_png_b64 / roi_binary_rle
 
 # ================= Utils =================
 def _np_from_path(path: str) -> np.ndarray:
@@ -100,6 +105,31 @@ def _binary_to_rle(binary: np.ndarray) -> Dict[str, Any]:
     return {"height": int(h), "width": int(w), "start": 1 if int(flat[0])>0 else 0, "counts": counts}
 
 # ================= Hand ROI / Landmarks =================
+# detector ที่สร้างค้างไว้ (warm) สำหรับ worker process ที่รันงานทีละชิ้น; None = สร้างใหม่ทุกครั้ง
+_HANDS = None
+
+def warm_detectors() -> bool:
+    """
+    สร้าง mediapipe Hands ค้างไว้ให้ detect_landmarks ใช้ซ้ำ (ไม่ต้องโหลดโมเดลทุกภาพ)
+    ใช้ใน process ที่ประมวลผลทีละภาพเท่านั้น เพราะ Hands ไม่ thread-safe
+    """
+    global _HANDS
+    if _HANDS is not None:
+        return True
+    try:
+        import mediapipe as mp
+        _HANDS = mp.solutions.hands.Hands(
+            static_image_mode=True,
+            max_num_hands=1,
+            model_complexity=0,
+            min_detection_confidence=0.5,
+            min_tracking_confidence=0.5
+        )
+        return True
+    except Exception:
+        _HANDS = None
+        return False
+
 def detect_landmarks(img_bgr):
     """
     คืนพิกัดแลนด์มาร์คมือเป็น list[(x, y)] ถ้าหาไม่เจอหรือ mediapipe มีปัญหา -> คืน None
@@ -121,14 +151,17 @@ def detect_landmarks(img_bgr):
         return None
 
     try:
-        with mp.solutions.hands.Hands(
-            static_image_mode=True,
-            max_num_hands=1,
-            model_complexity=0,            # เร็วขึ้น
-            min_detection_confidence=0.5,
-            min_tracking_confidence=0.5
-        ) as hands:
-            res = hands.process(rgb)
+        if _HANDS is not None:
+            res = _HANDS.process(rgb)
+        else:
+            with mp.solutions.hands.Hands(
+                static_image_mode=True,
+                max_num_hands=1,
+                model_complexity=0,            # เร็วขึ้น
+                min_detection_confidence=0.5,
+                min_tracking_confidence=0.5
+            ) as hands:
+                res = hands.process(rgb)
 
         if not res or not getattr(res, "multi_hand_landmarks", None):
             return None
@@ -179,17 +212,55 @@ def refine_mask_grabcut(img_bgr: np.ndarray, coarse_mask: np.ndarray) -> np.ndar
         m = coarse_mask.copy()
     return refine_mask_morph(m)
 
-def overlay_region(full_bgr: np.ndarray, mask: np.ndarray,
-                   fill_color=(0,255,255), edge_color=(0,128,255),
-                   alpha_fill=0.35, edge_thick=3) -> np.ndarray:
-    out = full_bgr.copy()
-    if out.ndim==2: out = cv2.cvtColor(out, cv2.COLOR_GRAY2BGR)
-    fill = np.zeros_like(out); fill[:] = fill_color
-    out = np.where(mask[...,None]>0,
-                   (alpha_fill*fill + (1-alpha_fill)*out).astype(np.uint8),
-                   out)
-    cnts,_ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    cv2.drawContours(out, cnts, -1, edge_color, edge_thick, cv2.LINE_AA)
+def _blend_mask_inplace(img: np.ndarray, mask: np.ndarray, color, alpha: float,
+                        edge_color=None, edge_thick: int = 0) -> None:
+    """ผสมสีแบบ cv2.addWeighted ลงใน img เฉพาะในกรอบ bbox ของ mask (แก้ img ตรงๆ)"""
+    x,y,w,h = cv2.boundingRect(mask)
+    if w == 0 or h == 0:
+        return
+    roi, m = img[y:y+h, x:x+w], mask[y:y+h, x:x+w]
+    a = min(max(alpha, 0.0), 1.0)
+    tint = cv2.addWeighted(roi, 1.0 - a, np.full_like(roi, color), a, 0.0)
+    np.copyto(roi, tint, where=(m > 0)[..., None])
+    if edge_color is not None and edge_thick > 0:
+        cnts,_ = cv2.findContours(m, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x, y))
+        cv2.drawContours(img, cnts, -1, edge_color, edge_thick, cv2.LINE_AA)
+
+def _preview(img: np.ndarray, preview_side: int) -> Tuple[np.ndarray, float]:
+    """(สำเนา BGR ขนาด preview, scale) — ย่อก่อนวาด overlay จะได้ไม่ต้องทำทั้งภาพเต็ม"""
+    h, w = img.shape[:2]
+    s = preview_side / max(h, w) if preview_side and max(h, w) > preview_side else 1.0
+    out = cv2.resize(img, (max(1, round(w*s)), max(1, round(h*s))), interpolation=cv2.INTER_LINEAR) if s < 1.0 else img.copy()
+    if out.ndim == 2:
+        out = cv2.cvtColor(out, cv2.COLOR_GRAY2BGR)
+    return out, s
+
+def _scale_mask(mask: np.ndarray, size: Tuple[int,int], thin: bool = False) -> np.ndarray:
+    if mask.shape[1] == size[0] and mask.shape[0] == size[1]:
+        return mask
+    if not thin:
+        return cv2.resize(mask, size, interpolation=cv2.INTER_NEAREST)
+    # เส้น skeleton บางๆ: INTER_AREA แล้ว >0 เพื่อไม่ให้เส้นหายตอนย่อ
+    return (cv2.resize(mask, size, interpolation=cv2.INTER_AREA) > 0).astype(np.uint8) * 255
+
+def render_overlay(located: Dict[str,Any], hand: Optional[np.ndarray] = None,
+                   skel: Optional[np.ndarray] = None, hand_alpha: float = 0.5,
+                   preview_side: int = OVERLAY_PREVIEW_SIDE) -> np.ndarray:
+    """
+    Overlay on the working image, built only when asked for: the whole-hand
+    mask tinted (``hand``) and/or the ROI skeleton in green (``skel``).
+    Drawn at ``preview_side`` and only inside the mask / ROI box.
+    """
+    out, s = _preview(located["small"], preview_side)
+    if hand is not None:
+        hmask = _scale_mask(hand, (out.shape[1], out.shape[0]))
+        _blend_mask_inplace(out, hmask, (0,255,255), hand_alpha, (0,128,255), max(1, round(3 * s)))
+    if skel is not None:
+        x,y,w,h = located["bbox"]
+        x0, y0 = int(x*s), int(y*s)
+        x1, y1 = min(out.shape[1], max(x0+1, round((x+w)*s))), min(out.shape[0], max(y0+1, round((y+h)*s)))
+        green = out[y0:y1, x0:x1, 1]
+        np.maximum(green, _scale_mask(skel, (x1-x0, y1-y0), thin=True), out=green)
     return out
 
 def contour_features(mask: np.ndarray):
@@ -386,70 +457,203 @@ def branch_points_on_path(path: List[Tuple[int,int]], skel: np.ndarray) -> int:
     return int(cnt)
 
 # ================= CORE =================
-def analyze(img_bgr: np.ndarray, outdir="debug_out", Cfg: PipeConfig = PipeConfig()) -> Dict[str,Any]:
-    if img_bgr is None or img_bgr.size == 0:
-        return {"error": "Invalid image."}
-
+# ================= Hand location & fingerprint =================
+def locate_hand(img_bgr: np.ndarray, Cfg: PipeConfig = PipeConfig()) -> Optional[Dict[str,Any]]:
+    """Resize + landmarks + ROI box (ขั้นแรกของ analyze); None ถ้าไม่เจอมือ"""
     small, inv_scale = _resize_keep_ratio(img_bgr, Cfg.max_side)
-
     land = detect_landmarks(small)
     if land is None:
-        return {"error":"Hand not detected."}
-
-    # ROI robust
+        return None
     mask_full = hand_mask_from_landmarks(small, land)
-    x,y,w,h = cv2.boundingRect(mask_full)
-    gray_full = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    return {"small": small, "inv_scale": inv_scale, "land": land, "image_size": img_bgr.shape[:2],
+            "mask_full": mask_full, "bbox": cv2.boundingRect(mask_full)}
 
+def scan_fingerprint(located: Dict[str,Any]) -> Dict[str,Any]:
+    """
+    Perceptual fingerprint of a located hand: 64-bit dHash of the ROI crop
+    (grayscale, 9x8) + landmarks normalized to the ROI box. รูปมือเดิมที่ถ่ายซ้ำ
+    ต่างกันเล็กน้อยจะได้ hash ที่ Hamming distance ต่ำ
+    """
+    x,y,w,h = located["bbox"]
+    small = located["small"]
+    gray = small if small.ndim == 2 else cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    tiny = cv2.resize(gray[y:y+h, x:x+w], (9, 8), interpolation=cv2.INTER_AREA)
+    bits = np.packbits((tiny[:, 1:] > tiny[:, :-1]).flatten())
+    land = [(round((px-x)/max(w,1), 4), round((py-y)/max(h,1), 4)) for (px,py) in located["land"]]
+    return {"roi_dhash": bits.tobytes().hex(), "landmarks": land}
+
+# ================= Stage graph (incremental re-analysis) =================
+# stage -> (stage ที่ใช้เป็น input, field ของ PipeConfig ที่ stage นั้นใช้)
+# key ของแต่ละ stage มาจาก image_key + field ของตัวเอง + key ของ input
+# เปลี่ยนค่าปลายทาง (เช่น prune_spur_iter) จะคำนวณใหม่เฉพาะ stage ที่ได้รับผล
+STAGES = {
+    "locate":     ((), ("max_side",)),
+    "roi":        (("locate",), ()),
+    "hand":       (("locate",), ("show_hand", "hand_refine")),
+    "enhance":    (("roi",), ("strong_enhance", "clahe_clip")),
+    "binary":     (("enhance",), ("detail_binary", "block_size", "C", "close_itr", "open_itr",
+                                  "use_frangi", "frangi_sigmas", "frangi_thresh")),
+    "skeleton":   (("binary",), ("rect_skeleton_kernel",)),
+    "components": (("skeleton",), ("min_component_pixels",)),
+    "prune":      (("components",), ("prune_spur_iter",)),
+    "paths":      (("locate", "prune"), ()),
+    "lines":      (("locate", "enhance", "binary", "prune", "paths"), ()),
+}
+
+_MISSING = object()
+
+def _nbytes(value) -> int:
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return 64 + sum(_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return 64 + sum(_nbytes(v) for v in value)
+    return 64
+
+class StageCache:
+    """Thread-safe LRU of stage outputs, bounded by total array bytes."""
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = int(max_bytes)
+        self._data: "collections.OrderedDict[str, tuple[int, Any]]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: str, value):
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old:
+                self.bytes -= old[0]
+            self._data[key] = (size, value)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (n, _) = self._data.popitem(last=False)
+                self.bytes -= n
+
+    def stats(self) -> Dict[str,Any]:
+        total = self.hits + self.misses
+        return {"entries": len(self._data), "mb": round(self.bytes / 2**20, 1),
+                "max_mb": round(self.max_bytes / 2**20, 1), "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0}
+
+def compute_image_key(img_bgr: np.ndarray) -> str:
+    h = hashlib.blake2b(repr(img_bgr.shape).encode(), digest_size=16)
+    h.update(np.ascontiguousarray(img_bgr).data)
+    return h.hexdigest()
+
+class _StageRun:
+    def __init__(self, Cfg: PipeConfig, image_key: str, cache: Optional[StageCache],
+                 img_bgr: Optional[np.ndarray] = None, located: Optional[Dict[str,Any]] = None,
+                 refresh: bool = False):
+        self.Cfg, self.image_key, self.cache, self.img = Cfg, image_key, cache, img_bgr
+        # refresh: คำนวณทุก stage ใหม่ (ไม่อ่านจาก cache) แต่ยังเก็บผลลง cache
+        self.refresh = refresh
+        self.values: Dict[str,Any] = {}
+        self.keys: Dict[str,str] = {}
+        self.recomputed: List[str] = []
+        if cache is not None and img_bgr is not None and (refresh or cache.get("image:" + image_key) is None):
+            cache.set("image:" + image_key, img_bgr)
+        if located is not None:
+            self.values["locate"] = located
+            if cache is not None:
+                cache.set(self.key("locate"), located)
+
+    def image(self) -> np.ndarray:
+        if self.img is None and self.cache is not None:
+            self.img = self.cache.get("image:" + self.image_key)
+        if self.img is None:
+            raise KeyError(self.image_key)
+        return self.img
+
+    def key(self, stage: str) -> str:
+        if stage not in self.keys:
+            parents, fields = STAGES[stage]
+            h = hashlib.blake2b(f"{stage}|{self.image_key}".encode(), digest_size=16)
+            for f in fields:
+                h.update(repr((f, getattr(self.Cfg, f))).encode())
+            for parent in parents:
+                h.update(self.key(parent).encode())
+            self.keys[stage] = h.hexdigest()
+        return self.keys[stage]
+
+    def __getitem__(self, stage: str):
+        if stage not in self.values:
+            key = self.key(stage)
+            value = self.cache.get(key, _MISSING) if self.cache is not None and not self.refresh else _MISSING
+            if value is _MISSING:
+                value = _STAGE_FUNCS[stage](self)
+                self.recomputed.append(stage)
+                if self.cache is not None:
+                    self.cache.set(key, value)
+            self.values[stage] = value
+        return self.values[stage]
+
+def _stage_roi(run: _StageRun) -> np.ndarray:
+    loc = run["locate"]
+    x,y,w,h = loc["bbox"]
+    gray_full = cv2.cvtColor(loc["small"], cv2.COLOR_BGR2GRAY)
     gray_roi = gray_full[y:y+h, x:x+w].copy()
-    roi_mask = mask_full[y:y+h, x:x+w]
+    roi_mask = loc["mask_full"][y:y+h, x:x+w]
     if cv2.countNonZero(roi_mask) < (roi_mask.size // 10):
         roi_mask = cv2.bitwise_not(roi_mask)
-    gray_roi = cv2.bitwise_and(gray_roi, gray_roi, mask=roi_mask)
+    return cv2.bitwise_and(gray_roi, gray_roi, mask=roi_mask)
 
-    # ===== Hand (whole-hand) segmentation & overlay =====
+def _stage_hand(run: _StageRun):
+    """(hand mask, hand json) หรือ None ถ้า show_hand=False"""
+    Cfg = run.Cfg
+    if not Cfg.show_hand:
+        return None
+    loc = run["locate"]
+    small, coarse = loc["small"], loc["mask_full"].copy()
+    if Cfg.hand_refine == "none":
+        hand = refine_mask_morph(coarse)
+    elif Cfg.hand_refine == "morph":
+        hand = refine_mask_morph(coarse)
+    elif Cfg.hand_refine == "skin":
+        hand = refine_mask_skin(small, coarse)
+    else:
+        hand = refine_mask_grabcut(small, coarse)
+    feats = contour_features(hand)
     hand_json = None
-    if Cfg.show_hand:
-        coarse = mask_full.copy()
-        if Cfg.hand_refine == "none":
-            hand = refine_mask_morph(coarse)
-        elif Cfg.hand_refine == "morph":
-            hand = refine_mask_morph(coarse)
-        elif Cfg.hand_refine == "skin":
-            hand = refine_mask_skin(small, coarse)
-        else:
-            hand = refine_mask_grabcut(small, coarse)
-        hand_overlay = overlay_region(small, hand,
-                                      fill_color=(0,255,255),
-                                      edge_color=(0,128,255),
-                                      alpha_fill=float(Cfg.hand_alpha),
-                                      edge_thick=3)
-        os.makedirs(outdir, exist_ok=True)
-        cv2.imwrite(os.path.join(outdir, "hand_mask.png"), hand)
-        cv2.imwrite(os.path.join(outdir, "hand_overlay.png"), hand_overlay)
-        feats = contour_features(hand)
-        if feats:
-            hand_json = {
-                "area_px": feats["area_px"],
-                "perimeter_px": feats["perimeter_px"],
-                "bbox_small": feats["bbox"],
-                "polygon_small": feats["polygon_px"]
-            }
-
-    # ===== Pipeline: enhance → binary → skeleton =====
-    enh = enhance(gray_roi, Cfg)
-    binary = to_binary(enh, Cfg)
-    skel = skeletonize_morph(binary, Cfg)
-    skel = remove_small_components(skel, Cfg.min_component_pixels)
-    skel = prune_spurs(skel, Cfg.prune_spur_iter)
-
-    # ===== Zones บน ROI =====
-    masks = zone_masks_on_roi(w, h)
+    if feats:
+        hand_json = {
+            "area_px": feats["area_px"],
+            "perimeter_px": feats["perimeter_px"],
+            "bbox_small": feats["bbox"],
+            "polygon_small": feats["polygon_px"]
+        }
+    return hand, hand_json
+
+def _stage_paths(run: _StageRun) -> Dict[str,List[Tuple[int,int]]]:
+    """เส้นทางยาวสุดของแต่ละ zone (พิกัด ROI)"""
+    _, _, w, h = run["locate"]["bbox"]
+    skel = run["prune"]
+    return {name: longest_path_in_zone(skel, z) for name, z in zone_masks_on_roi(w, h).items()}
+
+def _stage_lines(run: _StageRun) -> Dict[str,Any]:
+    loc = run["locate"]
+    x,y,w,h = loc["bbox"]
+    inv_scale = loc["inv_scale"]
+    enh, binary, skel = run["enhance"], run["binary"], run["prune"]
 
     # ===== Metrics ต่อเส้น =====
     lines={}
-    for name, z in masks.items():
-        path = longest_path_in_zone(skel, z)
+    for name, path in run["paths"].items():
         length_px = path_length(path) * inv_scale
         start_end=None
         if len(path)>=2:
@@ -469,42 +673,130 @@ def analyze(img_bgr: np.ndarray, outdir="debug_out", Cfg: PipeConfig = PipeConfi
             "branch_points": branch,
             "branch_style": style
         }
+    return lines
+
+_STAGE_FUNCS = {
+    "locate":     lambda run: locate_hand(run.image(), run.Cfg),
+    "roi":        _stage_roi,
+    "hand":       _stage_hand,
+    "enhance":    lambda run: enhance(run["roi"], run.Cfg),
+    "binary":     lambda run: to_binary(run["enhance"], run.Cfg),
+    "skeleton":   lambda run: skeletonize_morph(run["binary"], run.Cfg),
+    "components": lambda run: remove_small_components(run["skeleton"], run.Cfg.min_component_pixels),
+    "prune":      lambda run: prune_spurs(run["components"], run.Cfg.prune_spur_iter),
+    "paths":      _stage_paths,
+    "lines":      _stage_lines,
+}
+
+def simplify_polyline(path: List[Tuple[int,int]], offset: Tuple[int,int], scale: float,
+                      tolerance: float, delta: bool = False) -> List[int]:
+    """
+    ROI path -> flat full-image polyline [x0,y0,x1,y1,...] simplified with
+    Douglas–Peucker (``tolerance`` px). ``delta=True`` keeps the first point and
+    stores the rest as differences [x0,y0,dx1,dy1,...] (ตัวเลขสั้นลงใน JSON)
+    """
+    if len(path) < 2:
+        return []
+    pts = (np.asarray(path, np.float32) + np.asarray(offset, np.float32)) * float(scale)
+    if tolerance > 0:
+        pts = cv2.approxPolyDP(pts.reshape(-1, 1, 2), float(tolerance), False).reshape(-1, 2)
+    pts = pts.astype(np.int64)   # ปัดแบบเดียวกับ start_end_px
+    if delta:
+        pts[1:] = np.diff(pts, axis=0)
+    return pts.flatten().tolist()
+
+def locate_hand_cached(img_bgr: np.ndarray, Cfg: PipeConfig = PipeConfig(),
+                       cache: Optional[StageCache] = None, image_key: Optional[str] = None,
+                       refresh: bool = False):
+    """locate_hand ผ่าน stage cache (ถ้ามี) เพื่อให้ analyze ครั้งต่อไปใช้ผลเดียวกัน"""
+    if cache is None:
+        return locate_hand(img_bgr, Cfg)
+    return _StageRun(Cfg, image_key or compute_image_key(img_bgr), cache, img_bgr, refresh=refresh)["locate"]
+
+def analyze(img_bgr: Optional[np.ndarray], outdir: Optional[str] = None, Cfg: PipeConfig = PipeConfig(),
+            located: Optional[Dict[str,Any]] = None, cache: Optional[StageCache] = None,
+            image_key: Optional[str] = None, overlay: bool = False,
+            arrays: Optional[Dict[str,np.ndarray]] = None, refresh: bool = False) -> Dict[str,Any]:
+    """
+    Full pipeline. With ``cache`` every stage output is cached (see ``STAGES``);
+    the result then carries ``image_key`` so the same image can be re-analyzed
+    with other settings by passing ``img_bgr=None, image_key=...``.
+    ``refresh=True`` recomputes every stage instead of reading the cache (the
+    new outputs still replace the cached ones).
+
+    Debug images (roi_*, hand_*, overlay_full) are written only when ``outdir``
+    is given; ``overlay=True`` adds a preview ``overlay_png_b64`` to the result.
+    A dict passed as ``arrays`` receives the raw ``roi_binary`` / ``roi_skeleton``
+    masks (uint8) for callers that move them without encoding.
+    """
+    if img_bgr is None and (cache is None or image_key is None):
+        return {"error": "Invalid image."}
+    if img_bgr is not None:
+        if img_bgr.size == 0:
+            return {"error": "Invalid image."}
+        if cache is not None:
+            image_key = image_key or compute_image_key(img_bgr)
+
+    # located: ผลของ locate_hand ที่คำนวณไว้แล้ว (เช่นตอนเช็ค scan ซ้ำ)
+    run = _StageRun(Cfg, image_key, cache, img_bgr, located, refresh=refresh)
+    try:
+        located = run["locate"]
+    except KeyError:
+        return {"error": "Unknown or expired image_key."}
+    if located is None:
+        return {"error":"Hand not detected."}
+    small, inv_scale, land = located["small"], located["inv_scale"], located["land"]
+    x,y,w,h = located["bbox"]
+
+    # ===== Hand (whole-hand) segmentation =====
+    hand, hand_json = run["hand"] or (None, None)
+
+    # ===== Pipeline: enhance → binary → skeleton → zones/metrics =====
+    enh = run["enhance"]
+    binary = run["binary"]
+    skel = run["prune"]
+    paths = run["paths"]
+    lines = {
+        name: {**d, "polyline": simplify_polyline(paths[name], (x, y), inv_scale,
+                                                  Cfg.polyline_tolerance, Cfg.polyline_delta)}
+        for name, d in run["lines"].items()
+    }
 
-    # ===== Debug outputs =====
-    os.makedirs(outdir, exist_ok=True)
-    cv2.imwrite(os.path.join(outdir,"roi_enh.png"), enh)
-    cv2.imwrite(os.path.join(outdir,"roi_binary.png"), binary)
-    cv2.imwrite(os.path.join(outdir,"roi_skeleton.png"), skel)
-
-    # overlay เขียวบน full image (กันเคสภาพเป็น gray)
-    overlay = small.copy()
-    if overlay.ndim == 2:
-        overlay = cv2.cvtColor(overlay, cv2.COLOR_GRAY2BGR)
-    roi_green = overlay[y:y+h, x:x+w].copy()
-    ch1 = 1  # ใช้ช่องสีเขียว
-    roi_green[..., ch1] = np.maximum(
-        roi_green[..., ch1],
-        (skel>0).astype(np.uint8)*255
-    )
-    overlay[y:y+h, x:x+w] = roi_green
-    cv2.imwrite(os.path.join(outdir,"overlay_full.png"), overlay)
-
-    # base64 + RLE
-    roi_binary_png_b64 = _png_b64(binary)
-    roi_skeleton_png_b64 = _png_b64(skel)
-    roi_binary_rle = _binary_to_rle(binary)
+    # ===== Debug outputs (เฉพาะตอนขอ outdir) =====
+    if outdir:
+        os.makedirs(outdir, exist_ok=True)
+        cv2.imwrite(os.path.join(outdir,"roi_enh.png"), enh)
+        cv2.imwrite(os.path.join(outdir,"roi_binary.png"), binary)
+        cv2.imwrite(os.path.join(outdir,"roi_skeleton.png"), skel)
+        if hand is not None:
+            cv2.imwrite(os.path.join(outdir, "hand_mask.png"), hand)
+            cv2.imwrite(os.path.join(outdir, "hand_overlay.png"),
+                        render_overlay(located, hand=hand, hand_alpha=float(Cfg.hand_alpha)))
+        cv2.imwrite(os.path.join(outdir,"overlay_full.png"), render_overlay(located, skel=skel))
 
     # ===== Return JSON =====
-    return {
-        "image_size": {"width": img_bgr.shape[1], "height": img_bgr.shape[0]},
+    out = {
+        "image_size": {"width": located["image_size"][1], "height": located["image_size"][0]},
         "roi_bbox_small": {"x": x, "y": y, "w": w, "h": h},
         "lines": lines,
+        "polyline_encoding": "delta" if Cfg.polyline_delta else "xy",
         "finger_length_ratio_to_hand": _finger_ratios([(int(px*inv_scale), int(py*inv_scale)) for (px,py) in land]),
-        "roi_binary_png_b64": roi_binary_png_b64,
-        "roi_skeleton_png_b64": roi_skeleton_png_b64,
-        "roi_binary_rle": roi_binary_rle,
-        "hand": hand_json
     }
+    if Cfg.include_masks:
+        # base64 + RLE
+        out["roi_binary_png_b64"] = _png_b64(binary)
+        out["roi_skeleton_png_b64"] = _png_b64(skel)
+        out["roi_binary_rle"] = _binary_to_rle(binary)
+    out["hand"] = hand_json
+    if arrays is not None:
+        arrays["roi_binary"] = binary
+        arrays["roi_skeleton"] = skel
+    if overlay:
+        out["overlay_png_b64"] = _png_b64(render_overlay(located, hand, skel, float(Cfg.hand_alpha)))
+    if cache is not None:
+        out["image_key"] = image_key
+        out["stages_recomputed"] = run.recomputed
+    return out
 
 def _finger_ratios(land_full: List[Tuple[int,int]]) -> Dict[str,float]:
     L=lambda i: land_full[i]
@@ -542,6 +834,10 @@ if __name__ == "__main__":
     ap.add_argument("--hand_refine", type=str, default="grabcut", choices=["none","morph","skin","grabcut"])
     ap.add_argument("--hand_alpha", type=float, default=0.5)
 
+    ap.add_argument("--polyline_tolerance", type=float, default=1.5)
+    ap.add_argument("--polyline_delta", type=int, default=0)
+    ap.add_argument("--include_masks", type=int, default=1)
+
     args = ap.parse_args()
 
     if not os.path.exists(args.path):
@@ -563,7 +859,10 @@ if __name__ == "__main__":
         prune_spur_iter=args.prune_spur_iter,
         show_hand=bool(args.show_hand),
         hand_refine=args.hand_refine,
-        hand_alpha=args.hand_alpha
+        hand_alpha=args.hand_alpha,
+        polyline_tolerance=args.polyline_tolerance,
+        polyline_delta=bool(args.polyline_delta),
+        include_masks=bool(args.include_masks)
     )
 
     try:
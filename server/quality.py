@@ -0,0 +1,125 @@
+# server/quality.py
+"""
+Load-adaptive quality tiers for the analyze pipeline.
+
+``QualityController`` looks at the analyze queue depth and the p95 of recent
+pipeline run times. When either is above target it steps one tier down
+(cheaper ``PipeConfig``), and steps back up one tier at a time once load has
+stayed low for ``step_up_after`` seconds. ``apply`` only ever lowers settings,
+so a request that already asked for less work keeps its own values.
+"""
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, replace
+
+
+@dataclass(frozen=True)
+class Tier:
+    name: str
+    max_side: int | None = None        # เพดาน max_side
+    hand_refine: str | None = None     # "morph" แทน grabcut
+    show_hand: bool = True             # False = ข้าม segmentation/overlay ของทั้งมือ
+
+
+TIERS = (
+    Tier("full"),
+    Tier("reduced", max_side=1100, hand_refine="morph"),
+    Tier("low", max_side=900, hand_refine="morph", show_hand=False),
+    Tier("minimal", max_side=700, hand_refine="morph", show_hand=False),
+)
+
+_CHEAPER_REFINE = {"grabcut": 3, "skin": 2, "morph": 1, "none": 0}
+
+
+class QualityController:
+    def __init__(self, depth_fn, target_p95: float = 4.0, queue_high: int = 4,
+                 step_down_after: float = 2.0, step_up_after: float = 15.0,
+                 tiers=TIERS, enabled: bool = True, window: int = 64):
+        self.depth_fn = depth_fn
+        self.target_p95 = float(target_p95)
+        self.queue_high = max(1, int(queue_high))
+        self.step_down_after = float(step_down_after)
+        self.step_up_after = float(step_up_after)
+        self.tiers = tuple(tiers)
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._tier = 0
+        self._changed = 0.0
+        self._low_since = None
+        self.served = [0] * len(self.tiers)
+
+    def observe(self, seconds: float):
+        """Record one pipeline run time (only runs that actually computed)."""
+        with self._lock:
+            self._latencies.append(float(seconds))
+
+    def _p95(self) -> float:
+        if not self._latencies:
+            return 0.0
+        v = sorted(self._latencies)
+        return v[int(0.95 * (len(v) - 1))]
+
+    def pressure(self) -> float:
+        """>1 = overloaded, <0.5 = room to step up."""
+        try:
+            depth = self.depth_fn()
+        except Exception:
+            depth = 0
+        with self._lock:
+            p95 = self._p95()
+        return max(depth / self.queue_high, p95 / self.target_p95 if self.target_p95 > 0 else 0.0)
+
+    def current(self) -> int:
+        if not self.enabled:
+            return 0
+        p = self.pressure()
+        now = time.monotonic()
+        with self._lock:
+            if p > 1.0:
+                self._low_since = None
+                if self._tier < len(self.tiers) - 1 and now - self._changed >= self.step_down_after:
+                    self._tier += 1
+                    self._changed = now
+                    # เริ่มนับ latency ใหม่ของ tier นี้
+                    self._latencies.clear()
+            elif p < 0.5 and self._tier > 0:
+                if self._low_since is None:
+                    self._low_since = now
+                elif now - self._low_since >= self.step_up_after:
+                    self._tier -= 1
+                    self._changed = now
+                    self._low_since = now
+            else:
+                self._low_since = None
+            return self._tier
+
+    def apply(self, cfg):
+        """Return ``(cfg for the current tier, {"tier", "name"})``."""
+        idx = self.current()
+        tier = self.tiers[idx]
+        changes = {}
+        if tier.max_side and cfg.max_side > tier.max_side:
+            changes["max_side"] = tier.max_side
+        if tier.hand_refine and _CHEAPER_REFINE.get(cfg.hand_refine, 3) > _CHEAPER_REFINE[tier.hand_refine]:
+            changes["hand_refine"] = tier.hand_refine
+        if not tier.show_hand and cfg.show_hand:
+            changes["show_hand"] = False
+        with self._lock:
+            self.served[idx] += 1
+        return (replace(cfg, **changes) if changes else cfg), {"tier": idx, "name": tier.name}
+
+    def stats(self) -> dict:
+        with self._lock:
+            p95 = self._p95()
+            tier = self._tier
+            served = dict(zip((t.name for t in self.tiers), self.served))
+        return {
+            "enabled": self.enabled,
+            "tier": tier,
+            "name": self.tiers[tier].name,
+            "latency_p95_s": round(p95, 3),
+            "pressure": round(self.pressure(), 2),
+            "served": served,
+        }
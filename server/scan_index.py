@@ -0,0 +1,95 @@
+# server/scan_index.py
+"""
+Per-user index of recent scans for near-duplicate detection.
+
+Each entry keeps the fingerprint from ``python.scan_fingerprint`` (ROI dHash +
+normalized landmarks), the config it was analyzed with and the analyze result
+without its mask images (the caller passes the slim result).
+A new photo matches an entry when the dHash Hamming distance is at most
+``max_hamming`` and the mean landmark offset is at most ``landmark_tol`` (as a
+fraction of the ROI box). Entries are addressed by a ``scan_key`` that
+``/scan/save`` links to the saved scan id.
+"""
+import threading
+import time
+import uuid
+
+from ttl_cache import TTLCache
+
+
+def hamming(a: str, b: str) -> int:
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def landmark_distance(a, b) -> float:
+    if not a or len(a) != len(b):
+        return float("inf")
+    return sum(abs(p[0] - q[0]) + abs(p[1] - q[1]) for p, q in zip(a, b)) / (2 * len(a))
+
+
+class ScanIndex:
+    def __init__(self, max_users: int = 500, per_user: int = 3, ttl: float = 900.0,
+                 max_hamming: int = 6, landmark_tol: float = 0.04):
+        self.per_user = max(1, int(per_user))
+        self.max_hamming = int(max_hamming)
+        self.landmark_tol = float(landmark_tol)
+        self._users = TTLCache(max_users, ttl)            # uid -> [entry, ...] (ใหม่สุดท้ายสุด)
+        self._keys = TTLCache(max_users * self.per_user, ttl)   # scan_key -> entry
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+
+    def find(self, user_id: str, fp: dict, cfg_key: str):
+        """Closest matching entry as ``(entry, hamming)``, or None."""
+        with self._lock:
+            self.lookups += 1
+            entries = list(self._users.get(user_id) or [])
+        best = None
+        for e in entries:
+            if e["cfg_key"] != cfg_key:
+                continue
+            d = hamming(e["fp"]["roi_dhash"], fp["roi_dhash"])
+            if d > self.max_hamming:
+                continue
+            if landmark_distance(e["fp"]["landmarks"], fp["landmarks"]) > self.landmark_tol:
+                continue
+            if best is None or d < best[1]:
+                best = (e, d)
+        if best:
+            with self._lock:
+                self.hits += 1
+        return best
+
+    def add(self, user_id: str, fp: dict, cfg_key: str, result: dict) -> str:
+        entry = {
+            "scan_key": uuid.uuid4().hex[:16],
+            "user_id": user_id,
+            "fp": fp,
+            "cfg_key": cfg_key,
+            "result": result,
+            "scan_id": None,
+            "created": time.time(),
+        }
+        with self._lock:
+            entries = (list(self._users.get(user_id) or []) + [entry])[-self.per_user:]
+            self._users.set(user_id, entries)
+            self._keys.set(entry["scan_key"], entry)
+        return entry["scan_key"]
+
+    def lookup(self, scan_key: str, user_id: str):
+        entry = self._keys.get(scan_key)
+        return entry if entry and entry["user_id"] == user_id else None
+
+    def link(self, scan_key: str, user_id: str, scan_id: str):
+        entry = self.lookup(scan_key, user_id)
+        if entry is not None:
+            entry["scan_id"] = scan_id
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._users),
+            "entries": len(self._keys),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.lookups, 3) if self.lookups else 0.0,
+        }
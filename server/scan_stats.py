@@ -0,0 +1,85 @@
+# server/scan_stats.py
+"""
+Per-user scan aggregates kept in one document (``users/{uid}/stats/scans``).
+
+Every saved scan adds Firestore ``Increment`` transforms: the scan count, and
+per line (life/head/heart) the count, sum and sum of squares of ``length_px``
+and ``thickness_px`` plus one counter per ``branch_style``. Increments commute,
+so saves go through the write queue without a read-modify-write; mean and
+variance are derived when the document is read (``describe``).
+"""
+import math
+
+from firebase_admin import firestore
+
+LINES = ("life", "head", "heart")
+METRICS = ("length_px", "thickness_px")
+
+
+def _contributions(summary: dict):
+    """``(path, amount)`` pairs one scan adds to the aggregate document."""
+    yield ("count",), 1
+    for name in LINES:
+        d = (summary or {}).get(name) or {}
+        for metric in METRICS:
+            v = d.get(metric)
+            if isinstance(v, (int, float)) and math.isfinite(v):
+                v = float(v)
+                yield ("lines", name, metric, "n"), 1
+                yield ("lines", name, metric, "sum"), v
+                yield ("lines", name, metric, "sumsq"), v * v
+        style = d.get("branch_style")
+        if style:
+            yield ("lines", name, "branch_style", str(style)), 1
+
+
+def _put(doc: dict, path: tuple, value):
+    for key in path[:-1]:
+        doc = doc.setdefault(key, {})
+    doc[path[-1]] = value
+
+
+def increments(summary: dict) -> dict:
+    """Merge-write payload that folds one scan summary into the aggregates."""
+    doc = {"updatedAt": firestore.SERVER_TIMESTAMP}
+    for path, amount in _contributions(summary):
+        _put(doc, path, firestore.Increment(amount))
+    return doc
+
+
+def accumulate(doc: dict, summary: dict) -> dict:
+    """Same as ``increments`` but added into a plain dict (used for backfill)."""
+    for path, amount in _contributions(summary):
+        cur = doc
+        for key in path[:-1]:
+            cur = cur.setdefault(key, {})
+        cur[path[-1]] = (cur.get(path[-1]) or 0) + amount
+    return doc
+
+
+def _moments(s: dict) -> dict:
+    n = int(s.get("n") or 0)
+    if n == 0:
+        return {"n": 0, "mean": None, "variance": None, "stddev": None}
+    mean = float(s.get("sum") or 0.0) / n
+    # sample variance จาก sum/sumsq (ค่า px ไม่ใหญ่พอจะเสียความแม่นยำ)
+    var = max(0.0, (float(s.get("sumsq") or 0.0) - n * mean * mean) / (n - 1)) if n > 1 else 0.0
+    return {"n": n, "mean": round(mean, 3), "variance": round(var, 3), "stddev": round(math.sqrt(var), 3)}
+
+
+def describe(doc: dict | None) -> dict:
+    """API view of the aggregate document: count, per-line moments and branch-style shares."""
+    doc = doc or {}
+    lines = {}
+    for name in LINES:
+        d = (doc.get("lines") or {}).get(name) or {}
+        counts = {k: int(v) for k, v in (d.get("branch_style") or {}).items()}
+        total = sum(counts.values())
+        lines[name] = {
+            **{metric: _moments(d.get(metric) or {}) for metric in METRICS},
+            "branch_style": {
+                "counts": counts,
+                "share": {k: round(v / total, 3) for k, v in counts.items()} if total else {},
+            },
+        }
+    return {"count": int(doc.get("count") or 0), "lines": lines, "updatedAt": doc.get("updatedAt")}
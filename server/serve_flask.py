@@ -1,16 +1,24 @@
 # server/serve_flask.py
 import os
 import base64
+import hashlib
+import itertools
+import json
+import logging
+import random
+import re
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import astuple
 from datetime import datetime, timezone
+from functools import wraps
 from pathlib import Path
 
 import numpy as np
 import cv2
 import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 
 # ---- load .env early ----
@@ -21,13 +29,41 @@ try:
 except Exception:
     pass
 
-from python import analyze, PipeConfig
+from python import analyze, locate_hand_cached, scan_fingerprint, compute_image_key, StageCache, PipeConfig
+from fortune_cache import FortuneCache, fortune_key, seconds_until_period_end
+from write_queue import WriteQueue
+from known_users import KnownUsers
+from token_cache import TokenCache
+from ttl_cache import TTLCache
+from admission import Admission, Overloaded
+from analyze_jobs import AnalyzeJobs, JobQueueFull, MemoryJobStore, SqliteJobStore, start_pool
+from shm_transport import SegmentPool
+from fastjson import FastJSONProvider
+from compress import init_compression
+from applog import setup_logging, init_request_logging
+from single_flight import SingleFlight, payload_key
+from deepseek_client import DeepSeekClient, DeepSeekError as _DeepSeekError
+import prompts
+from scan_index import ScanIndex
+import scan_stats
+from quality import QualityController
 
 import firebase_admin
 from firebase_admin import credentials, firestore, auth as fb_auth
 
+# /analyze/jobs เปิดเมื่อกำหนด ANALYZE_WORKERS > 0 (ค่าเริ่มต้น 0 = ปิด ไม่มี worker process)
+# fork worker ตอนนี้ ก่อนที่ module นี้จะเริ่ม thread แรก (log writer, write queue, gRPC)
+_ANALYZE_WORKERS = max(0, int(os.getenv("ANALYZE_WORKERS") or 0))
+_ANALYZE_POOL = start_pool(_ANALYZE_WORKERS, os.getenv("ANALYZE_MP_START") or None) if _ANALYZE_WORKERS else None
+
+setup_logging(os.getenv("LOG_LEVEL", "INFO"), os.getenv("LOG_FORMAT", "json"),
+              queue_size=int(os.getenv("LOG_QUEUE_SIZE", "10000")))
+log = logging.getLogger("serve_flask")
+
 app = Flask(__name__)
-CORS(app)
+app.json = FastJSONProvider(app)   # orjson ถ้ามี, ไม่งั้น stdlib (รองรับ numpy ทั้งคู่)
+# X-Next-Cursor: cursor หน้าถัดไปของ /scan/list, /fortune/list
+CORS(app, expose_headers=["X-Next-Cursor"])
 
 DEEPSEEK_BASE = os.getenv("DEEPSEEK_BASE", "https://api.deepseek.com")
 DEEPSEEK_KEY = os.getenv("DEEPSEEK_API_KEY", "")
@@ -36,33 +72,144 @@ DEEPSEEK_KEY = os.getenv("DEEPSEEK_API_KEY", "")
 app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_CONTENT_LENGTH_MB", "16")) * 1024 * 1024  # default 16 MB
 
 
-# ---------- HTTP session with retries for DeepSeek ----------
+# ---------- DeepSeek client (deadline, deadline-aware retries, optional hedging) ----------
 def _get_timeout():
     # ENV ปรับได้ เช่น DEEPSEEK_CONNECT_TIMEOUT=10, DEEPSEEK_READ_TIMEOUT=75
     c = float(os.getenv("DEEPSEEK_CONNECT_TIMEOUT", "10"))
     r = float(os.getenv("DEEPSEEK_READ_TIMEOUT", "75"))
     return (c, r)
 
-def _make_session():
-    s = requests.Session()
-    retry = Retry(
-        total=4,                # รวมครั้งแรก = 5 ครั้ง
-        connect=3,              # retry เมื่อ connect ล้มเหลว
-        read=3,                 # retry เมื่อ read timeout
-        backoff_factor=0.8,     # 0.8, 1.6, 3.2, ...
-        status_forcelist=(502, 503, 504),
-        allowed_methods=frozenset(["GET", "POST", "HEAD"])
+
+_CONNECT_TIMEOUT, _READ_TIMEOUT = _get_timeout()
+_DEEPSEEK = DeepSeekClient(
+    DEEPSEEK_BASE, DEEPSEEK_KEY,
+    connect_timeout=_CONNECT_TIMEOUT,
+    read_timeout=_READ_TIMEOUT,
+    deadline=float(os.getenv("DEEPSEEK_DEADLINE_SEC", "90")),
+    max_retries=int(os.getenv("DEEPSEEK_MAX_RETRIES", "2")),
+    # ให้พอกับ LLM_MAX_CONCURRENT (+ hedge)
+    pool_size=int(os.getenv("DEEPSEEK_POOL_SIZE", "32")),
+    hedge=os.getenv("DEEPSEEK_HEDGE", "0").lower() in ("1", "true", "yes"),
+    hedge_after=float(os.getenv("DEEPSEEK_HEDGE_AFTER_SEC", "8")),
+)
+
+
+def _deepseek_stream(payload: dict):
+    """Streaming ``/chat/completions``; returns the ok response once headers arrive (body bounded by the deadline)."""
+    return _DEEPSEEK.open_stream(payload)
+
+
+# request ซ้ำ (กดสองครั้ง / client retry) ที่ payload เหมือนกันและยังรอ DeepSeek อยู่ ใช้ call เดียวกัน
+_LLM_FLIGHTS = SingleFlight("deepseek")
+
+
+# prompt_cache_hit_tokens / prompt_cache_miss_tokens จาก usage แยกตาม template
+_PROMPT_USAGE = prompts.PromptCacheStats()
+
+
+def _deepseek_complete(payload: dict, template: str) -> dict:
+    """Non-stream ``chat/completions`` JSON; identical in-flight payloads share one upstream call."""
+    def call():
+        resp = _DEEPSEEK.complete(payload)
+        _PROMPT_USAGE.record(template, resp.get("usage"))
+        return resp
+
+    resp, _ = _LLM_FLIGHTS.do(payload_key(payload), call)
+    return resp
+
+
+def _sse(data, event=None) -> str:
+    """Format one Server-Sent Events frame."""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {app.json.dumps(data)}\n\n"
+
+
+def _sse_response(gen):
+    # X-Accel-Buffering ปิด buffer ของ reverse proxy (nginx) ให้ token ไหลถึง client ทันที
+    return Response(
+        stream_with_context(gen),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
-    adapter = HTTPAdapter(max_retries=retry)
-    s.mount("https://", adapter)
-    s.mount("http://", adapter)
-    return s
 
-_HTTP = _make_session()
+
+def _iter_deepseek_chunks(r):
+    """
+    Parse DeepSeek's SSE body (``data: {...}`` lines, ends with ``data: [DONE]``)
+    and yield each chunk as a dict. ``chunk_size=None`` hands lines over as soon
+    as they arrive instead of waiting for a fixed-size buffer to fill.
+    """
+    # decode เองเป็น UTF-8: text/event-stream ไม่มี charset requests จะเดาเป็น latin-1
+    for raw in r.iter_lines(chunk_size=None):
+        line = raw.decode("utf-8", errors="replace")
+        if not line or not line.startswith("data:"):
+            continue
+        body = line[5:].strip()
+        if body == "[DONE]":
+            break
+        try:
+            yield json.loads(body)
+        except ValueError:
+            continue
+
+
+def _relay_deepseek_stream(r, on_done, template: str):
+    """
+    Relay a streaming DeepSeek response as SSE ``delta`` events while
+    accumulating the full answer. When the upstream stream completes,
+    ``on_done(resp)`` is called with a response shaped like the non-stream
+    ``chat/completions`` JSON; its return value is sent as the ``done`` event.
+    """
+    parts, reasoning = [], []
+    resp = {"object": "chat.completion", "choices": []}
+    finish_reason = None
+    try:
+        for chunk in _iter_deepseek_chunks(r):
+            for key in ("id", "model", "created", "system_fingerprint"):
+                if chunk.get(key) is not None:
+                    resp[key] = chunk[key]
+            if chunk.get("usage"):
+                resp["usage"] = chunk["usage"]
+            for choice in chunk.get("choices") or []:
+                delta = choice.get("delta") or {}
+                if delta.get("reasoning_content"):
+                    reasoning.append(delta["reasoning_content"])
+                if delta.get("content"):
+                    parts.append(delta["content"])
+                    yield _sse({"content": delta["content"]}, event="delta")
+                if choice.get("finish_reason"):
+                    finish_reason = choice["finish_reason"]
+    except requests.RequestException as e:
+        yield _sse({"error": "stream_interrupted", "detail": str(e)}, event="error")
+        return
+    except _DeepSeekError as e:
+        # เกิน DEEPSEEK_DEADLINE_SEC ระหว่าง stream
+        yield _sse(e.body, event="error")
+        return
+    finally:
+        r.close()
+
+    message = {"role": "assistant", "content": "".join(parts)}
+    if reasoning:
+        message["reasoning_content"] = "".join(reasoning)
+    resp["choices"] = [{"index": 0, "message": message, "finish_reason": finish_reason}]
+    _PROMPT_USAGE.record(template, resp.get("usage"))
+
+    try:
+        result = on_done(resp)
+    except Exception as e:
+        log.exception("saving streamed result failed")
+        result = {"answer": message["content"], "_save_error": str(e)}
+    yield _sse(result, event="done")
 # -----------------------------------------------------------
 
 
 def _init_firestore():
+    # FIRESTORE_BACKEND=memory: ใช้ store ในหน่วยความจำ (รันออฟไลน์/load test)
+    if os.getenv("FIRESTORE_BACKEND", "").lower() == "memory":
+        from memory_firestore import MemoryFirestore
+        log.info("firestore: using in-memory backend")
+        return MemoryFirestore()
     cred_path_env = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
     if cred_path_env and os.path.exists(cred_path_env):
         cred_path = cred_path_env
@@ -77,6 +224,18 @@ def _init_firestore():
 db = _init_firestore()
 
 
+def _run_transaction(fn):
+    """รัน fn(transaction) ใน transaction (backend memory มี retry loop ของตัวเอง)"""
+    if hasattr(db, "run_transaction"):
+        return db.run_transaction(fn)
+    return firestore.transactional(fn)(db.transaction())
+
+_FORTUNE_CACHE = FortuneCache(
+    maxsize=int(os.getenv("FORTUNE_CACHE_SIZE", "2048")),
+    redis_url=os.getenv("FORTUNE_CACHE_REDIS_URL"),
+)
+
+
 def _to_bool(v, default=False):
     if v is None:
         return default
@@ -98,6 +257,33 @@ def _to_float(v, default=None):
     return float(v)
 
 
+# request id + access log (endpoint, status, latency) — ลงทะเบียนก่อน compression จะได้เห็น response สุดท้าย
+_REQUEST_LOG = init_request_logging(
+    app,
+    access_sample=float(os.getenv("LOG_ACCESS_SAMPLE_RATE", "1")),
+    debug_sample=float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.05")),
+    slow_ms=float(os.getenv("LOG_SLOW_MS", "2000")),
+)
+
+# gzip/brotli สำหรับ response ใหญ่ (ผล analyze, /scan/list) — ไม่แตะ SSE
+_COMPRESSOR = init_compression(
+    app,
+    min_size=int(os.getenv("COMPRESS_MIN_BYTES", "1024")),
+    level=int(os.getenv("COMPRESS_LEVEL", "6")),
+    brotli_quality=int(os.getenv("BROTLI_QUALITY", "5")),
+) if _to_bool(os.getenv("COMPRESS_ENABLED"), True) else None
+
+
+# Firestore writes จาก endpoint ไปเข้าคิวแล้ว commit เป็น batch ใน background
+_WRITES = WriteQueue(
+    db,
+    maxsize=int(os.getenv("WRITE_QUEUE_MAX", "1000")),
+    batch_size=int(os.getenv("WRITE_BATCH_SIZE", "200")),
+    linger=float(os.getenv("WRITE_BATCH_LINGER_MS", "50")) / 1000.0,
+    enabled=_to_bool(os.getenv("WRITE_QUEUE_ENABLED"), True),
+)
+
+
 def _summarize_analyze(out: dict) -> dict:
     lines = (out or {}).get("lines", {}) or {}
 
@@ -105,6 +291,7 @@ def _summarize_analyze(out: dict) -> dict:
         d = lines.get(name) or {}
         return {
             "length_px": d.get("length_px"),
+            "thickness_px": d.get("thickness_px"),
             "branch_style": d.get("branch_style"),
         } if d else None
 
@@ -121,49 +308,83 @@ def _summarize_analyze(out: dict) -> dict:
     }
 
 
+def _write_user_doc(user_id: str, data: dict, merge: bool = True):
+    _WRITES.set(db.collection("users").document(user_id), data, merge=merge)
+    # updatedAt อย่างเดียวไม่กระทบ safe profile จึงไม่ต้องล้าง cache
+    if set(data) - {"updatedAt"}:
+        _PROFILES.pop(user_id)
+
+
+def _touch_user_doc(user_id: str):
+    _write_user_doc(user_id, {"updatedAt": firestore.SERVER_TIMESTAMP})
+
+
+# user ที่รู้แล้วว่ามีเอกสาร จะไม่เขียนซ้ำทุก request; updatedAt ถูกรวบเขียนเป็นรอบ
+_KNOWN_USERS = KnownUsers(
+    _touch_user_doc,
+    ttl=float(os.getenv("KNOWN_USER_TTL_SEC", "3600")),
+    maxsize=int(os.getenv("KNOWN_USER_CACHE_SIZE", "10000")),
+    flush_interval=float(os.getenv("USER_TOUCH_FLUSH_SEC", "60")),
+)
+
+
 def _ensure_user_doc(user_id: str):
     if not user_id:
         user_id = "anonymous"
-    db.collection("users").document(user_id).set(
-        {"updatedAt": firestore.SERVER_TIMESTAMP},
-        merge=True,
-    )
+    _KNOWN_USERS.ensure(user_id)
     return user_id
 
 
-def _get_uid(req) -> str:
-    # Prefer Firebase ID token from Authorization: Bearer <token>
+# ID token ที่ verify แล้วเก็บไว้จนถึง exp ของ token (ไม่ต้อง verify ซ้ำทุก request)
+_ID_TOKENS = TokenCache(
+    fb_auth.verify_id_token,
+    maxsize=int(os.getenv("ID_TOKEN_CACHE_SIZE", "4096")),
+    check_revoked=_to_bool(os.getenv("AUTH_CHECK_REVOKED"), False),
+    revoke_recheck=float(os.getenv("AUTH_REVOKE_RECHECK_SEC", "60")),
+)
+
+
+def _token_uid(req) -> str | None:
+    # uid จาก Firebase ID token (Authorization: Bearer <token>) ที่ verify แล้วเท่านั้น
     authz = req.headers.get("Authorization") or ""
     if authz.startswith("Bearer "):
         token = authz.split(" ", 1)[1].strip()
         if token:
             try:
-                decoded = fb_auth.verify_id_token(token)
-                uid = decoded.get("uid")
-                if uid:
-                    return uid
+                return _ID_TOKENS.verify(token).get("uid") or None
             except Exception as e:
-                print("[auth] verify_id_token failed:", e)
-    # Fallback to JSON body user_id for dev/testing
+                log.warning("verify_id_token failed: %s", e)
+    return None
+
+
+def _get_uid(req) -> str:
+    # Prefer Firebase ID token from Authorization: Bearer <token>
+    uid = _token_uid(req)
+    if uid:
+        return uid
+    # Fallback to JSON body / form user_id for dev/testing
     if req.is_json:
         data = req.get_json(silent=True) or {}
         uid = (data.get("user_id") or "").strip()
         if uid:
             return uid
+    uid = (req.form.get("user_id") or "").strip()
+    if uid:
+        return uid
     return "anonymous"
 
 
-def _fetch_user_profile(user_id: str) -> dict:
+def _fetch_user_profile(user_id: str) -> dict | None:
     """
     ดึงข้อมูล users/{user_id} (เช่น displayName, dob, gender, locale ฯลฯ)
-    ถ้าเอกสารไม่มี ให้คืน {} (ไม่ error)
+    ถ้าเอกสารไม่มี ให้คืน {} (ไม่ error), ถ้าอ่านไม่สำเร็จคืน None
     """
     try:
         d = db.collection("users").document(user_id).get()
         return d.to_dict() or {}
     except Exception as e:
-        print("[user_profile] fetch failed:", e)
-        return {}
+        log.warning("user profile fetch failed: %s", e, extra={"user_id": user_id})
+        return None
 
 
 def _normalize_birth_date(raw) -> str | None:
@@ -247,6 +468,131 @@ def _build_safe_profile(user_profile: dict) -> dict:
     return safe
 
 
+# safe profile (ผลของ _build_safe_profile) ต่อ user; ล้างเมื่อ server เขียน users/{uid}
+_PROFILES = TTLCache(
+    maxsize=int(os.getenv("PROFILE_CACHE_SIZE", "4096")),
+    ttl=float(os.getenv("PROFILE_CACHE_TTL_SEC", "300")),
+)
+_PROFILE_PREFETCH = _to_bool(os.getenv("PROFILE_PREFETCH"), True)
+_IO_POOL = ThreadPoolExecutor(
+    max_workers=int(os.getenv("IO_POOL_WORKERS", "8")),
+    thread_name_prefix="io",
+)
+
+
+def _get_safe_profile(user_id: str, refresh: bool = False) -> dict:
+    if not refresh:
+        cached = _PROFILES.get(user_id)
+        if cached is not None:
+            return cached
+    user_profile = _fetch_user_profile(user_id)
+    if user_profile is None:
+        return {}  # อ่านไม่สำเร็จ: ไม่ cache
+    safe = _build_safe_profile(user_profile)
+    _PROFILES.set(user_id, safe)
+    return safe
+
+
+def _prefetch_safe_profile(user_id: str, refresh: bool = False) -> Future:
+    """Start loading the safe profile so it overlaps with other Firestore reads."""
+    if not refresh:
+        cached = _PROFILES.get(user_id)
+        if cached is not None:
+            f = Future()
+            f.set_result(cached)
+            return f
+    if _PROFILE_PREFETCH:
+        return _IO_POOL.submit(_get_safe_profile, user_id, True)
+    f = Future()
+    f.set_result(_get_safe_profile(user_id, True))
+    return f
+
+
+# ---------- admission control / load shedding ----------
+_ADMISSION_PER_USER = int(os.getenv("ADMISSION_PER_USER", "2"))
+_GATES = {
+    # CPU-bound OpenCV/MediaPipe
+    "analyze": Admission(
+        "analyze",
+        max_concurrent=int(os.getenv("ANALYZE_MAX_CONCURRENT", str(os.cpu_count() or 2))),
+        max_queue=int(os.getenv("ANALYZE_MAX_QUEUE", "8")),
+        max_wait=float(os.getenv("ANALYZE_MAX_WAIT_SEC", "10")),
+        per_user=_ADMISSION_PER_USER,
+    ),
+    # DeepSeek calls (long I/O waits)
+    "llm": Admission(
+        "llm",
+        max_concurrent=int(os.getenv("LLM_MAX_CONCURRENT", "16")),
+        max_queue=int(os.getenv("LLM_MAX_QUEUE", "32")),
+        max_wait=float(os.getenv("LLM_MAX_WAIT_SEC", "5")),
+        per_user=_ADMISSION_PER_USER,
+    ),
+}
+
+
+def _overloaded_response(e: Overloaded, **extra):
+    resp = jsonify({**extra, "error": "overloaded", "detail": e.reason, "gate": e.gate})
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp, 503
+
+
+class _ReleaseOnClose:
+    """Response iterable that holds an admission ticket until the body is fully sent (or aborted)."""
+
+    def __init__(self, iterable, ticket):
+        self._iterable = iterable
+        self._ticket = ticket
+
+    def __iter__(self):
+        try:
+            yield from self._iterable
+        finally:
+            self._ticket.release()
+
+    def close(self):
+        try:
+            if hasattr(self._iterable, "close"):
+                self._iterable.close()
+        finally:
+            self._ticket.release()
+
+
+def _hold_until_sent(resp, ticket):
+    if resp.is_streamed:
+        resp.response = _ReleaseOnClose(resp.response, ticket)
+    else:
+        ticket.release()
+    return resp
+
+
+def _fairness_key(req) -> str:
+    # key ของโควตาต่อ user: uid จาก token ที่ verify แล้ว ไม่งั้นใช้ IP ผู้เรียก
+    # (ไม่ใช้ user_id ใน body/form เพราะ client ตั้งเองได้ และทุกคนที่ไม่ login จะเป็น "anonymous" ก้อนเดียว)
+    uid = _token_uid(req)
+    return f"uid:{uid}" if uid else f"ip:{req.remote_addr or 'unknown'}"
+
+
+def _admit(gate_name: str):
+    """Run the view only after ``_GATES[gate_name]`` admits the caller; otherwise 503 + Retry-After."""
+    gate = _GATES[gate_name]
+
+    def deco(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            try:
+                ticket = gate.acquire(_fairness_key(request))
+            except Overloaded as e:
+                return _overloaded_response(e)
+            try:
+                resp = app.make_response(view(*args, **kwargs))
+            except Exception:
+                ticket.release()
+                raise
+            return _hold_until_sent(resp, ticket)
+        return wrapped
+    return deco
+
+
 @app.get("/routes")
 def routes():
     return {"routes": sorted([r.rule for r in app.url_map.iter_rules()])}, 200
@@ -266,16 +612,36 @@ def env_info():
     }), 200
 
 
+@app.get("/metrics")
+def metrics():
+    return jsonify({
+        "id_tokens": _ID_TOKENS.stats(),
+        "known_users": _KNOWN_USERS.stats(),
+        "profiles": _PROFILES.stats(),
+        "fortune_cache": _FORTUNE_CACHE.stats(),
+        "write_queue": _WRITES.stats(),
+        "analyze_jobs": _ANALYZE_JOBS.stats() if _ANALYZE_JOBS else None,
+        "admission": {name: gate.stats() for name, gate in _GATES.items()},
+        "compression": _COMPRESSOR.stats() if _COMPRESSOR else None,
+        "scan_dedup": _SCAN_INDEX.stats(),
+        "stage_cache": _STAGE_CACHE.stats() if _STAGE_CACHE is not None else None,
+        "quality": _QUALITY.stats(),
+        "deepseek": _DEEPSEEK.stats(),
+        "prompt_cache": _PROMPT_USAGE.stats(),
+        "coalescing": {"deepseek": _LLM_FLIGHTS.stats(), "fortune": _FORTUNE_FLIGHTS.stats()},
+        "logging": _REQUEST_LOG.stats(),
+    }), 200
+
+
 @app.get("/debug/deepseek")
 def debug_deepseek():
     """เช็คว่าออกเน็ตไปยัง DeepSeek ได้ไหม"""
     t0 = time.time()
     try:
         # 401/403 ถือว่า “ถึงปลายทาง” (แค่สิทธิ์/route) => reachable True
-        resp = _HTTP.get(
-            f"{DEEPSEEK_BASE}/v1/models",
+        resp = _DEEPSEEK.get(
+            "/v1/models",
             headers={"Authorization": f"Bearer {DEEPSEEK_KEY}"},
-            timeout=_get_timeout(),
         )
         ms = int((time.time() - t0) * 1000)
         ok = resp.status_code in (200, 401, 403)
@@ -293,71 +659,397 @@ def firestore_ping():
         ref = db.collection("ping_test").add(doc)
         return jsonify({"ok": True, "id": ref[1].id}), 200
     except Exception as e:
-        import traceback; traceback.print_exc()
+        log.exception("firestore ping failed")
         return jsonify({"ok": False, "error": str(e)}), 500
 
 
-@app.post("/analyze")
-def analyze_endpoint():
-    print(">> Content-Type:", request.content_type)
-    print(">> files keys:", list(request.files.keys()))
-    print(">> form keys:", list(request.form.keys()))
-
-    img = None
-
-    if "file" in request.files:
-        fs = request.files["file"]
+def _request_image_bytes(req):
+    """
+    Encoded image bytes from multipart ``file`` or JSON ``image_b64``.
+    Returns ``(raw, None)`` or ``(None, error_response)``.
+    """
+    if "file" in req.files:
+        fs = req.files["file"]
         raw = fs.read()
-        print(">> received file:", fs.filename, fs.mimetype, "bytes:", len(raw))
-        arr = np.frombuffer(raw, np.uint8)
-        img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-        if img is None:
-            print("!! cv2.imdecode returned None for multipart file")
+        log.debug("image upload", extra={"content_type": req.content_type, "upload_name": fs.filename,
+                                         "mimetype": fs.mimetype, "bytes": len(raw),
+                                         "form_keys": list(req.form.keys())})
+        return raw, None
 
-    elif request.is_json:
-        data = request.get_json(silent=True) or {}
+    if req.is_json:
+        data = req.get_json(silent=True) or {}
         b64 = data.get("image_b64")
         if not b64:
-            return jsonify({"error": "missing image_b64"}), 400
+            return None, (jsonify({"error": "missing image_b64"}), 400)
         try:
-            arr = np.frombuffer(base64.b64decode(b64), np.uint8)
-            img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-            if img is None:
-                print("!! cv2.imdecode returned None for base64 JSON")
+            return base64.b64decode(b64), None
         except Exception as e:
-            print("!! base64 decode error:", e)
-            return jsonify({"error": "invalid base64"}), 400
+            log.debug("invalid image_b64: %s", e)
+            return None, (jsonify({"error": "invalid base64"}), 400)
+
+    return None, (jsonify({"error": "missing/invalid image"}), 400)
 
+
+def _decode_request_image(req):
+    """
+    Decode the uploaded image: multipart ``file`` or JSON ``image_b64``.
+    Returns ``(img, None)`` or ``(None, error_response)``.
+    """
+    raw, err = _request_image_bytes(req)
+    if err:
+        return None, err
+    img = cv2.imdecode(np.frombuffer(raw, np.uint8), cv2.IMREAD_COLOR)
     if img is None:
-        return jsonify({"error": "missing/invalid image"}), 400
-
-    cfg = PipeConfig(
-        max_side=_to_int(request.form.get("max_side")) or PipeConfig.max_side,
-        strong_enhance=_to_bool(request.form.get("strong_enhance"), False),
-        clahe_clip=_to_float(request.form.get("clahe_clip")) or PipeConfig.clahe_clip,
-        detail_binary=_to_bool(request.form.get("detail_binary"), False),
-        block_size=_to_int(request.form.get("block_size")) or PipeConfig.block_size,
-        C=_to_int(request.form.get("C")) or PipeConfig.C,
-        close_itr=_to_int(request.form.get("close_itr")) or PipeConfig.close_itr,
-        open_itr=_to_int(request.form.get("open_itr")) or PipeConfig.open_itr,
-        use_frangi=_to_bool(request.form.get("use_frangi"), False),
-        frangi_thresh=_to_float(request.form.get("frangi_thresh")) or PipeConfig.frangi_thresh,
-        rect_skeleton_kernel=_to_bool(request.form.get("rect_skeleton_kernel"), False),
-        min_component_pixels=_to_int(request.form.get("min_component_pixels")) or PipeConfig.min_component_pixels,
-        prune_spur_iter=_to_int(request.form.get("prune_spur_iter")) or PipeConfig.prune_spur_iter,
-        show_hand=_to_bool(request.form.get("show_hand"), True),
-        hand_refine=request.form.get("hand_refine") or PipeConfig.hand_refine,
-        hand_alpha=_to_float(request.form.get("hand_alpha")) or PipeConfig.hand_alpha,
+        log.debug("cv2.imdecode returned None")
+        return None, (jsonify({"error": "missing/invalid image"}), 400)
+    return img, None
+
+
+def _pipe_config(params) -> PipeConfig:
+    return PipeConfig(
+        max_side=_to_int(params.get("max_side")) or PipeConfig.max_side,
+        strong_enhance=_to_bool(params.get("strong_enhance"), False),
+        clahe_clip=_to_float(params.get("clahe_clip")) or PipeConfig.clahe_clip,
+        detail_binary=_to_bool(params.get("detail_binary"), False),
+        block_size=_to_int(params.get("block_size")) or PipeConfig.block_size,
+        C=_to_int(params.get("C")) or PipeConfig.C,
+        close_itr=_to_int(params.get("close_itr")) or PipeConfig.close_itr,
+        open_itr=_to_int(params.get("open_itr")) or PipeConfig.open_itr,
+        use_frangi=_to_bool(params.get("use_frangi"), False),
+        frangi_thresh=_to_float(params.get("frangi_thresh")) or PipeConfig.frangi_thresh,
+        rect_skeleton_kernel=_to_bool(params.get("rect_skeleton_kernel"), False),
+        min_component_pixels=_to_int(params.get("min_component_pixels")) or PipeConfig.min_component_pixels,
+        prune_spur_iter=_to_int(params.get("prune_spur_iter")) or PipeConfig.prune_spur_iter,
+        show_hand=_to_bool(params.get("show_hand"), True),
+        hand_refine=params.get("hand_refine") or PipeConfig.hand_refine,
+        hand_alpha=_to_float(params.get("hand_alpha")) or PipeConfig.hand_alpha,
+        polyline_tolerance=_to_float(params.get("polyline_tolerance"), PipeConfig.polyline_tolerance),
+        polyline_delta=_to_bool(params.get("polyline_delta"), False),
+        include_masks=_to_bool(params.get("include_masks"), True),
     )
 
-    out = analyze(img, outdir="debug_out", Cfg=cfg)
+
+# ---------- near-duplicate scans (ถ่ายมือเดิมซ้ำภายในไม่กี่นาที) ----------
+_SCAN_INDEX = ScanIndex(
+    max_users=int(os.getenv("SCAN_DEDUP_USERS", "500")),
+    per_user=int(os.getenv("SCAN_DEDUP_PER_USER", "3")),
+    ttl=float(os.getenv("SCAN_DEDUP_TTL_SEC", "900")),
+    max_hamming=int(os.getenv("SCAN_DEDUP_MAX_HAMMING", "6")),
+    landmark_tol=float(os.getenv("SCAN_DEDUP_LANDMARK_TOL", "0.04")),
+)
+SCAN_DEDUP_ENABLED = _to_bool(os.getenv("SCAN_DEDUP_ENABLED"), True)
+
+
+# ภาพ debug (roi_*, hand_*, overlay_full) เขียนเฉพาะบาง request ตาม DEBUG_SAMPLE_RATE (0 = ไม่เขียน)
+DEBUG_OUT_DIR = os.getenv("DEBUG_OUT_DIR", "debug_out")
+DEBUG_SAMPLE_RATE = float(os.getenv("DEBUG_SAMPLE_RATE", "0"))
+
+
+def _debug_outdir():
+    return DEBUG_OUT_DIR if DEBUG_SAMPLE_RATE > 0 and random.random() < DEBUG_SAMPLE_RATE else None
+
+
+# ผลกลางของแต่ละ stage ของ pipeline (ปรับค่าปลายทางแล้ววิเคราะห์ใหม่ไม่ต้องเริ่มจากศูนย์)
+_STAGE_CACHE_MB = int(os.getenv("STAGE_CACHE_MB", "256"))
+_STAGE_CACHE = StageCache(_STAGE_CACHE_MB * 1024 * 1024) if _STAGE_CACHE_MB > 0 else None
+
+
+def _analyze_or_reuse(user_id: str, img, cfg: PipeConfig, force_fresh: bool = False,
+                      overlay: bool = False) -> dict:
+    """
+    ``analyze`` unless ``user_id`` analyzed a near-identical photo with the same
+    config recently; then the earlier result is returned with ``duplicate_of``
+    (``scan_key``, ``scan_id`` if it was saved, ``hamming``) without the mask
+    images, which the index does not keep. Successful results
+    carry a ``scan_key`` for ``/scan/save`` and the ``quality`` tier they ran at.
+    ``overlay`` asks for a preview ``overlay_png_b64`` (never reused from the index).
+    ``force_fresh`` skips both the index and the stage cache.
+    """
+    t0 = time.perf_counter()
+    cfg, quality = _QUALITY.apply(cfg)
+
+    if not SCAN_DEDUP_ENABLED or user_id == "anonymous" or img is None or img.size == 0:
+        return _with_quality(analyze(img, outdir=_debug_outdir(), Cfg=cfg, cache=_STAGE_CACHE,
+                                     overlay=overlay, refresh=force_fresh), quality, t0)
+
+    image_key = compute_image_key(img) if _STAGE_CACHE is not None else None
+    located = locate_hand_cached(img, cfg, _STAGE_CACHE, image_key, refresh=force_fresh)
+    if located is None:
+        return {"error": "Hand not detected."}
+    fp = scan_fingerprint(located)
+    cfg_key = hashlib.sha1(repr(astuple(cfg)).encode("utf-8")).hexdigest()[:16]
+
+    if not force_fresh and not overlay:
+        hit = _SCAN_INDEX.find(user_id, fp, cfg_key)
+        if hit:
+            entry, dist = hit
+            return {
+                **entry["result"],
+                **({"image_key": image_key} if image_key else {}),
+                "scan_key": entry["scan_key"],
+                "duplicate_of": {"scan_key": entry["scan_key"], "scan_id": entry["scan_id"], "hamming": dist},
+            }
+
+    out = analyze(img, outdir=_debug_outdir(), Cfg=cfg, located=located,
+                  cache=_STAGE_CACHE, image_key=image_key, overlay=overlay, refresh=force_fresh)
+    out = _with_quality(out, quality, t0)
+    if not out.get("error"):
+        out["scan_key"] = _SCAN_INDEX.add(user_id, fp, cfg_key, _slim_result(out))
+    return out
+
+
+def _with_quality(out: dict, quality: dict, t0: float) -> dict:
+    if not out.get("error"):
+        _QUALITY.observe(time.perf_counter() - t0)
+        out["quality"] = quality
+    return out
+
+
+@app.post("/analyze")
+@_admit("analyze")
+def analyze_endpoint():
+    """
+    วิเคราะห์รูปมือ (multipart ``file`` หรือ JSON ``image_b64``)
+    รูปที่เกือบเหมือนรูปล่าสุดของ user เดิมจะได้ผลเดิมคืน (มี ``duplicate_of``)
+    ส่ง force_fresh=1 เพื่อบังคับวิเคราะห์ใหม่; ส่ง ``scan_key`` ไปกับ /scan/save
+    ส่ง ``image_key`` (จากผลครั้งก่อน) แทนรูป + ค่า PipeConfig ใหม่ เพื่อวิเคราะห์ซ้ำ
+    โดยคำนวณใหม่เฉพาะ stage ที่ได้รับผลจากค่าที่เปลี่ยน
+    ส่ง overlay=1 ถ้าต้องการภาพ overlay ขนาด preview (``overlay_png_b64``)
+    """
+    params = request.form if request.files else (request.get_json(silent=True) or {})
+    image_key = params.get("image_key")
+    overlay = _to_bool(params.get("overlay"), False)
+
+    if image_key and "file" not in request.files and not params.get("image_b64"):
+        if _STAGE_CACHE is None:
+            return jsonify({"error": "re-analysis by image_key is disabled (STAGE_CACHE_MB=0)"}), 400
+        t0 = time.perf_counter()
+        cfg, quality = _QUALITY.apply(_pipe_config(params))
+        out = _with_quality(analyze(None, outdir=_debug_outdir(), Cfg=cfg, cache=_STAGE_CACHE,
+                                    image_key=str(image_key), overlay=overlay), quality, t0)
+    else:
+        img, err = _decode_request_image(request)
+        if err:
+            return err
+        out = _analyze_or_reuse(_get_uid(request), img, _pipe_config(params),
+                                _to_bool(params.get("force_fresh"), False), overlay)
 
     if isinstance(out, dict) and out.get("error"):
+        if out["error"] == "Unknown or expired image_key.":
+            return jsonify(out), 410
         return jsonify(out), 422
 
     return jsonify(out), 200
 
 
+# ---------- async analyze jobs (process pool) ----------
+_ANALYZE_JOB_DB = os.getenv("ANALYZE_JOB_DB")  # path ของ sqlite ถ้าต้องการเก็บผลข้าม restart
+# ภาพที่ decode แล้วส่งให้ worker ผ่าน shared memory แทน pickle (0 = ส่ง bytes แบบเดิม)
+_ANALYZE_SHM_MB = int(os.getenv("ANALYZE_SHM_MB", "256"))
+_ANALYZE_JOBS = None if _ANALYZE_POOL is None else AnalyzeJobs(
+    workers=_ANALYZE_WORKERS,
+    max_pending=int(os.getenv("ANALYZE_MAX_PENDING", "32")),
+    timeout=float(os.getenv("ANALYZE_JOB_TIMEOUT_SEC", "60")),
+    kill_after=_to_float(os.getenv("ANALYZE_JOB_KILL_AFTER_SEC")),
+    result_ttl=float(os.getenv("ANALYZE_JOB_TTL_SEC", "600")),
+    store=SqliteJobStore(_ANALYZE_JOB_DB) if _ANALYZE_JOB_DB else MemoryJobStore(),
+    start_method=os.getenv("ANALYZE_MP_START") or None,
+    pool=_ANALYZE_POOL,
+    outdir=DEBUG_OUT_DIR,
+    debug_sample=DEBUG_SAMPLE_RATE,
+    transport=SegmentPool(_ANALYZE_SHM_MB * 1024 * 1024,
+                          leak_after=float(os.getenv("ANALYZE_JOB_TTL_SEC", "600"))) if _ANALYZE_SHM_MB > 0 else None,
+)
+
+
+# ลดคุณภาพ pipeline ตามโหลด (คิว analyze + p95 เวลาวิเคราะห์) แล้วค่อยๆ กลับเมื่อโหลดลด
+_QUALITY = QualityController(
+    depth_fn=lambda: _GATES["analyze"].queue_depth() + (
+        max(0, _ANALYZE_JOBS.depth() - _ANALYZE_JOBS.workers) if _ANALYZE_JOBS else 0),
+    target_p95=float(os.getenv("QUALITY_TARGET_P95_SEC", "4")),
+    queue_high=int(os.getenv("QUALITY_QUEUE_HIGH", "4")),
+    step_up_after=float(os.getenv("QUALITY_STEP_UP_SEC", "15")),
+    enabled=_to_bool(os.getenv("QUALITY_ADAPTIVE"), True),
+)
+
+
+def _jobs_disabled():
+    return jsonify({"error": "analyze jobs are disabled (set ANALYZE_WORKERS)"}), 404
+
+
+@app.post("/analyze/jobs")
+@_admit("analyze")
+def analyze_job_submit():
+    """
+    รับภาพแบบเดียวกับ /analyze แต่คืน job_id ทันที (202) แล้วให้ poll ที่ /analyze/jobs/<id>
+    ผ่าน gate "analyze" เหมือน /analyze (decode ภาพเกิดใน request นี้ และ worker แย่ง CPU เดียวกัน)
+    raw_masks=1: worker ไม่ encode PNG/RLE แต่เขียน mask ลง shared memory ให้อ่านที่ /analyze/jobs/<id>/masks
+    """
+    if _ANALYZE_JOBS is None:
+        return _jobs_disabled()
+    raw, err = _request_image_bytes(request)
+    if err:
+        return err
+    raw_masks = _to_bool(request.form.get("raw_masks"), False)
+    params = {**request.form, "include_masks": "0"} if raw_masks else request.form
+    cfg, quality = _QUALITY.apply(_pipe_config(params))
+    try:
+        job_id = _ANALYZE_JOBS.submit(raw, cfg, raw_masks=raw_masks)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except JobQueueFull:
+        resp = jsonify({"error": "busy", "detail": "analyze queue is full"})
+        resp.headers["Retry-After"] = "2"
+        return resp, 503
+    return jsonify({"job_id": job_id, "status": "queued", "quality": quality}), 202
+
+
+@app.get("/analyze/jobs/<job_id>")
+def analyze_job_get(job_id):
+    """?wait=N long-poll สูงสุด N วินาที (ไม่เกิน 30) จนกว่างานจะเสร็จ"""
+    if _ANALYZE_JOBS is None:
+        return _jobs_disabled()
+    wait = min(max(_to_float(request.args.get("wait"), 0.0), 0.0), 30.0)
+    job = _ANALYZE_JOBS.get(job_id, wait=wait)
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+    job.pop("deadline", None)
+    if (job.get("result") or {}).get("masks_shm"):
+        # ตำแหน่งใน shared memory เป็นเรื่องภายใน: บอกแค่ว่ามี mask ให้อ่าน
+        job["result"] = {**{k: v for k, v in job["result"].items() if k != "masks_shm"}, "raw_masks": True}
+    return jsonify(job), 200
+
+
+def _mask_png_b64(mask) -> str:
+    ok, buf = cv2.imencode(".png", mask)
+    return base64.b64encode(buf.tobytes()).decode("ascii") if ok else ""
+
+
+@app.get("/analyze/jobs/<job_id>/masks")
+def analyze_job_masks(job_id):
+    """
+    ROI masks ของงานที่ส่งมาพร้อม raw_masks=1: อ่านจาก shared memory แล้ว encode PNG ที่ฝั่งนี้
+    (ไม่ผ่าน pickle ของ worker) — อ่านได้ครั้งเดียว segment ถูกคืนหลังอ่าน
+    """
+    if _ANALYZE_JOBS is None:
+        return _jobs_disabled()
+    masks = _ANALYZE_JOBS.masks(job_id)
+    if masks is None:
+        return jsonify({"error": "masks not available (unknown job, not finished, not raw_masks, or already read)"}), 404
+    return jsonify({f"{name}_png_b64": _mask_png_b64(m) for name, m in masks.items()}), 200
+
+
+@app.delete("/analyze/jobs/<job_id>")
+def analyze_job_cancel(job_id):
+    if _ANALYZE_JOBS is None:
+        return _jobs_disabled()
+    job = _ANALYZE_JOBS.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify({"job_id": job_id, "status": job["status"]}), 200
+
+
+# ผลวิเคราะห์ส่วนที่ใหญ่ (PNG/base64/RLE) ไม่เก็บลง Firestore และ scan index
+_BIG_KEYS = (
+    "roi_skeleton_png_b64", "roi_binary_png_b64", "roi_gray_png_b64",
+    "full_image_b64", "image_b64", "mask_b64", "overlay_png_b64", "roi_binary_rle",
+)
+
+
+# ข้อมูลเฉพาะ response ของ /analyze ไม่ต้องเก็บลง scan
+_TRANSIENT_KEYS = ("scan_key", "duplicate_of", "image_key", "stages_recomputed")
+
+
+def _slim_result(analyze_result: dict) -> dict:
+    return {k: v for k, v in analyze_result.items() if k not in _BIG_KEYS and k not in _TRANSIENT_KEYS}
+
+
+def _scan_stats_ref(user_id: str):
+    return db.collection("users").document(user_id).collection("stats").document("scans")
+
+
+# user ที่เอกสาร stats ถูก backfill แล้ว (ส่ง Increment ได้ทันที)
+_SCAN_STATS_READY = TTLCache(
+    maxsize=int(os.getenv("KNOWN_USER_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("KNOWN_USER_TTL_SEC", "3600")),
+)
+# user ที่ backfill กำลังรัน (หรือล้มเหลว รอรันใหม่) ใน _IO_POOL: [future, {scan_id: summary} ที่รอ Increment]
+_SCAN_STATS_BACKFILLS: dict = {}
+_SCAN_STATS_LOCK = threading.Lock()
+
+
+def _scan_stats_backfill(user_id: str, scan_id: str | None = None, summary: dict | None = None) -> Future | None:
+    """
+    Start (or join) the background backfill of the user's aggregate document.
+    ``scan_id``/``summary`` is a scan about to be queued: it is left out of the
+    backfill and its Increment is queued once the backfill has committed, so it
+    is counted exactly once. Returns None if the user is already backfilled.
+    """
+    with _SCAN_STATS_LOCK:
+        if _SCAN_STATS_READY.get(user_id):
+            return None
+        entry = _SCAN_STATS_BACKFILLS.setdefault(user_id, [None, {}])
+        if entry[0] is None or entry[0].done():
+            entry[0] = _IO_POOL.submit(_run_scan_stats_backfill, user_id)
+        if scan_id is not None:
+            entry[1][scan_id] = summary
+        return entry[0]
+
+
+def _run_scan_stats_backfill(user_id: str) -> dict:
+    ref = _scan_stats_ref(user_id)
+
+    def skip():
+        with _SCAN_STATS_LOCK:
+            return set(_SCAN_STATS_BACKFILLS[user_id][1])
+
+    try:
+        doc = _backfill_scan_stats(user_id, ref, skip)
+    except Exception:
+        # scan ที่รอ Increment ยังอยู่ใน entry: save/stats ครั้งถัดไปของ user จะรัน backfill ใหม่
+        log.exception("scan stats backfill failed", extra={"user_id": user_id})
+        raise
+    with _SCAN_STATS_LOCK:
+        _, waiting = _SCAN_STATS_BACKFILLS.pop(user_id)
+        _SCAN_STATS_READY.set(user_id, True)
+    for summary in waiting.values():
+        _WRITES.set(ref, scan_stats.increments(summary), merge=True)
+    return doc
+
+
+def _ensure_scan_stats(user_id: str) -> dict:
+    """Return the user's aggregate document, waiting for the backfill if it has not run yet."""
+    snap = _scan_stats_ref(user_id).get()
+    doc = (snap.to_dict() if snap.exists else None) or {}
+    if doc.get("backfilled") and user_id not in _SCAN_STATS_BACKFILLS:
+        _SCAN_STATS_READY.set(user_id, True)
+        return doc
+    pending = _scan_stats_backfill(user_id)
+    return pending.result() if pending is not None else doc
+
+
+def _save_scan(user_id: str, analyze_result: dict, meta: dict):
+    """
+    Queue a users/{user_id}/scans document and fold its summary into the
+    user's scan aggregates; returns ``(scan_id, summary)``.
+    """
+    summary = _summarize_analyze(_slim_result(analyze_result))
+    doc = {
+        "user_id": user_id,
+        "summary": summary,
+        "meta": meta,
+        "createdAt": firestore.SERVER_TIMESTAMP,
+    }
+
+    ref = db.collection("users").document(user_id).collection("scans").document()
+    # ยังไม่ backfill: ฝาก Increment ไว้กับ backfill ที่รันเบื้องหลัง (ก่อนเขียน scan จะได้ไม่ถูกนับซ้ำ)
+    deferred = not _SCAN_STATS_READY.get(user_id) and _scan_stats_backfill(user_id, ref.id, summary) is not None
+    _WRITES.set(ref, doc)
+    if not deferred:
+        _WRITES.set(_scan_stats_ref(user_id), scan_stats.increments(summary), merge=True)
+    return ref.id, summary
+
+
 @app.post("/scan/save")
 def scan_save():
     try:
@@ -374,62 +1066,206 @@ def scan_save():
 
         user_id = _ensure_user_doc(user_id)
 
-        big_keys = [
-            "roi_skeleton_png_b64", "roi_binary_png_b64", "roi_gray_png_b64",
-            "full_image_b64", "image_b64", "mask_b64",
-        ]
-        slim_result = {k: v for k, v in analyze_result.items() if k not in big_keys}
-
-        doc = {
-            "user_id": user_id,
-            "summary": _summarize_analyze(slim_result),
-            "meta": meta,
-            "createdAt": firestore.SERVER_TIMESTAMP,
-        }
+        # scan_key จาก /analyze: ถ้า scan นี้ (หรือรูปซ้ำของมัน) ถูกบันทึกแล้วคืน id เดิม
+        scan_key = data.get("scan_key") or analyze_result.get("scan_key")
+        entry = _SCAN_INDEX.lookup(scan_key, user_id) if scan_key else None
+        if entry and entry["scan_id"]:
+            return jsonify({"id": entry["scan_id"], "duplicate": True}), 200
 
-        ref = (
-            db.collection("users")
-              .document(user_id)
-              .collection("scans")
-              .add(doc)
-        )
-        return jsonify({"id": ref[1].id}), 201
+        scan_id, _ = _save_scan(user_id, analyze_result, meta)
+        if entry:
+            _SCAN_INDEX.link(scan_key, user_id, scan_id)
+        return jsonify({"id": scan_id}), 201
 
     except Exception as e:
-        import traceback; traceback.print_exc()
+        log.exception("scan save failed")
         return jsonify({"error": f"save_failed: {e.__class__.__name__}: {str(e)}"}), 500
 
 
+# ---------- paginated listing (cursor = createdAt + doc id) ----------
+LIST_MAX_LIMIT = int(os.getenv("LIST_MAX_LIMIT", "100"))
+_FIELD_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$")
+
+# /fortune/list ไม่ส่ง raw (response เต็มของ DeepSeek) เว้นแต่ขอ
+FORTUNE_LIST_FIELDS = [
+    "user_id", "scan_id", "summary", "model", "language", "style", "period",
+    "period_text", "user_profile_used", "answer", "createdAt",
+]
+
+
+def _encode_cursor(created_at, doc_id: str) -> str:
+    raw = json.dumps({"t": created_at.isoformat(), "id": doc_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> dict:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        return {"createdAt": datetime.fromisoformat(raw["t"]), "__name__": str(raw["id"])}
+    except Exception:
+        raise ValueError("invalid cursor")
+
+
+def _parse_fields(value) -> list[str] | None:
+    if not value:
+        return None
+    fields = [f.strip() for f in value.split(",") if f.strip() and f.strip() != "id"]
+    for f in fields:
+        if not _FIELD_RE.match(f):
+            raise ValueError(f"invalid field '{f}'")
+    if "createdAt" not in fields:
+        fields.append("createdAt")  # ต้องใช้สร้าง cursor
+    return fields
+
+
+def _list_user_docs(user_id: str, collection: str, limit: int,
+                    cursor: str | None = None, fields: list[str] | None = None):
+    """
+    One page of ``users/{user_id}/{collection}`` ordered by ``createdAt`` desc.
+    Returns ``(items, next_cursor)``; ``next_cursor`` is None on the last page.
+    """
+    limit = max(1, min(int(limit), LIST_MAX_LIMIT))
+    q = (
+        db.collection("users")
+          .document(user_id)
+          .collection(collection)
+          .order_by("createdAt", direction=firestore.Query.DESCENDING)
+          .order_by("__name__", direction=firestore.Query.DESCENDING)
+    )
+    if fields:
+        q = q.select(fields)
+    if cursor:
+        q = q.start_after(_decode_cursor(cursor))
+    q = q.limit(limit)
+
+    items, last = [], None
+    for d in q.stream():
+        obj = d.to_dict() or {}
+        obj["id"] = d.id
+        items.append(obj)
+        last = (obj.get("createdAt"), d.id)
+
+    next_cursor = None
+    if len(items) == limit and last and last[0] is not None:
+        next_cursor = _encode_cursor(*last)
+    return items, next_cursor
+
+
+def _list_response(items: list, next_cursor: str | None):
+    """
+    Bare array of items, as /scan/list has always returned, with the cursor of
+    the next page in ``X-Next-Cursor``; ``paged=1`` returns
+    ``{"items": [...], "next_cursor": ...}`` instead.
+    """
+    if _to_bool(request.args.get("paged"), False):
+        return jsonify({"items": items, "next_cursor": next_cursor}), 200
+    resp = jsonify(items)
+    if next_cursor:
+        resp.headers["X-Next-Cursor"] = next_cursor
+    return resp, 200
+
+
 @app.get("/scan/list")
 def scan_list():
+    """
+    Query: limit (default 20), cursor (next_cursor ของหน้าก่อน), fields=a,b,c (Firestore select)
+    คืน {"items": [...], "next_cursor": str|null}
+    """
     try:
         limit = int(request.args.get("limit", 20))
+        fields = _parse_fields(request.args.get("fields"))
         # allow override via query for dev, else use token
         q_uid = (request.args.get("user_id") or "").strip()
         user_id = q_uid or _get_uid(request)
 
         user_id = _ensure_user_doc(user_id)
 
-        q = (
-            db.collection("users")
-              .document(user_id)
-              .collection("scans")
-              .order_by("createdAt", direction=firestore.Query.DESCENDING)
-              .limit(limit)
+        items, next_cursor = _list_user_docs(
+            user_id, "scans", limit, request.args.get("cursor"), fields,
         )
+        return _list_response(items, next_cursor)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        log.exception("scan list failed")
+        return jsonify({"error": f"list_failed: {e.__class__.__name__}: {str(e)}"}), 500
+
+
+@app.get("/scan/stats")
+def scan_stats_get():
+    """
+    สถิติรวมของ scan ทั้งหมดของ user จากเอกสารเดียว (users/{uid}/stats/scans):
+    count, mean/variance ของ length_px/thickness_px และสัดส่วน branch_style ต่อเส้น
+    """
+    try:
+        q_uid = (request.args.get("user_id") or "").strip()
+        user_id = _ensure_user_doc(q_uid or _get_uid(request))
 
-        items = []
-        for d in q.stream():
-            obj = d.to_dict()
-            obj["id"] = d.id
-            items.append(obj)
-        return jsonify(items), 200
+        return jsonify(scan_stats.describe(_ensure_scan_stats(user_id))), 200
     except Exception as e:
-        import traceback; traceback.print_exc()
+        log.exception("scan stats failed")
+        return jsonify({"error": f"stats_failed: {e.__class__.__name__}: {str(e)}"}), 500
+
+
+def _backfill_scan_stats(user_id: str, ref, skip=lambda: ()) -> dict:
+    """
+    สร้าง aggregate จาก scan ที่บันทึกไว้ก่อนมีเอกสาร stats (อ่านทั้ง collection ครั้งเดียว)
+    ทำใน transaction: ถ้ามี server อื่น backfill ไปก่อน จะใช้ของเดิมแทนการเขียนทับ
+    ``skip()`` คืน id ของ scan ที่จะได้ Increment แยกเอง (อ่านหลังดึง scan ครบแล้ว)
+    """
+    scans = db.collection("users").document(user_id).collection("scans")
+
+    def run(transaction):
+        snap = ref.get(transaction=transaction)
+        current = (snap.to_dict() if snap.exists else None) or {}
+        if current.get("backfilled"):
+            return current, False
+        doc = {}
+        rows = list(transaction.get(scans.select(["summary"])))
+        skipped = skip()
+        for scan in rows:
+            if scan.id not in skipped:
+                scan_stats.accumulate(doc, (scan.to_dict() or {}).get("summary") or {})
+        doc.update(backfilled=True, updatedAt=datetime.now(timezone.utc))
+        transaction.set(ref, doc)
+        return doc, True
+
+    doc, written = _run_transaction(run)
+    if written:
+        log.info("scan stats backfilled", extra={"user_id": user_id, "scans": doc.get("count", 0)})
+    return doc
+
+
+@app.get("/fortune/list")
+def fortune_list():
+    """
+    Paginated users/{uid}/fortunes แบบเดียวกับ /scan/list
+    ไม่รวม raw ยกเว้นส่ง include_raw=1 หรือระบุ fields เอง
+    """
+    try:
+        limit = int(request.args.get("limit", 20))
+        fields = _parse_fields(request.args.get("fields"))
+        if fields is None and not _to_bool(request.args.get("include_raw"), False):
+            fields = FORTUNE_LIST_FIELDS
+        q_uid = (request.args.get("user_id") or "").strip()
+        user_id = q_uid or _get_uid(request)
+
+        user_id = _ensure_user_doc(user_id)
+
+        items, next_cursor = _list_user_docs(
+            user_id, "fortunes", limit, request.args.get("cursor"), fields,
+        )
+        return _list_response(items, next_cursor)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        log.exception("fortune list failed")
         return jsonify({"error": f"list_failed: {e.__class__.__name__}: {str(e)}"}), 500
 
 
 @app.post("/ai/chat")
+@_admit("llm")
 def ai_chat():
     if not DEEPSEEK_KEY:
         return jsonify({"error": "DEEPSEEK_API_KEY is missing"}), 500
@@ -445,60 +1281,267 @@ def ai_chat():
 
     user_id = _ensure_user_doc(user_id)
 
+    payload = {"model": model, "messages": messages, "stream": stream}
+    if stream:
+        payload["stream_options"] = {"include_usage": True}
+
     try:
-        r = _HTTP.post(
-            f"{DEEPSEEK_BASE}/chat/completions",
-            headers={
-                "Authorization": f"Bearer {DEEPSEEK_KEY}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "model": model,
-                "messages": messages,
-                "stream": stream
-            },
-            timeout=_get_timeout(),
+        if stream:
+            r = _deepseek_stream(payload)
+        else:
+            resp = _deepseek_complete(payload, "chat")
+    except _DeepSeekError as e:
+        return jsonify(e.body), e.status
+
+    def save_chat(resp):
+        completion = (resp.get("choices") or [{}])[0].get("message", {})
+        doc = {
+            "user_id": user_id,
+            "provider": "deepseek",
+            "model": model,
+            "prompt_last": messages[-1] if messages else None,
+            "answer": completion,
+            "raw": resp,
+            "createdAt": firestore.SERVER_TIMESTAMP,
+        }
+        ref = _WRITES.add(
+            db.collection("users").document(user_id).collection("ai_chats"),
+            doc,
         )
-    except requests.exceptions.ReadTimeout:
-        return jsonify({"error": "deepseek_timeout", "detail": "DeepSeek read timed out"}), 504
-    except requests.RequestException as e:
-        return jsonify({"error": "request_failed", "detail": str(e)}), 502
+        return ref.id
 
-    if not r.ok:
-        try:
-            return jsonify(r.json()), r.status_code
-        except Exception:
-            return jsonify({"error": r.text}), r.status_code
-
-    resp = r.json()
+    if stream:
+        def on_done(resp):
+            answer = (resp["choices"][0].get("message") or {}).get("content", "")
+            return {"saved_id": save_chat(resp) if do_save else None, "answer": answer}
+        return _sse_response(_relay_deepseek_stream(r, on_done, "chat"))
 
     saved_id = None
     if do_save:
         try:
-            completion = (resp.get("choices") or [{}])[0].get("message", {})
-            doc = {
-                "user_id": user_id,
-                "provider": "deepseek",
-                "model": model,
-                "prompt_last": messages[-1] if messages else None,
-                "answer": completion,
-                "raw": resp,
-                "createdAt": firestore.SERVER_TIMESTAMP,
-            }
-            ref = (
-                db.collection("users")
-                  .document(user_id)
-                  .collection("ai_chats")
-                  .add(doc)
-            )
-            saved_id = ref[1].id
+            saved_id = save_chat(resp)
         except Exception as e:
             resp["_save_error"] = str(e)
 
     return jsonify({"data": resp, "saved_id": saved_id}), 200
 
 
+# ---------- fortune prediction ----------
+_PERIODS = ("today", "week", "month")
+
+# (th, en)
+_PERIOD_TEXT = {
+    "today": ("ภายในวันนี้", "today"),
+    "week": ("ภายใน 7 วันข้างหน้า", "within the next 7 days"),
+    "month": ("ภายในเดือนนี้", "within this month"),
+}
+
+
+def _fortune_options(data) -> dict:
+    period = (data.get("period") or "today").lower()
+    if period not in _PERIODS:
+        period = "today"
+    # "periods": ["today", "week", "month"] หรือ "all" => ทำนายหลายช่วงใน call เดียว
+    periods = data.get("periods")
+    if periods == "all":
+        periods = list(_PERIODS)
+    elif isinstance(periods, str):
+        periods = periods.split(",")
+    periods = [p for p in _PERIODS if p in {str(x).strip().lower() for x in (periods or [])}]
+    return {
+        "model": data.get("model") or "deepseek-chat",
+        "language": (data.get("language") or "th").lower(),
+        "style": (data.get("style") or "friendly").lower(),
+        "period": period,
+        "periods": periods or [period],
+        "stream": _to_bool(data.get("stream"), False),
+        "force_refresh": _to_bool(data.get("force_refresh"), False),
+    }
+
+
+def _build_fortune_messages(summary: dict, safe_profile: dict, language: str,
+                            style: str, period: str):
+    """Return ``(messages, period_text)`` for one fortune request."""
+    period_text_th, period_text_en = _PERIOD_TEXT[period]
+    # คำสั่งยาวคงที่อยู่ใน system (prefix เดิมทุก request) ข้อมูลผู้ใช้อยู่ท้ายสุด
+    lang = "th" if language == "th" else "en"
+    messages = prompts.FORTUNE[lang].render(
+        **prompts.fortune_values(summary, safe_profile, style),
+        period_text=period_text_th if lang == "th" else period_text_en,
+    )
+    return messages, {"th": period_text_th, "en": period_text_en}
+
+
+def _build_multi_fortune_messages(summary: dict, safe_profile: dict, language: str,
+                                  style: str, periods: list):
+    """Like ``_build_fortune_messages`` but asks for every period in one JSON object."""
+    lang = "th" if language == "th" else "en"
+    idx = 0 if lang == "th" else 1
+    return prompts.FORTUNE_MULTI[lang].render(
+        **prompts.fortune_values(summary, safe_profile, style),
+        frames="\n".join(f"- {p}: {_PERIOD_TEXT[p][idx]}" for p in periods),
+    )
+
+
+_FORTUNE_FLIGHTS = SingleFlight("fortune")
+
+
+def _predict_fortune(user_id: str, scan_id, summary: dict, safe_profile: dict, opts: dict):
+    """
+    Run (or reuse from cache) one fortune prediction.
+
+    Returns the result dict ``{"fortune_id", "answer"}`` (plus ``"cached": True``
+    on a cache hit), or when ``opts["stream"]`` a generator of SSE frames that
+    ends with a ``done`` event carrying that dict.
+    Raises ``_DeepSeekError`` when the upstream call fails before streaming starts.
+    """
+    model, language, style, period = opts["model"], opts["language"], opts["style"], opts["period"]
+    stream = opts["stream"]
+
+    cache_key = fortune_key(user_id, summary, safe_profile, model, language, style, period)
+    if not opts["force_refresh"]:
+        cached = _FORTUNE_CACHE.get(cache_key)
+        if cached:
+            result = {**cached, "cached": True}
+            if stream:
+                return iter([
+                    _sse({"content": result["answer"]}, event="delta"),
+                    _sse(result, event="done"),
+                ])
+            return result
+
+    messages, period_text = _build_fortune_messages(summary, safe_profile, language, style, period)
+    payload = {"model": model, "messages": messages, "stream": stream}
+    if stream:
+        payload["stream_options"] = {"include_usage": True}
+
+    def save_fortune(resp):
+        answer = (resp.get("choices") or [{}])[0].get("message", {}).get("content", "")
+        doc = {
+            "user_id": user_id,
+            "scan_id": scan_id,
+            "summary": summary,
+            "model": model,
+            "language": language,
+            "style": style,
+            "period": period,
+            "period_text": period_text,
+            "user_profile_used": safe_profile,
+            "answer": answer,
+            "raw": resp,
+            "createdAt": firestore.SERVER_TIMESTAMP,
+        }
+
+        ref = _WRITES.add(
+            db.collection("users").document(user_id).collection("fortunes"),
+            doc,
+        )
+        result = {"fortune_id": ref.id, "answer": answer}
+        _FORTUNE_CACHE.set(
+            cache_key, result,
+            ttl=seconds_until_period_end(period, safe_profile.get("timezone")),
+        )
+        return result
+
+    if stream:
+        # บันทึก Firestore หลัง stream จบ แล้วส่ง fortune_id ใน event "done"
+        return _relay_deepseek_stream(_deepseek_stream(payload), save_fortune, "fortune")
+    # request เดียวกันที่มาซ้อนกันได้ fortune_id เดียวกัน (บันทึกครั้งเดียว)
+    result, _ = _FORTUNE_FLIGHTS.do(cache_key, lambda: save_fortune(_deepseek_complete(payload, "fortune")))
+    return result
+
+
+def _predict_fortunes(user_id: str, scan_id, summary: dict, safe_profile: dict, opts: dict):
+    """
+    Fortunes for every period in ``opts["periods"]``: cached periods are reused,
+    the rest come from one structured (JSON) DeepSeek call and are saved as one
+    fortune document per period. Returns ``{"fortunes": {period: result}}``.
+    """
+    model, language, style = opts["model"], opts["language"], opts["style"]
+    tz = safe_profile.get("timezone")
+    keys = {p: fortune_key(user_id, summary, safe_profile, model, language, style, p)
+            for p in opts["periods"]}
+
+    fortunes, missing = {}, []
+    for p in opts["periods"]:
+        cached = None if opts["force_refresh"] else _FORTUNE_CACHE.get(keys[p])
+        if cached:
+            fortunes[p] = {**cached, "cached": True}
+        else:
+            missing.append(p)
+
+    if len(missing) == 1:
+        fortunes[missing[0]] = _predict_fortune(
+            user_id, scan_id, summary, safe_profile,
+            {**opts, "period": missing[0], "stream": False, "force_refresh": True},
+        )
+    elif missing:
+        def generate():
+            messages = _build_multi_fortune_messages(summary, safe_profile, language, style, missing)
+            resp = _deepseek_complete({
+                "model": model, "messages": messages, "stream": False,
+                "response_format": {"type": "json_object"},
+            }, "fortune_multi")
+            content = (resp.get("choices") or [{}])[0].get("message", {}).get("content", "")
+            try:
+                answers = json.loads(content)
+            except ValueError:
+                answers = None
+            if not isinstance(answers, dict) or not all(isinstance(answers.get(p), str) for p in missing):
+                raise _DeepSeekError({"error": "invalid_model_output",
+                                      "detail": "expected a JSON object with one answer per period"}, 502)
+
+            out = {}
+            for p in missing:
+                th, en = _PERIOD_TEXT[p]
+                ref = _WRITES.add(
+                    db.collection("users").document(user_id).collection("fortunes"),
+                    {
+                        "user_id": user_id,
+                        "scan_id": scan_id,
+                        "summary": summary,
+                        "model": model,
+                        "language": language,
+                        "style": style,
+                        "period": p,
+                        "period_text": {"th": th, "en": en},
+                        "user_profile_used": safe_profile,
+                        "answer": answers[p],
+                        "batch_periods": missing,
+                        "raw": resp,
+                        "createdAt": firestore.SERVER_TIMESTAMP,
+                    },
+                )
+                out[p] = {"fortune_id": ref.id, "answer": answers[p]}
+                _FORTUNE_CACHE.set(keys[p], out[p], ttl=seconds_until_period_end(p, tz))
+            return out
+
+        generated, _ = _FORTUNE_FLIGHTS.do("|".join(keys[p] for p in missing), generate)
+        fortunes.update(generated)
+
+    return {"fortunes": {p: fortunes[p] for p in opts["periods"]}}
+
+
+def _load_scan_summary(user_id: str, scan_id: str) -> dict | None:
+    """Summary of users/{user_id}/scans/{scan_id}; None if the scan does not exist."""
+    scan_ref = (
+        db.collection("users")
+          .document(user_id)
+          .collection("scans")
+          .document(scan_id)
+    )
+    # scan ที่เพิ่ง save อาจยังอยู่ในคิวเขียน (ยังไม่ถึง Firestore)
+    queued = _WRITES.pending(scan_ref.path)
+    if queued is not None:
+        return queued.get("summary") or {}
+    d = scan_ref.get()
+    if not d.exists:
+        return None
+    return d.to_dict().get("summary") or {}
+
+
 @app.post("/fortune/predict")
+@_admit("llm")
 def fortune_predict():
     """
     ใช้สรุปเส้นลายมือ + โปรไฟล์ผู้ใช้ (ถ้ามี) เพื่อทำนาย 4 หัวข้อ:
@@ -506,7 +1549,11 @@ def fortune_predict():
     - การงาน (Career)
     - การเงิน (Finance)
     - สุขภาพ (Health)
-    ครอบคลุมช่วงเวลา period: week|month (default=month)
+    ครอบคลุมช่วงเวลา period: today|week|month (default=today)
+    ส่ง "periods": ["today", "week", "month"] (หรือ "all") เพื่อทำนายหลายช่วงใน DeepSeek call เดียว
+    => {"fortunes": {period: {"fortune_id", "answer"}}} (บันทึกแยกเอกสารต่อ period)
+    ส่ง "stream": true เพื่อรับคำตอบแบบ SSE (event: delta ... event: done)
+    คำตอบถูก cache จนหมดช่วง period (ตาม timezone ผู้ใช้) ส่ง "force_refresh": true เพื่อขอใหม่
     """
     if not DEEPSEEK_KEY:
         return jsonify({"error": "DEEPSEEK_API_KEY is missing"}), 500
@@ -517,152 +1564,128 @@ def fortune_predict():
     scan_id = data.get("scan_id")
     summary = data.get("summary")
     user_id = _get_uid(request)
-    model = data.get("model") or "deepseek-chat"
-    language = (data.get("language") or "th").lower()
-    style = (data.get("style") or "friendly").lower()
-    period = (data.get("period") or "today").lower()
-
-    if period not in ("today", "week", "month"):
-        period = "today"
+    opts = _fortune_options(data)
 
     user_id = _ensure_user_doc(user_id)
 
-    # fetch user profile for context
-    user_profile = _fetch_user_profile(user_id)
-    safe_profile = _build_safe_profile(user_profile)
+    # fetch user profile for context (อ่านคู่ขนานกับ scan ด้านล่าง)
+    profile_future = _prefetch_safe_profile(user_id, refresh=opts["force_refresh"])
     # ตัวอย่างฟิลด์ที่คาดหวัง: displayName, dob (YYYY-MM-DD), gender, locale, timezone, interests ฯลฯ
 
     if not summary and scan_id:
-        d = (
-            db.collection("users")
-              .document(user_id)
-              .collection("scans")
-              .document(scan_id)
-              .get()
-        )
-        if not d.exists:
+        summary = _load_scan_summary(user_id, scan_id)
+        if summary is None:
             return jsonify({"error": f"scan_id '{scan_id}' not found for user '{user_id}'"}), 404
-        summary = d.to_dict().get("summary") or {}
 
     if not isinstance(summary, dict) or not summary:
         return jsonify({"error": "summary is required (either via scan_id or in body)"}), 400
 
-    # ---------- Build prompts ----------
-    sys_th = (
-        "คุณคือผู้ช่วยโหราศาสตร์ลายมือ เชี่ยวชาญการอ่านเส้นชีวิต/เส้นสมอง/เส้นหัวใจ "
-        "ตอบอย่างระมัดระวัง ไม่อ้างอิงเรื่องรักษาโรคหรือการเงินแบบชี้นำลงทุน "
-        "ให้คำแนะนำเชิงบวก นำไปใช้ได้จริง และเคารพความเป็นส่วนตัวของผู้ใช้"
-    )
-    sys_en = (
-        "You are a palmistry assistant who reads life/head/heart lines carefully, "
-        "avoids medical or investment directives, and gives practical, positive, privacy-respecting guidance."
-    )
-    system_prompt = sys_th if language == "th" else sys_en
+    safe_profile = profile_future.result()
 
-    def line_desc(name):
-        d = (summary.get(name) or {})
-        return f"{name}: length_px={d.get('length_px')}, branch_style={d.get('branch_style')}"
+    if len(opts["periods"]) > 1:
+        if opts["stream"]:
+            return jsonify({"error": "stream is not supported with multiple periods"}), 400
+        try:
+            out = _predict_fortunes(user_id, scan_id, summary, safe_profile, opts)
+        except _DeepSeekError as e:
+            return jsonify(e.body), e.status
+        all_cached = all(f.get("cached") for f in out["fortunes"].values())
+        return jsonify(out), 200 if all_cached else 201
 
-    # Embed user profile (safe fields only) and set time-frame copy
+    try:
+        out = _predict_fortune(user_id, scan_id, summary, safe_profile, opts)
+    except _DeepSeekError as e:
+        return jsonify(e.body), e.status
 
-    if period == "today":
-        period_text_th = "ภายในวันนี้"
-        period_text_en = "today"
-    elif period == "week":
-        period_text_th = "ภายใน 7 วันข้างหน้า"
-        period_text_en = "within the next 7 days"
-    else:
-        period_text_th = "ภายในเดือนนี้"
-        period_text_en = "within this month"
-
-    if language == "th":
-        user_prompt = (
-            "ช่วยทำนายจากลายมือ โดยยึดข้อมูลภาพรวมและโปรไฟล์ดังนี้\n"
-            f"- {line_desc('life')}\n- {line_desc('head')}\n- {line_desc('heart')}\n"
-            f"ขนาดภาพ: {summary.get('image_w')}x{summary.get('image_h')}, roi={summary.get('roi')}\n"
-            f"ข้อมูลผู้ใช้ (ถ้ามี): {safe_profile}\n\n"
-            f"กรอบเวลา: {period_text_th}\n"
-            "รูปแบบคำตอบเป็นหัวข้อย่อย 4 หมวด และสั้นกระชับใช้งานได้จริง:\n"
-            "1) ความรัก\n2) การงาน\n3) การเงิน\n4) สุขภาพ\n\n"
-            "เพิ่ม: คำแนะนำปฏิบัติ 3-5 ข้อ และข้อควรระวัง 1-2 ข้อ\n"
-            f"โทน: {'เป็นกันเอง' if style=='friendly' else 'เป็นทางการ'}\n"
-            "ห้ามกล่าวอ้างการรักษาโรคหรือรับประกันผลลัพธ์ ทางการแพทย์/การเงิน และให้กำลังใจอย่างเหมาะสม"
-        )
-    else:
-        user_prompt = (
-            "Please read the palm using the following summary and user profile context:\n"
-            f"- {line_desc('life')}\n- {line_desc('head')}\n- {line_desc('heart')}\n"
-            f"image: {summary.get('image_w')}x{summary.get('image_h')}, roi={summary.get('roi')}\n"
-            f"user profile (if any): {safe_profile}\n\n"
-            f"Time frame: {period_text_en}\n"
-            "Return concise, actionable sections:\n"
-            "1) Love\n2) Career\n3) Finance\n4) Health\n\n"
-            "Also include: 3-5 practical tips and 1-2 caveats.\n"
-            f"Tone: {'friendly' if style=='friendly' else 'formal'}\n"
-            "Avoid medical or investment guarantees. Be supportive and realistic."
-        )
+    if opts["stream"]:
+        return _sse_response(out)
+    return jsonify(out), 200 if out.get("cached") else 201
 
-    payload = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ],
-        "stream": False
-    }
+
+@app.post("/scan/analyze-predict")
+def scan_analyze_predict():
+    """
+    /analyze + /scan/save + /fortune/predict ใน request เดียว
+    รับรูปแบบเดียวกับ /analyze (multipart ``file`` หรือ JSON ``image_b64``) พร้อม
+    ค่า PipeConfig, ``meta`` (JSON) และตัวเลือก fortune (model/language/style/period/stream/force_refresh)
+
+    โหลดโปรไฟล์ผู้ใช้คู่ขนานกับการวิเคราะห์ภาพ, บันทึก scan แบบ slim (ไม่ต้องอัปโหลดผลกลับมา)
+    แล้วเรียก DeepSeek ทันทีที่มี summary
+    - ปกติคืน {scan_id, summary, analysis, fortune_id, answer}
+    - stream: SSE ``analysis`` (scan_id/summary/analysis) ตามด้วย ``delta`` ... ``done``
+    ``analysis`` ตัดภาพ base64 ออก เว้นแต่ส่ง include_masks=1
+    """
+    if not DEEPSEEK_KEY:
+        return jsonify({"error": "DEEPSEEK_API_KEY is missing"}), 500
+
+    params = request.form if request.files else (request.get_json(silent=True) or {})
+    user_id = _ensure_user_doc(_get_uid(request))
+    fair_key = _fairness_key(request)   # key เดียวกับ @_admit ของ /analyze และ /fortune/predict
+    opts = _fortune_options(params)
+
+    profile_future = _prefetch_safe_profile(user_id, refresh=opts["force_refresh"])
+
+    img, err = _decode_request_image(request)
+    if err:
+        return err
 
     try:
-        r = _HTTP.post(
-            f"{DEEPSEEK_BASE}/chat/completions",
-            headers={
-                "Authorization": f"Bearer {DEEPSEEK_KEY}",
-                "Content-Type": "application/json",
-            },
-            json=payload,
-            timeout=_get_timeout(),
-        )
-    except requests.exceptions.ReadTimeout:
-        return jsonify({"error": "deepseek_timeout", "detail": "DeepSeek read timed out"}), 504
-    except requests.RequestException as e:
-        return jsonify({"error": "request_failed", "detail": str(e)}), 502
+        with _GATES["analyze"].acquire(fair_key):
+            # ไม่ขอ include_masks ก็ไม่ต้อง encode PNG/RLE เลย
+            cfg = _pipe_config({**params, "include_masks": params.get("include_masks") or "0"})
+            out = _analyze_or_reuse(user_id, img, cfg, _to_bool(params.get("force_fresh"), False))
+    except Overloaded as e:
+        return _overloaded_response(e)
+    if isinstance(out, dict) and out.get("error"):
+        return jsonify(out), 422
 
-    if not r.ok:
+    meta = params.get("meta") or {}
+    if isinstance(meta, str):
         try:
-            return jsonify(r.json()), r.status_code
-        except Exception:
-            return jsonify({"error": r.text}), r.status_code
-
-    resp = r.json()
-    answer = (resp.get("choices") or [{}])[0].get("message", {}).get("content", "")
+            meta = json.loads(meta)
+        except ValueError:
+            meta = {}
+
+    entry = _SCAN_INDEX.lookup(out["scan_key"], user_id) if out.get("scan_key") else None
+    if entry and entry["scan_id"]:
+        # รูปซ้ำของ scan ที่บันทึกแล้ว: ใช้ scan เดิม (fortune มักได้จาก cache)
+        scan_id, summary = entry["scan_id"], _summarize_analyze(_slim_result(out))
+    else:
+        scan_id, summary = _save_scan(user_id, out, meta)
+        if entry:
+            _SCAN_INDEX.link(out["scan_key"], user_id, scan_id)
+    analysis = out if _to_bool(params.get("include_masks"), False) else _slim_result(out)
+    head = {"scan_id": scan_id, "summary": summary, "analysis": analysis}
+    if out.get("duplicate_of"):
+        head["duplicate_of"] = out["duplicate_of"]
 
-    doc = {
-        "user_id": user_id,
-        "scan_id": scan_id,
-        "summary": summary,
-        "model": model,
-        "language": language,
-        "style": style,
-        "period": period,
-        "period_text": {"th": period_text_th, "en": period_text_en},
-        "user_profile_used": safe_profile,
-        "answer": answer,
-        "raw": resp,
-        "createdAt": firestore.SERVER_TIMESTAMP,
-    }
+    safe_profile = profile_future.result()
 
-    ref = (
-        db.collection("users")
-          .document(user_id)
-          .collection("fortunes")
-          .add(doc)
-    )
+    # scan ถูกบันทึกแล้ว ถ้าทำนายไม่สำเร็จ client เรียก /fortune/predict ด้วย scan_id ซ้ำได้
+    try:
+        ticket = _GATES["llm"].acquire(fair_key)
+    except Overloaded as e:
+        return _overloaded_response(e, **head)
+    try:
+        fortune = _predict_fortune(user_id, scan_id, summary, safe_profile, opts)
+    except _DeepSeekError as e:
+        ticket.release()
+        return jsonify({**head, "error": e.body}), e.status
+    except Exception:
+        ticket.release()
+        raise
 
-    return jsonify({"fortune_id": ref[1].id, "answer": answer}), 201
+    if opts["stream"]:
+        resp = _sse_response(itertools.chain([_sse(head, event="analysis")], fortune))
+    else:
+        resp = app.make_response((jsonify({**head, **fortune}), 201))
+    return _hold_until_sent(resp, ticket)
 
 
-print("SERVE FILE:", __file__)
-print("DEEPSEEK_API_KEY set?:", bool(DEEPSEEK_KEY))
+log.info("serve_flask loaded", extra={"file": __file__, "deepseek_key_set": bool(DEEPSEEK_KEY)})
 
 if __name__ == "__main__":
-    print("URL MAP:", app.url_map)
-    app.run(host="0.0.0.0", port=8000, debug=True, use_reloader=False)
+    log.info("url map:\n%s", app.url_map)
+    # งาน CPU หนักของ /analyze/jobs อยู่ใน process pool; dev server รับ request แบบ threaded
+    app.run(host="0.0.0.0", port=8000, debug=_to_bool(os.getenv("FLASK_DEBUG"), True),
+            threaded=True, use_reloader=False)
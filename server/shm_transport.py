@@ -0,0 +1,265 @@
+# server/shm_transport.py
+"""
+Shared-memory image handoff between the Flask process and analyze workers.
+
+Instead of pickling images and mask arrays through the process pool's pipe,
+the Flask side leases a segment from ``SegmentPool``, decodes the upload into
+it and sends the worker only a small ``ShmRef`` (segment name, shape, dtype).
+The worker maps the segment (``view``) and wraps it as a NumPy array without
+copying, then unmaps everything it touched once the job is done
+(``detach_all``), so segments the pool unlinks are really freed. Raw output
+masks go back the same way, into a segment preallocated for the job.
+
+Segments are sized in power-of-two classes and reused after ``release``.
+Leases still held after ``leak_after`` seconds are counted as leaks by
+``reap``; those whose owner is no longer active are unlinked (never reused,
+a worker could still hold the mapping). Everything is unlinked on ``close``
+/ exit.
+"""
+import atexit
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from multiprocessing import resource_tracker, shared_memory
+
+import cv2
+import numpy as np
+
+_MIN_SEGMENT = 1 << 20   # 1 MiB
+
+log = logging.getLogger(__name__)
+
+
+class ShmPoolFull(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class ShmRef:
+    """Picklable pointer to an array inside a shared-memory segment."""
+    name: str
+    shape: tuple
+    dtype: str = "uint8"
+    offset: int = 0
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+
+def _size_class(nbytes: int) -> int:
+    size = _MIN_SEGMENT
+    while size < nbytes:
+        size <<= 1
+    return size
+
+
+class Lease:
+    __slots__ = ("shm", "size", "owner", "leased_at")
+
+    def __init__(self, shm, size: int, owner: str):
+        self.shm = shm
+        self.size = size
+        self.owner = owner
+        self.leased_at = time.monotonic()
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def ref(self, shape, dtype="uint8", offset: int = 0) -> ShmRef:
+        ref = ShmRef(self.shm.name, tuple(int(n) for n in shape), np.dtype(dtype).str, int(offset))
+        if offset + ref.nbytes > self.size:
+            raise ValueError(f"{ref.nbytes} bytes at offset {offset} do not fit a {self.size}-byte segment")
+        return ref
+
+    def array(self, ref: ShmRef) -> np.ndarray:
+        return np.ndarray(ref.shape, np.dtype(ref.dtype), buffer=self.shm.buf, offset=ref.offset)
+
+
+# ---------- Flask process side ----------
+class SegmentPool:
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, leak_after: float = 600.0,
+                 prefix: str = "palm"):
+        self.max_bytes = int(max_bytes)
+        self.leak_after = float(leak_after)
+        self.prefix = f"{prefix}_{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._free: dict[int, list] = {}       # size class -> [SharedMemory, ...]
+        self._leased: dict[str, Lease] = {}    # segment name -> Lease
+        self._bytes = 0
+        self._seq = 0
+        self.created = 0
+        self.reused = 0
+        self.leaked = 0
+        self.rejected = 0
+        atexit.register(self.close)
+
+    def _create(self, size: int):
+        self._seq += 1
+        shm = shared_memory.SharedMemory(name=f"{self.prefix}_{self._seq}", create=True, size=size)
+        self._bytes += size
+        self.created += 1
+        return shm
+
+    def _evict_free(self, need: int):
+        # ทิ้ง segment ว่างที่ไม่ได้ใช้ (ใหญ่สุดก่อน) จนมีที่พอ
+        for size in sorted(self._free, reverse=True):
+            while self._free[size] and self._bytes + need > self.max_bytes:
+                shm = self._free[size].pop()
+                shm.close()
+                shm.unlink()
+                self._bytes -= size
+
+    def lease(self, nbytes: int, owner: str = "") -> Lease:
+        """A segment of at least ``nbytes``; raises ``ShmPoolFull`` over ``max_bytes``."""
+        size = _size_class(nbytes)
+        with self._lock:
+            free = self._free.get(size)
+            if free:
+                shm = free.pop()
+                self.reused += 1
+            else:
+                if self._bytes + size > self.max_bytes:
+                    self._evict_free(size)
+                if self._bytes + size > self.max_bytes:
+                    self.rejected += 1
+                    raise ShmPoolFull(f"shared memory pool full ({self._bytes} of {self.max_bytes} bytes leased)")
+                shm = self._create(size)
+            lease = Lease(shm, size, owner)
+            self._leased[shm.name] = lease
+        return lease
+
+    def release(self, lease: Lease | None):
+        if lease is None:
+            return
+        with self._lock:
+            if self._leased.pop(lease.name, None) is lease:
+                self._free.setdefault(lease.size, []).append(lease.shm)
+
+    def alloc(self, shape, dtype="uint8", owner: str = "") -> tuple[Lease, ShmRef]:
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        lease = self.lease(nbytes, owner)
+        return lease, lease.ref(shape, dtype)
+
+    def put_array(self, arr: np.ndarray, owner: str = "") -> tuple[Lease, ShmRef]:
+        lease, ref = self.alloc(arr.shape, arr.dtype, owner)
+        np.copyto(lease.array(ref), arr)
+        return lease, ref
+
+    def decode(self, raw: bytes, owner: str = "") -> tuple[Lease, ShmRef] | None:
+        """Decode an encoded image into a leased segment; None if it is not an image."""
+        img = cv2.imdecode(np.frombuffer(raw, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            return None
+        # cv2.imdecode เขียนลง buffer ที่ให้ไม่ได้ จึงมี copy หนึ่งครั้งฝั่งนี้ (แทน pickle + copy ผ่าน pipe)
+        return self.put_array(img, owner)
+
+    def read(self, ref: ShmRef) -> np.ndarray:
+        """Copy of the array behind ``ref`` (segment must be leased from this pool)."""
+        with self._lock:
+            lease = self._leased.get(ref.name)
+        if lease is None:
+            raise KeyError(f"segment {ref.name} is not leased")
+        return lease.array(ref).copy()
+
+    def reap(self, active=None) -> int:
+        """
+        Unlink leases held longer than ``leak_after`` whose owner is not
+        ``active(owner)`` any more (e.g. the job is finished); returns how many.
+        Reaped segments are never put back in the free list.
+        """
+        now = time.monotonic()
+        with self._lock:
+            stale = [l for l in self._leased.values() if now - l.leased_at > self.leak_after
+                     and not (active is not None and l.owner and active(l.owner))]
+            stale = [l for l in stale if self._leased.pop(l.name, None) is l]
+            for lease in stale:
+                self._bytes -= lease.size
+            self.leaked += len(stale)
+        for lease in stale:
+            log.warning("leaked segment %s unlinked", lease.name, extra={
+                "bytes": lease.size, "owner": lease.owner or None, "held_s": round(now - lease.leased_at)})
+            try:
+                lease.shm.close()
+                lease.shm.unlink()
+            except (BufferError, FileNotFoundError):
+                pass
+        return len(stale)
+
+    def stats(self) -> dict:
+        with self._lock:
+            leased = sum(l.size for l in self._leased.values())
+            free = sum(len(v) for v in self._free.values())
+            return {
+                "segments": len(self._leased) + free,
+                "leased": len(self._leased),
+                "free": free,
+                "bytes": self._bytes,
+                "leased_bytes": leased,
+                "max_bytes": self.max_bytes,
+                "created": self.created,
+                "reused": self.reused,
+                "leaked": self.leaked,
+                "rejected": self.rejected,
+            }
+
+    def close(self):
+        with self._lock:
+            segments = [l.shm for l in self._leased.values()]
+            segments += [shm for free in self._free.values() for shm in free]
+            self._leased.clear()
+            self._free.clear()
+            self._bytes = 0
+        for shm in segments:
+            try:
+                shm.close()
+                shm.unlink()
+            except (BufferError, FileNotFoundError):
+                pass
+
+
+# ---------- worker process side ----------
+_ATTACHED: "OrderedDict[str, shared_memory.SharedMemory]" = OrderedDict()
+# ปกติ detach_all หลังจบแต่ละงาน ค่านี้กันไว้เผื่อ mapping ที่ยังปิดไม่ได้ค้างสะสม
+_MAX_ATTACHED = 4
+
+
+def _attach(name: str):
+    shm = _ATTACHED.get(name)
+    if shm is not None:
+        _ATTACHED.move_to_end(name)
+        return shm
+    # segment เป็นของ SegmentPool ฝั่ง Flask: ไม่ให้ resource_tracker ของ worker ไป unlink ตอน worker ออก
+    register = resource_tracker.register
+    resource_tracker.register = lambda *a, **k: None
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+    _ATTACHED[name] = shm
+    while len(_ATTACHED) > _MAX_ATTACHED:
+        _, old = _ATTACHED.popitem(last=False)
+        try:
+            old.close()
+        except BufferError:
+            pass
+    return shm
+
+
+def view(ref: ShmRef) -> np.ndarray:
+    """Zero-copy NumPy view of ``ref`` in this process."""
+    return np.ndarray(ref.shape, np.dtype(ref.dtype), buffer=_attach(ref.name).buf, offset=ref.offset)
+
+
+def detach_all():
+    """Unmap every segment this process attached; call when a job is done."""
+    for name in list(_ATTACHED):
+        try:
+            _ATTACHED[name].close()
+        except BufferError:
+            continue   # ยังมี view ค้างอยู่ (เช่นใน traceback) ปิดรอบหน้า
+        del _ATTACHED[name]
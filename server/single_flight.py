@@ -0,0 +1,71 @@
+# server/single_flight.py
+"""
+Single-flight call coalescing.
+
+``SingleFlight.do(key, fn)`` runs ``fn()`` once per key at a time: callers that
+arrive while the same key is in flight wait for that call and get its result
+(or its exception) instead of starting their own. Nothing is cached after the
+call finishes.
+"""
+import copy
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+
+
+def payload_key(payload: dict) -> str:
+    """Canonical key for a JSON request body (key order does not matter)."""
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    def __init__(self, name: str = "", wait_timeout: float | None = None):
+        self.name = name
+        self.wait_timeout = wait_timeout   # follower รอนานสุด (None = รอจน leader เสร็จ)
+        self._lock = threading.Lock()
+        self._calls: dict[str, Future] = {}
+        self.leaders = 0
+        self.shared = 0
+        self.errors = 0
+
+    def do(self, key: str, fn):
+        """Return ``(result, shared)``; ``shared`` is True when another caller did the work."""
+        with self._lock:
+            fut = self._calls.get(key)
+            leader = fut is None
+            if leader:
+                fut = self._calls[key] = Future()
+                self.leaders += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            # สำเนาแยกกัน เผื่อ caller แก้ dict ที่ได้ไป
+            return copy.deepcopy(fut.result(self.wait_timeout)), True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            with self._lock:
+                self.errors += 1
+            fut.set_exception(e)
+            raise
+        else:
+            fut.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.leaders + self.shared
+            return {
+                "in_flight": len(self._calls),
+                "leaders": self.leaders,
+                "shared": self.shared,
+                "errors": self.errors,
+                "coalesce_rate": round(self.shared / total, 3) if total else 0.0,
+            }
@@ -0,0 +1,6 @@
+# server/tests/conftest.py
+# module ของ server import กันด้วยชื่อตรงๆ (ไม่ได้เป็น package) จึงเพิ่ม server/ เข้า sys.path
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
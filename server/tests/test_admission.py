@@ -0,0 +1,77 @@
+import threading
+import time
+
+import pytest
+
+from admission import Admission, Overloaded
+
+
+def test_admits_up_to_max_concurrent_then_sheds():
+    gate = Admission("t", max_concurrent=2, max_queue=0)
+    a, b = gate.acquire("u1"), gate.acquire("u2")
+    with pytest.raises(Overloaded) as e:
+        gate.acquire("u3")
+    assert e.value.reason == "queue_full"
+    assert e.value.retry_after >= 1
+    a.release()
+    gate.acquire("u3").release()
+    b.release()
+    assert gate.stats()["active"] == 0
+    assert gate.stats()["shed"]["queue_full"] == 1
+
+
+def test_per_user_limit():
+    gate = Admission("t", max_concurrent=4, per_user=1)
+    ticket = gate.acquire("u1")
+    with pytest.raises(Overloaded) as e:
+        gate.acquire("u1")
+    assert e.value.reason == "per_user_limit"
+    gate.acquire("u2").release()
+    ticket.release()
+    gate.acquire("u1").release()
+
+
+def test_queued_request_times_out():
+    gate = Admission("t", max_concurrent=1, max_queue=1, max_wait=0.05)
+    with gate.acquire("u1"):
+        with pytest.raises(Overloaded) as e:
+            gate.acquire("u2")
+    assert e.value.reason == "wait_timeout"
+    assert gate.stats()["queued"] == 0
+    assert gate.stats()["active"] == 0
+
+
+def test_release_hands_the_slot_to_the_oldest_waiter():
+    gate = Admission("t", max_concurrent=1, max_queue=2, max_wait=5)
+    first = gate.acquire("u0")
+    order = []
+
+    def wait_for_slot(user):
+        with gate.acquire(user):
+            order.append(user)
+
+    threads = []
+    for user in ("u1", "u2"):
+        t = threading.Thread(target=wait_for_slot, args=(user,))
+        t.start()
+        threads.append(t)
+        while gate.queue_depth() < len(threads):
+            time.sleep(0.01)
+
+    # ที่ว่างไม่ถูกแย่งโดย request ใหม่ระหว่างที่มีคนรออยู่
+    with pytest.raises(Overloaded):
+        gate.acquire("u3")
+    first.release()
+    for t in threads:
+        t.join(5)
+    assert order == ["u1", "u2"]
+    assert gate.stats()["active"] == 0
+    assert gate.stats()["admitted"] == 3
+
+
+def test_ticket_release_is_idempotent():
+    gate = Admission("t", max_concurrent=1)
+    ticket = gate.acquire("u1")
+    ticket.release()
+    ticket.release()
+    assert gate.stats()["active"] == 0
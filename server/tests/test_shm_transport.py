@@ -0,0 +1,92 @@
+import cv2
+import numpy as np
+import pytest
+
+import shm_transport
+from shm_transport import SegmentPool, ShmPoolFull, view
+
+MB = 1 << 20
+
+
+@pytest.fixture
+def pool():
+    p = SegmentPool(max_bytes=8 * MB, leak_after=600)
+    yield p
+    shm_transport.detach_all()
+    p.close()
+
+
+def test_put_array_round_trips_through_a_view(pool):
+    arr = np.arange(300 * 400 * 3, dtype=np.uint32).reshape(300, 400, 3)
+    lease, ref = pool.put_array(arr, owner="job1")
+    assert ref.shape == arr.shape and ref.nbytes == arr.nbytes
+    np.testing.assert_array_equal(view(ref), arr)
+    np.testing.assert_array_equal(pool.read(ref), arr)
+    # view ไม่ได้ copy: เขียนฝั่ง worker แล้วฝั่ง pool เห็น
+    view(ref)[0, 0, 0] = 7
+    assert pool.read(ref)[0, 0, 0] == 7
+    shm_transport.detach_all()
+    assert not shm_transport._ATTACHED
+    pool.release(lease)
+
+
+def test_decode(pool):
+    img = np.full((40, 60, 3), 128, np.uint8)
+    ok, png = cv2.imencode(".png", img)
+    lease, ref = pool.decode(png.tobytes())
+    np.testing.assert_array_equal(pool.read(ref), img)
+    pool.release(lease)
+    assert pool.decode(b"not an image") is None
+
+
+def test_released_segments_are_reused_by_size_class(pool):
+    lease = pool.lease(100)
+    name, size = lease.name, lease.size
+    assert size == MB
+    pool.release(lease)
+    again = pool.lease(MB)
+    assert again.name == name
+    assert pool.stats()["reused"] == 1
+    bigger = pool.lease(MB + 1)
+    assert bigger.size == 2 * MB and bigger.name != name
+
+
+def test_pool_full_evicts_free_segments_first(pool):
+    leases = [pool.lease(MB) for _ in range(8)]
+    with pytest.raises(ShmPoolFull):
+        pool.lease(MB)
+    assert pool.stats()["rejected"] == 1
+    for lease in leases[:2]:
+        pool.release(lease)
+    # ที่ว่าง 2 MiB มาจากการทิ้ง segment 1 MiB ที่ไม่ได้ใช้สองอัน
+    big = pool.lease(2 * MB)
+    assert big.size == 2 * MB
+    assert pool.stats()["bytes"] <= pool.max_bytes
+
+
+def test_reap_skips_active_owners_and_never_reuses_reaped_segments():
+    pool = SegmentPool(max_bytes=8 * MB, leak_after=0)
+    try:
+        done = pool.lease(MB, owner="done-job")
+        running = pool.lease(MB, owner="running-job")
+        assert pool.reap(active=lambda owner: owner == "running-job") == 1
+        stats = pool.stats()
+        assert stats["leaked"] == 1 and stats["leased"] == 1 and stats["free"] == 0
+        assert stats["bytes"] == MB
+        # lease ที่ถูก reap แล้วคืนมาช้า ไม่กลับเข้า free list
+        pool.release(done)
+        assert pool.stats()["free"] == 0
+        assert pool.lease(MB).name not in (done.name, running.name)
+    finally:
+        pool.close()
+
+
+def test_close_unlinks_everything():
+    pool = SegmentPool(max_bytes=8 * MB)
+    lease = pool.lease(MB)
+    pool.release(pool.lease(MB))
+    name = lease.name
+    pool.close()
+    assert pool.stats()["segments"] == 0
+    with pytest.raises(FileNotFoundError):
+        shm_transport.shared_memory.SharedMemory(name=name)
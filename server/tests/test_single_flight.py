@@ -0,0 +1,81 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from single_flight import SingleFlight, payload_key
+
+
+def test_payload_key_ignores_key_order():
+    assert payload_key({"a": 1, "b": [1, 2]}) == payload_key({"b": [1, 2], "a": 1})
+    assert payload_key({"a": 1}) != payload_key({"a": 2})
+
+
+def _run_concurrently(sf, key, fn, n=5):
+    started = threading.Barrier(n)
+
+    def call():
+        started.wait()
+        return sf.do(key, fn)
+
+    pool = ThreadPoolExecutor(n)
+    futures = [pool.submit(call) for _ in range(n)]
+    pool.shutdown(wait=False)
+    return futures
+
+
+def test_concurrent_callers_share_one_call():
+    sf = SingleFlight("t")
+    calls = []
+    release = threading.Event()
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        return {"answer": [1]}
+
+    futures = _run_concurrently(sf, "k", fn)
+    time.sleep(0.2)
+    release.set()
+    results = [f.result(5) for f in futures]
+
+    assert len(calls) == 1
+    leaders = [r for r, shared in results if not shared]
+    followers = [r for r, shared in results if shared]
+    assert len(leaders) == 1 and len(followers) == 4
+    # follower ได้สำเนาของตัวเอง แก้แล้วไม่กระทบคนอื่น
+    followers[0]["answer"].append(2)
+    assert leaders[0]["answer"] == [1]
+    assert all(r["answer"] == [1] for r in followers[1:])
+    assert sf.stats()["in_flight"] == 0
+
+
+def test_exception_reaches_every_caller():
+    sf = SingleFlight("t")
+    release = threading.Event()
+
+    def fn():
+        release.wait(5)
+        raise RuntimeError("upstream failed")
+
+    futures = _run_concurrently(sf, "k", fn, n=3)
+    time.sleep(0.2)
+    release.set()
+    for f in futures:
+        with pytest.raises(RuntimeError):
+            f.result(5)
+    assert sf.stats()["errors"] == 1
+
+
+def test_nothing_is_cached_after_the_call():
+    sf = SingleFlight("t")
+    n = [0]
+
+    def fn():
+        n[0] += 1
+        return n[0]
+
+    assert sf.do("k", fn) == (1, False)
+    assert sf.do("k", fn) == (2, False)
+    assert sf.do("other", fn) == (3, False)
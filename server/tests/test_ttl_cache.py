@@ -0,0 +1,58 @@
+import types
+
+import pytest
+
+import ttl_cache
+from ttl_cache import TTLCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ttl_cache, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def test_get_set_and_expiry(clock):
+    c = TTLCache(maxsize=10, ttl=5)
+    c.set("a", 1)
+    assert c.get("a") == 1
+    assert "a" in c
+    clock[0] += 5
+    assert c.get("a") is None
+    assert "a" not in c
+    assert c.stats()["hits"] == 1
+    assert c.stats()["misses"] == 1
+
+
+def test_per_entry_ttl_and_remaining(clock):
+    c = TTLCache(maxsize=10, ttl=5)
+    c.set("long", 1, ttl=60)
+    c.set("never", 2, ttl=0)
+    assert "never" not in c
+    clock[0] += 30
+    assert c.get("long") == 1
+    assert c.remaining("long") == pytest.approx(30)
+    assert c.remaining("missing") == 0.0
+
+
+def test_lru_eviction(clock):
+    c = TTLCache(maxsize=2, ttl=60)
+    c.set("a", 1)
+    c.set("b", 2)
+    c.get("a")          # a ถูกใช้ล่าสุด: b ต้องถูกไล่ออกก่อน
+    c.set("c", 3)
+    assert c.get("b") is None
+    assert c.get("a") == 1 and c.get("c") == 3
+    assert len(c) == 2
+    assert c.stats()["evictions"] == 1
+
+
+def test_pop_and_clear(clock):
+    c = TTLCache(maxsize=10, ttl=60)
+    c.set("a", 1)
+    c.set("b", 2)
+    assert c.pop("a") == 1
+    assert c.pop("a", "gone") == "gone"
+    c.clear()
+    assert len(c) == 0
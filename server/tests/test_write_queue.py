@@ -0,0 +1,126 @@
+import types
+
+import pytest
+import requests
+from firebase_admin import firestore
+from google.api_core import exceptions as gexc
+
+import write_queue
+from memory_firestore import MemoryFirestore
+from write_queue import WriteQueue
+
+
+class FlakyFirestore(MemoryFirestore):
+    """MemoryFirestore whose batch commits fail: first with ``errors`` in order, then on ``reject(data)``."""
+
+    def __init__(self, errors=(), reject=None):
+        super().__init__()
+        self.errors = list(errors)
+        self.reject = reject
+        self.commits = 0
+
+    def batch(self):
+        batch = super().batch()
+        commit = batch.commit
+
+        def flaky_commit():
+            self.commits += 1
+            if self.errors:
+                raise self.errors.pop(0)
+            if self.reject and any(self.reject(data) for _, data, _ in batch._ops):
+                raise gexc.InvalidArgument("bad write")
+            commit()
+
+        batch.commit = flaky_commit
+        return batch
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    # backoff สั้นสุด (0.1s, 0.2s, ...) จะได้ไม่ต้องรอนาน
+    monkeypatch.setattr(write_queue, "random", types.SimpleNamespace(random=lambda: 0.0))
+
+
+def _queue(db, **kw):
+    kw.setdefault("linger", 0.01)
+    return WriteQueue(db, **kw)
+
+
+def _doc(db, path):
+    return db._docs.get(path)
+
+
+def test_writes_are_batched_and_visible_as_pending():
+    db = FlakyFirestore()
+    q = _queue(db, linger=0.3)
+    col = db.collection("users").document("u1").collection("scans")
+    ref = q.add(col, {"n": 1})
+    assert ref.path.startswith("users/u1/scans/")
+    assert q.pending(ref.path) == {"n": 1}
+    assert _doc(db, ref.path) is None
+    for i in range(10):
+        q.set(col.document(f"d{i}"), {"i": i})
+    assert q.flush(5)
+    assert _doc(db, ref.path) == {"n": 1}
+    assert q.pending(ref.path) is None
+    assert q.stats()["committed"] == 11
+    assert db.commits < 11
+
+
+def test_disabled_queue_writes_synchronously():
+    db = FlakyFirestore()
+    q = WriteQueue(db, enabled=False)
+    q.set(db.collection("c").document("a"), {"v": 1})
+    assert _doc(db, "c/a") == {"v": 1}
+
+
+def test_rejected_write_is_isolated_by_bisecting():
+    db = FlakyFirestore(reject=lambda data: data.get("bad"))
+    q = _queue(db, batch_size=8)
+    col = db.collection("c")
+    for i in range(8):
+        q.set(col.document(f"d{i}"), {"i": i, "bad": i == 5})
+    assert q.flush(5)
+    assert _doc(db, "c/d5") is None
+    assert all(_doc(db, f"c/d{i}") for i in range(8) if i != 5)
+    assert q.stats()["failed"] == 1
+
+
+@pytest.mark.parametrize("error", [gexc.ServiceUnavailable("down"), gexc.Aborted("contention")])
+def test_not_applied_batch_is_retried_whole(error):
+    db = FlakyFirestore(errors=[error])
+    q = _queue(db)
+    q.set(db.collection("c").document("a"), {"v": 1})
+    q.set(db.collection("c").document("n"), {"count": firestore.Increment(1)}, merge=True)
+    assert q.flush(5)
+    assert _doc(db, "c/a") == {"v": 1}
+    assert _doc(db, "c/n") == {"count": 1}
+    assert q.stats()["failed"] == 0
+
+
+@pytest.mark.parametrize("error", [
+    gexc.DeadlineExceeded("slow"),
+    gexc.RetryError("retries exhausted", None),
+    gexc.Cancelled("cancelled"),
+    requests.exceptions.ConnectionError("reset"),
+])
+def test_unknown_outcome_retries_only_idempotent_writes(error):
+    db = FlakyFirestore(errors=[error])
+    q = _queue(db)
+    q.set(db.collection("c").document("a"), {"v": 1})
+    q.set(db.collection("c").document("n"), {"count": firestore.Increment(1)}, merge=True)
+    assert q.flush(5)
+    assert _doc(db, "c/a") == {"v": 1}
+    # batch อาจ apply ไปแล้ว: Increment ไม่ถูกส่งซ้ำ
+    assert _doc(db, "c/n") is None
+    assert q.stats()["failed"] == 1
+
+
+def test_gives_up_after_max_retries():
+    db = FlakyFirestore(errors=[gexc.ServiceUnavailable("down")] * 10)
+    q = _queue(db, max_retries=2)
+    q.set(db.collection("c").document("a"), {"v": 1})
+    assert q.flush(5)
+    assert _doc(db, "c/a") is None
+    assert q.stats()["failed"] == 1
+    assert db.commits == 3
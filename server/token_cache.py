@@ -0,0 +1,47 @@
+# server/token_cache.py
+"""
+LRU cache of verified Firebase ID tokens.
+
+Entries are keyed by the SHA-256 digest of the token (the raw token is never
+stored) and expire at the token's ``exp`` claim. With ``check_revoked`` the
+token is verified with revocation checks and cached claims are re-verified
+every ``revoke_recheck`` seconds, so a revoked session is noticed quickly.
+"""
+import hashlib
+import time
+
+from ttl_cache import TTLCache
+
+
+class TokenCache:
+    def __init__(self, verify, maxsize: int = 4096, check_revoked: bool = False,
+                 revoke_recheck: float = 60.0):
+        """``verify(token, check_revoked=...)`` is ``firebase_admin.auth.verify_id_token``."""
+        self._verify = verify
+        self.cache = TTLCache(maxsize=maxsize, ttl=3600)
+        self.check_revoked = check_revoked
+        self.revoke_recheck = float(revoke_recheck)
+        self.failures = 0
+
+    def verify(self, token: str) -> dict:
+        key = hashlib.sha256(token.encode("utf-8")).digest()
+        decoded = self.cache.get(key)
+        if decoded is not None:
+            return decoded
+        try:
+            decoded = self._verify(token, check_revoked=self.check_revoked)
+        except Exception:
+            self.failures += 1
+            raise
+        ttl = float(decoded.get("exp", 0)) - time.time()
+        if self.check_revoked:
+            ttl = min(ttl, self.revoke_recheck)
+        self.cache.set(key, decoded, ttl=ttl)
+        return decoded
+
+    def stats(self) -> dict:
+        return {
+            **self.cache.stats(),
+            "verify_failures": self.failures,
+            "check_revoked": self.check_revoked,
+        }
@@ -0,0 +1,203 @@
+# server/write_queue.py
+"""
+Write-behind queue for Firestore.
+
+Endpoints enqueue ``set`` operations and return immediately; a background
+worker groups them into ``db.batch()`` commits. Document ids for ``add`` are
+allocated client-side (``collection.document()``), so callers get the id
+before the write reaches Firestore.
+
+A failed commit is handled by the kind of error. A rejected write (invalid
+argument, failed precondition, permission denied, or a value the client cannot
+encode) splits the batch in halves until only the bad write is left and
+dropped. If the batch was not applied (unavailable, throttled, aborted, or the
+auth transport failed before sending) the whole batch is retried with backoff.
+Anything else, such as deadlines, internal errors, cancellations, exhausted
+client retries or a dropped connection, leaves the outcome unknown: only the
+writes that are safe to apply twice are retried, never ``Increment`` ones.
+"""
+import atexit
+import logging
+import queue
+import random
+import threading
+import time
+
+from firebase_admin import firestore
+from google.api_core import exceptions as gexc
+from google.auth import exceptions as gauth_exc
+
+# Firestore rejects batches with more than 500 writes
+MAX_BATCH_WRITES = 500
+
+log = logging.getLogger(__name__)
+
+# Firestore ปฏิเสธ write บางตัวใน batch (ส่งซ้ำก็ไม่ผ่าน): แบ่งครึ่งหาตัวที่เสีย
+_REJECTED = (gexc.InvalidArgument, gexc.FailedPrecondition, gexc.PermissionDenied,
+             gexc.NotFound, gexc.AlreadyExists, gexc.OutOfRange, TypeError, ValueError)
+# Firestore ไม่ได้ apply batch นี้ ส่งซ้ำทั้งก้อนได้
+_NOT_APPLIED = (gexc.ServiceUnavailable, gexc.TooManyRequests, gexc.Aborted, gauth_exc.TransportError)
+# error อื่นทั้งหมด (DeadlineExceeded, InternalServerError, Cancelled, RetryError, connection ขาด ...)
+# ไม่รู้ว่า commit ไปแล้วหรือยัง: ส่งซ้ำได้เฉพาะ write ที่ apply ซ้ำแล้วผลเท่าเดิม
+
+
+def _has_increment(value) -> bool:
+    if isinstance(value, firestore.Increment):
+        return True
+    if isinstance(value, dict):
+        return any(_has_increment(v) for v in value.values())
+    return False
+
+
+class WriteQueue:
+    def __init__(self, db, maxsize: int = 1000, batch_size: int = 200,
+                 linger: float = 0.05, max_retries: int = 5, enabled: bool = True):
+        self.db = db
+        self.batch_size = max(1, min(int(batch_size), MAX_BATCH_WRITES))
+        self.linger = float(linger)
+        self.max_retries = int(max_retries)
+        self.enabled = enabled
+        self._q: "queue.Queue[tuple]" = queue.Queue(maxsize=max(1, int(maxsize)))
+        self._pending: dict[str, list] = {}   # path -> [count, latest data]
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._outstanding = 0
+        self._closed = False
+        self.committed = 0
+        self.failed = 0
+        self.sync_fallbacks = 0
+        self._worker = None
+        if enabled:
+            self._worker = threading.Thread(target=self._run, name="firestore-writer", daemon=True)
+            self._worker.start()
+            atexit.register(self.close)
+
+    # ---------- producer side ----------
+    def set(self, ref, data: dict, merge: bool = False):
+        """Queue ``ref.set(data, merge=merge)``; writes synchronously if the queue is off or full."""
+        if not self.enabled or self._closed:
+            ref.set(data, merge=merge)
+            return ref
+        with self._lock:
+            slot = self._pending.setdefault(ref.path, [0, None])
+            slot[0] += 1
+            if not merge:
+                slot[1] = data
+            self._outstanding += 1
+        try:
+            self._q.put_nowait((ref, data, merge))
+        except queue.Full:
+            # back-pressure: ยอมจ่าย round trip แทนการทิ้งข้อมูล
+            self._done([(ref, data, merge)])
+            self.sync_fallbacks += 1
+            ref.set(data, merge=merge)
+        return ref
+
+    def add(self, col_ref, data: dict):
+        """Like ``collection.add(data)`` but returns the new ``DocumentReference`` before it is written."""
+        ref = col_ref.document()
+        return self.set(ref, data)
+
+    def pending(self, path: str):
+        """Data of a queued (not yet committed) full-document write at ``path``, if any."""
+        with self._lock:
+            slot = self._pending.get(path)
+            return slot[1] if slot else None
+
+    def flush(self, timeout: float | None = 10.0) -> bool:
+        """Block until everything queued so far is committed (or failed)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._idle:
+            while self._outstanding > 0:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def close(self, timeout: float = 10.0):
+        if self._closed:
+            return
+        self.flush(timeout)
+        self._closed = True
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "queued": self._q.qsize(),
+            "outstanding": self._outstanding,
+            "committed": self.committed,
+            "failed": self.failed,
+            "sync_fallbacks": self.sync_fallbacks,
+        }
+
+    # ---------- worker side ----------
+    def _run(self):
+        while True:
+            ops = [self._q.get()]
+            deadline = time.monotonic() + self.linger
+            while len(ops) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    ops.append(self._q.get(timeout=max(0.0, remaining)) if remaining > 0
+                               else self._q.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit(ops)
+
+    def _commit(self, ops):
+        self._write(ops)
+        self._done(ops)
+
+    def _write(self, ops):
+        attempt = 0
+        while ops:
+            try:
+                batch = self.db.batch()
+                for ref, data, merge in ops:
+                    batch.set(ref, data, merge=merge)
+                batch.commit()
+                self.committed += len(ops)
+                return
+            except Exception as e:
+                if isinstance(e, _REJECTED):
+                    self._split(ops, e)
+                    return
+                attempt += 1
+                if attempt > self.max_retries:
+                    self.failed += len(ops)
+                    log.error("dropping %d writes after %d attempts: %s", len(ops), attempt, e)
+                    return
+                if not isinstance(e, _NOT_APPLIED):
+                    unsafe = [op for op in ops if _has_increment(op[1])]
+                    if unsafe:
+                        # batch อาจ apply ไปแล้ว: ส่ง Increment ซ้ำจะนับสองครั้ง ยอมเสียดีกว่านับเกิน
+                        self.failed += len(unsafe)
+                        log.error("commit outcome unknown, not retrying %d increment writes: %s", len(unsafe), e,
+                                  extra={"paths": [ref.path for ref, _, _ in unsafe][:20]})
+                        ops = [op for op in ops if not _has_increment(op[1])]
+                delay = min(5.0, 0.2 * (2 ** (attempt - 1))) * (0.5 + random.random())
+                log.warning("commit failed (attempt %d), retry in %.2fs: %s", attempt, delay, e)
+                time.sleep(delay)
+
+    def _split(self, ops, error):
+        # batch ถูกปฏิเสธทั้งก้อน (atomic) เพราะ write บางตัว: แบ่งครึ่งจนเหลือตัวที่เสียตัวเดียว
+        if len(ops) == 1:
+            self.failed += 1
+            log.error("dropping rejected write to %s: %s", ops[0][0].path, error)
+            return
+        mid = len(ops) // 2
+        self._write(ops[:mid])
+        self._write(ops[mid:])
+
+    def _done(self, ops):
+        with self._idle:
+            for ref, _, _ in ops:
+                slot = self._pending.get(ref.path)
+                if slot:
+                    slot[0] -= 1
+                    if slot[0] <= 0:
+                        del self._pending[ref.path]
+                self._outstanding -= 1
+            if self._outstanding <= 0:
+                self._idle.notify_all()